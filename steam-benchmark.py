@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from steam_catalog import GameCatalog
+from steam_corpus import ensure_corpus
+from steam_pagestore import LISTING_STORE, PageStore
+from steam_stats import STATS_DB
+from steam_stub_server import start_server
+from steam_telemetry import metrics
+
+
+def script(name):
+    # the scripts have hyphens in their names, they can be imported only by name
+    return importlib.import_module(name)
+
+
+def peak_memory():
+    """Returns the peak resident memory of the process in MB, None where it is not available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def reviews_path(params):
+    return os.path.join(params['corpus'], 'pages', 'reviews', 'all')
+
+
+def catalog(params):
+    return GameCatalog(os.path.join(params['corpus'], 'games.csv'))
+
+
+def listing_store(params):
+    return os.path.join(params['corpus'], 'pages', LISTING_STORE)
+
+
+def bench_listing(params):
+    script('steam-game-extractor').extract_games(listing_store(params), os.path.join(params['work'], 'games.csv'))
+    return params['counts']['games'], 'games'
+
+
+def bench_listing_cached(params):
+    script('steam-game-extractor').extract_games(listing_store(params),
+                                                 os.path.join(params['work'], 'games-cached.csv'))
+    return params['counts']['games'], 'games'
+
+
+def extract(params, name, parser='fast', dataset=None, force=True):
+    script('steam-review-extractor').extract_reviews(reviews_path(params), os.path.join(params['work'], name),
+                                                     catalog(params), None, 1, parser, dataset, force)
+    return metrics.counter('extract_reviews_total'), 'reviews'
+
+
+def bench_extract_bs4(params):
+    return extract(params, 'reviews-bs4.csv', 'bs4')
+
+
+def bench_extract_fast(params):
+    return extract(params, 'reviews.csv', 'fast')
+
+
+def bench_extract_cached(params):
+    return extract(params, 'reviews-cached.csv', force=False)
+
+
+def bench_extract_parquet(params):
+    return extract(params, 'reviews-parquet.csv', dataset=os.path.join(params['work'], 'dataset'))
+
+
+def stats(params, input, name):
+    output_dir = os.path.join(params['work'], name)
+    os.makedirs(output_dir, exist_ok=True)
+    script('steam-reviews-stats').process_reviews(os.path.join(params['work'], input), output_dir)
+    return params['counts']['reviews'], 'reviews'
+
+
+def bench_stats_csv(params):
+    return stats(params, 'reviews.csv', 'stats-csv')
+
+
+def bench_stats_parquet(params):
+    return stats(params, 'dataset', 'stats-parquet')
+
+
+def bench_crawl_listing(params):
+    script('steam-game-crawler').getgamepagesparallel(60, 3, 0, os.path.join(params['work'], 'crawl-listing'), True,
+                                                      None, params['baseurl'], workers=params['workers'])
+    return metrics.counter('crawl_pages_total'), 'pages'
+
+
+def bench_crawl_listing_refresh(params):
+    # all the pages are already in the store, they are requested again with conditional requests
+    return bench_crawl_listing(params)
+
+
+def crawl_reviews(params, name, structured):
+    ids = catalog(params).games()
+    script('steam-review-crawler').getgamereviews(ids, 'all', 60, 3, 0, os.path.join(params['work'], name),
+                                                  params['baseurl'], params['workers'], structured=structured)
+    return metrics.counter('crawl_pages_total'), 'pages'
+
+
+def bench_crawl_reviews(params):
+    return crawl_reviews(params, 'crawl-reviews', False)
+
+
+def bench_crawl_reviews_json(params):
+    return crawl_reviews(params, 'crawl-reviews-json', True)
+
+
+def clear(*names):
+    # outputs of previous runs that would make a stage skip work, removed before the stage
+    def prepare(params):
+        for name in names:
+            path = os.path.join(params['work'], name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+    return prepare
+
+
+def require(*stages):
+    # stages whose output is the input of a stage, run untimed when it is missing
+    def prepare(params):
+        for stage in stages:
+            outputs = BENCHMARKS[stage][1]
+            if not all(os.path.exists(os.path.join(params['work'], path)) for path in outputs):
+                run_untimed(stage, params)
+    return prepare
+
+
+def prepare_listing(params):
+    # the rows cached in the store by a previous run would leave no page to parse
+    store = PageStore(listing_store(params))
+    store.clear_extracted()
+    store.close()
+
+
+def prepare_stats_parquet(params):
+    require('extract-parquet')(params)
+    # the stats of a dataset are incremental, those of a previous run would leave nothing to aggregate
+    clear(os.path.join('dataset', STATS_DB))(params)
+
+
+# name: (function, files it writes in the work directory, untimed preparation run before it)
+BENCHMARKS = {
+    'listing': (bench_listing, ['games.csv'], prepare_listing),
+    'listing-cached': (bench_listing_cached, ['games-cached.csv'], require('listing')),
+    'extract-bs4': (bench_extract_bs4, ['reviews-bs4.csv'], None),
+    'extract-fast': (bench_extract_fast, ['reviews.csv'], None),
+    'extract-cached': (bench_extract_cached, ['reviews-cached.csv'], require('extract-fast')),
+    'extract-parquet': (bench_extract_parquet, ['dataset'], clear('dataset')),
+    'stats-csv': (bench_stats_csv, ['stats-csv'], require('extract-fast')),
+    'stats-parquet': (bench_stats_parquet, ['stats-parquet'], prepare_stats_parquet),
+    'crawl-listing': (bench_crawl_listing, ['crawl-listing'], clear('crawl-listing')),
+    'crawl-listing-refresh': (bench_crawl_listing_refresh, ['crawl-listing'], require('crawl-listing')),
+    'crawl-reviews': (bench_crawl_reviews, ['crawl-reviews'], clear('crawl-reviews')),
+    'crawl-reviews-json': (bench_crawl_reviews_json, ['crawl-reviews-json'], clear('crawl-reviews-json')),
+}
+
+
+def run_stage(name, params, results):
+    # runs in a new process, so that the peak memory is that of the stage alone
+    try:
+        # the memory of the interpreter and of the imported modules, before the stage starts
+        base = peak_memory()
+        with open(os.devnull, mode='w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+            start = perf_counter()
+            items, unit = BENCHMARKS[name][0](params)
+            seconds = perf_counter() - start
+        results.put({'seconds': seconds, 'items': items, 'unit': unit, 'base_mb': base, 'peak_mb': peak_memory()})
+    except BaseException:
+        results.put({'error': traceback.format_exc()})
+
+
+def run_process(name, params):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(name, params, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if 'error' in result:
+        raise RuntimeError(f'benchmark {name} failed:\n{result["error"]}')
+    return result
+
+
+def run_untimed(name, params):
+    prepare = BENCHMARKS[name][2]
+    if prepare:
+        prepare(params)
+    run_process(name, params)
+
+
+def run_benchmark(name, params, repeat=1):
+    """Runs a stage repeat times, each in a new process. Returns the best time and the highest peak memory."""
+    results = list()
+    for _ in range(repeat):
+        prepare = BENCHMARKS[name][2]
+        if prepare:
+            prepare(params)
+        results.append(run_process(name, params))
+    best = min(results, key=lambda result: result['seconds'])
+    peaks = [result['peak_mb'] for result in results if result['peak_mb'] is not None]
+    best['peak_mb'] = max(peaks) if peaks else None
+    best['throughput'] = best['items'] / best['seconds'] if best['seconds'] else None
+    return best
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def load_results(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_results(run, previous):
+    # previous is the last run with the same corpus, stages are compared on throughput
+    print(f'{"stage":<24}{"seconds":>10}{"throughput":>22}{"base MB":>10}{"peak MB":>10}{"vs previous":>14}')
+    for name, result in run['stages'].items():
+        throughput = f'{result["throughput"]:.1f} {result["unit"]}/s' if result['throughput'] else '-'
+        base = f'{result["base_mb"]:.0f}' if result['base_mb'] is not None else '-'
+        peak = f'{result["peak_mb"]:.0f}' if result['peak_mb'] is not None else '-'
+        change = ''
+        if previous and name in previous['stages'] and previous['stages'][name]['throughput']:
+            change = f'{result["throughput"] / previous["stages"][name]["throughput"]:.2f}x'
+        print(f'{name:<24}{result["seconds"]:>10.2f}{throughput:>22}{base:>10}{peak:>10}{change:>14}')
+    if previous:
+        print(f'previous run: {previous["time"]} {previous["commit"] or ""}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the stages of the crawl and extraction of Steam '
+                                                 'reviews, on a synthetic corpus and a local stub server')
+    parser.add_argument(
+        '-d', '--dir', help='Directory of the synthetic corpus and of the outputs of the benchmarks',
+        default='./benchmark', required=False)
+    parser.add_argument(
+        '-g', '--games', help='Number of games of the corpus. Default: 200', required=False, type=int, default=200)
+    parser.add_argument(
+        '-p', '--pages', help='Maximum number of review pages of a game. Default: 10', required=False, type=int,
+        default=10)
+    parser.add_argument(
+        '-n', '--reviews', help='Number of reviews per page. Default: 20', required=False, type=int, default=20)
+    parser.add_argument(
+        '-s', '--stages', help='Stages to benchmark. Default: all', required=False, nargs='+',
+        choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument(
+        '-r', '--repeat', help='Runs of every stage, the best is reported. Default: 1', required=False, type=int,
+        default=1)
+    parser.add_argument(
+        '-w', '--workers', help='Number of parallel crawlers in the crawl stages. Default: 8', required=False,
+        type=int, default=8)
+    parser.add_argument(
+        '-l', '--latency', help='Seconds the stub server waits before answering, in the crawl stages. Default: 0',
+        required=False, type=float, default=0.0)
+    parser.add_argument(
+        '-o', '--results', help='File to which the results are appended, one json line per run, and with whose '
+                                'previous runs they are compared. Default: DIR/benchmarks.jsonl', required=False)
+    args = parser.parse_args()
+
+    corpus = os.path.join(args.dir, 'corpus')
+    work = os.path.join(args.dir, 'work')
+    os.makedirs(work, exist_ok=True)
+    results_file = args.results or os.path.join(args.dir, 'benchmarks.jsonl')
+
+    print('preparing the corpus')
+    counts = ensure_corpus(corpus, args.games, args.pages, args.reviews)
+    # the index of the games is built once, not by the first stage that reads it
+    GameCatalog(os.path.join(corpus, 'games.csv')).close()
+    print(f'{counts["games"]} games, {counts["listing_pages"]} listing pages, {counts["review_pages"]} review '
+          f'pages, {counts["reviews"]} reviews')
+
+    params = {'corpus': corpus, 'work': work, 'counts': counts, 'workers': args.workers, 'baseurl': None}
+    server = None
+    if any(name.startswith('crawl') for name in args.stages):
+        server = start_server(pages=args.pages, reviews=args.reviews, games=args.games, latency=args.latency)
+        params['baseurl'] = f'http://127.0.0.1:{server.server_address[1]}'
+
+    stages = dict()
+    try:
+        for name in BENCHMARKS:
+            if name in args.stages:
+                print(f'running {name}')
+                stages[name] = run_benchmark(name, params, args.repeat)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    scale = {'games': args.games, 'pages': args.pages, 'reviews': args.reviews, 'workers': args.workers,
+             'latency': args.latency}
+    run = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(),
+           'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+           'scale': scale, 'repeat': args.repeat, 'stages': stages}
+    previous = [result for result in load_results(results_file) if result['scale'] == scale]
+    print_results(run, previous[-1] if previous else None)
+    with open(results_file, mode='a', encoding='utf-8') as f:
+        f.write(json.dumps(run) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -16,57 +16,98 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import json
 import os
 import re
-import socket
-import urllib
-import urllib.request
-from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
+from steam_http import backoff_pause, download_response, print_stats
+from steam_pagestore import LISTING_STORE, PageStore
+from steam_ratelimit import add_limiter_arguments, make_limiter
+from steam_telemetry import add_metrics_arguments, metrics
 
-def download_page(url, maxretries, timeout, pause):
-    tries = 0
-    htmlpage = None
-    while tries < maxretries and htmlpage is None:
-        try:
-            with closing(urllib.request.urlopen(url, timeout=timeout)) as f:
-                htmlpage = f.read()
-                sleep(pause)
-        except (urllib.error.URLError, socket.timeout, socket.error):
-            tries += 1
-    return htmlpage
+SEARCH_PARAMS = 'sort_by=_ASC&snr=1_7_7_230_7&supportedlang=all&ndl=1&ignore_preferences=1'
 
+# max results returned by a request to the infinite scroll json of the search
+MAX_SEARCH_COUNT = 100
 
-def getgamepages(timeout, maxretries, pause, out, force):
-    baseurl = 'http://store.steampowered.com/search/results?sort_by=_ASC&snr=1_7_7_230_7&supportedlang=all&ndl=1&ignore_preferences=1&page='
+# suffix of the name of an incomplete search page in the page store; names in the store have no extension,
+# pages of the json search are json objects, not html
+PARTIAL_SUFFIX = '.partial'
+
+gameidre = re.compile(r'/(app|bundle)/([0-9]+)/')
+
+
+def openstore(out):
+    """Opens the store of the listing pages in out, importing the pages that older crawls saved as html files."""
+    pagesdir = os.path.join(out, 'pages')
+    if not os.path.exists(pagesdir):
+        os.makedirs(pagesdir)
+    store = PageStore(os.path.join(pagesdir, LISTING_STORE))
+    filedir = os.path.join(pagesdir, 'games')
+    if os.path.isdir(filedir) and not store.names():
+        files = os.listdir(filedir)
+        for file in files:
+            with open(os.path.join(filedir, file), encoding='utf-8') as f:
+                store.put(os.path.splitext(file)[0], f.read())
+        print(f'{len(files)} pages imported from {filedir}')
+    return store
+
+
+def fetchpage(store, name, url, maxretries, timeout, pause, limiter):
+    """Downloads url, whose page is saved in store as name, with a conditional request if it is already there.
+
+    Returns the content of the page and the Response, whose status is 304
+    when the page in the store is still current, None if the download fails.
+    """
+    response = download_response(url, maxretries, timeout, pause, limiter, headers=store.validators(name))
+    if response is None:
+        return None
+    if response.status == 304:
+        return store.get(name), response
+    return response.body.decode(), response
+
+
+def storepage(store, name, page, url, response):
+    # unchanged pages are not written again
+    if response.status == 304 or not store.put(name, page, url, response.headers):
+        metrics.inc('crawl_unchanged_pages_total')
+
+
+def getgamepages(timeout, maxretries, pause, out, force, limiter=None, baseurl='http://store.steampowered.com'):
+    """Downloads the pages of the search listing, one after the other, until an empty page.
+
+    With force, the pages already in the store are downloaded again with a
+    conditional request, the server does not send again the pages that did
+    not change.
+    """
+    baseurl = f'{baseurl}/search/results?{SEARCH_PARAMS}&page='
     page = 0
-    gameidre = re.compile(r'/(app|bundle)/([0-9]+)/')
 
-    pagedir = os.path.join(out, 'pages', 'games')
-    if not os.path.exists(pagedir):
-        os.makedirs(pagedir)
+    store = openstore(out)
 
     retries = 0
     while True:
-        page_file = os.path.join(pagedir, f'games-page-{page}.html')
-        if os.path.exists(page_file) and not force:
-            print(f'File {page_file} already exists, skipping.')
+        name = f'games-page-{page}'
+        if name in store and not force:
+            print(f'Page {name} already downloaded, skipping.')
             page += 1
             continue
         url = f'{baseurl}{page}'
         print(page, url)
-        htmlpage = download_page(url, maxretries, timeout, pause)
+        result = fetchpage(store, name, url, maxretries, timeout, pause, limiter)
 
-        if htmlpage is None:
+        if result is None:
             print('Error downloading from ' + url)
-            sleep(pause * 10)
+            sleep(backoff_pause(pause, limiter) * 10)
         else:
-            htmlpage = htmlpage.decode()
-            with open(page_file, mode='w', encoding='utf-8') as f:
-                f.write(htmlpage)
+            htmlpage, response = result
+            storepage(store, name, htmlpage, url, response)
 
             pageids = set(gameidre.findall(htmlpage))
+            metrics.inc('crawl_pages_total')
+            metrics.inc('crawl_games_total', len(pageids))
             if len(pageids) == 0:
                 # sometimes you get an empty page but it is not actually
                 # the last one, so it is better to retry a few times before
@@ -81,6 +122,104 @@ def getgamepages(timeout, maxretries, pause, out, force):
             print(len(pageids), pageids)
             retries = 0
             page += 1
+    store.close()
+
+
+def searchurl(baseurl, start, count):
+    return f'{baseurl}/search/results/?query&start={start}&count={count}&{SEARCH_PARAMS}&infinite=1'
+
+
+def searchpagename(start, partial=False):
+    return f'games-start-{start}{PARTIAL_SUFFIX if partial else ""}'
+
+
+def getsearchpage(store, baseurl, start, count, timeout, maxretries, pause, limiter):
+    """Downloads count search results from start, saving their json in store.
+
+    Returns the total number of results reported by the server and whether
+    the page is complete, or None when the download fails. An incomplete
+    page is saved as games-start-N.partial, so that the extractor reads its
+    games; it is removed when the page is downloaded again complete.
+    """
+    url = searchurl(baseurl, start, count)
+    name = searchpagename(start)
+    result = fetchpage(store, name, url, maxretries, timeout, pause, limiter)
+    if result is None:
+        print('Error downloading from ' + url)
+        return None
+    page, response = result
+    try:
+        data = json.loads(page)
+        html = data['results_html']
+        total = int(data['total_count'])
+    except (ValueError, KeyError, TypeError):
+        print('Invalid search results from ' + url)
+        return None
+    found = len(set(gameidre.findall(html)))
+    complete = found >= min(count, total - start)
+    metrics.inc('crawl_pages_total')
+    metrics.inc('crawl_games_total', found)
+    if not complete:
+        metrics.inc('crawl_incomplete_pages_total')
+    if complete:
+        storepage(store, name, page, url, response)
+        if searchpagename(start, True) in store:
+            store.delete(searchpagename(start, True))
+    elif found:
+        store.put(searchpagename(start, True), page, url)
+    print(start, found, 'results' if complete else 'results, incomplete')
+    return total, complete
+
+
+def getgamepagesparallel(timeout, maxretries, pause, out, force, limiter=None, baseurl='http://store.steampowered.com',
+                         count=MAX_SEARCH_COUNT, workers=1):
+    """Downloads the search results in pages of count results, requesting them in parallel.
+
+    The first page gives the total number of results, so the range of pages
+    is known in advance and no request is wasted on the empty pages past the
+    end. Pages that fail or come back incomplete are requested again in the
+    following rounds, up to maxretries rounds. With force, the pages already
+    in the store are downloaded again with conditional requests, as in
+    getgamepages.
+    """
+    store = openstore(out)
+    try:
+        getsearchpages(store, timeout, maxretries, pause, force, limiter, baseurl, count, workers)
+    finally:
+        store.close()
+
+
+def getsearchpages(store, timeout, maxretries, pause, force, limiter, baseurl, count, workers):
+    result = getsearchpage(store, baseurl, 0, count, timeout, maxretries, pause, limiter)
+    if result is None:
+        return
+    total, complete = result
+    done = {0} if complete else set()
+    print(f'{total} results, {(total + count - 1) // count} pages of {count} results')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for attempt in range(maxretries + 1):
+            pending = [start for start in range(0, total, count) if start not in done
+                       and (force or searchpagename(start) not in store)]
+            if not pending:
+                break
+            if attempt > 0:
+                # the search sometimes answers with empty or short pages, that are fine a few seconds later
+                print(f'{len(pending)} pages missing, retrying')
+                sleep(5)
+            results = executor.map(lambda start: getsearchpage(store, baseurl, start, count, timeout, maxretries,
+                                                               pause, limiter), pending)
+            for start, result in zip(pending, results):
+                if result is None:
+                    continue
+                # the listing may grow while it is crawled
+                total = max(total, result[0])
+                if result[1]:
+                    done.add(start)
+        else:
+            missing = [start for start in range(0, total, count) if start not in done
+                       and (force or searchpagename(start) not in store)]
+            if missing:
+                print(f'{len(missing)} pages are missing or incomplete, run again to complete them: {missing}')
 
 
 def main():
@@ -101,12 +240,39 @@ def main():
         type=int, default=-1)
     parser.add_argument(
         '-o', '--out', help='Output base path', required=False, default='data')
+    parser.add_argument(
+        '-b', '--baseurl', help='Base url of the Steam store. Default: http://store.steampowered.com',
+        required=False, default='http://store.steampowered.com')
+    parser.add_argument(
+        '-j', '--json', help='Use the json search endpoint: the total number of results is read from the first '
+                             'request, and pages of --count results are downloaded in parallel by --workers',
+        required=False, action='store_true')
+    parser.add_argument(
+        '-c', '--count', help=f'Results per request with --json, at most {MAX_SEARCH_COUNT}. '
+                              f'Default: {MAX_SEARCH_COUNT}', required=False, type=int, default=MAX_SEARCH_COUNT)
+    parser.add_argument(
+        '-w', '--workers', help='Number of pages downloaded in parallel with --json. Default: 1', required=False,
+        type=int, default=1)
+    add_limiter_arguments(parser)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
     if not os.path.exists(args.out):
         os.makedirs(args.out)
 
-    getgamepages(args.timeout, args.maxretries, args.pause, args.out, args.force)
+    workers = args.workers if args.json else 1
+    limiter, pause = make_limiter(workers, args.pause, args.rate, args.maxinflight, args.adaptive, args.maxrate)
+
+    if args.metrics:
+        metrics.start_export(args.metrics, args.metricsinterval)
+    if args.json:
+        getgamepagesparallel(args.timeout, args.maxretries, pause, args.out, args.force, limiter, args.baseurl,
+                             min(args.count, MAX_SEARCH_COUNT), workers)
+    else:
+        getgamepages(args.timeout, args.maxretries, pause, args.out, args.force, limiter, args.baseurl)
+    metrics.stop_export()
+    print_stats()
+    print(metrics.summary())
 
 
 if __name__ == '__main__':
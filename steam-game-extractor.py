@@ -16,64 +16,111 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import csv
+import json
 import os
 import re
-import socket
-import urllib
-import urllib.request
-from contextlib import closing
-from time import sleep
 
-import pandas as pd
 from tqdm import tqdm
 
+from steam_pagestore import LISTING_STORE, PageStore, page_key
 
-def download_page(url, maxretries, timeout, pause):
-    tries = 0
-    htmlpage = None
-    while tries < maxretries and htmlpage is None:
-        try:
-            with closing(urllib.request.urlopen(url, timeout=timeout)) as f:
-                htmlpage = f.read()
-                sleep(pause)
-        except (urllib.error.URLError, socket.timeout, socket.error):
-            tries += 1
-    return htmlpage
+COLUMNS = ['package_type', 'game_id', 'game_title']
 
+# a result of the listing is a link to the page of the game, with its title within the link
+resultre = re.compile(r'<a\s[^>]*?href="[^"]*?/(app|bundle)/([0-9]+)/[^>]*>(.*?)</a>', re.S)
+gamenamere = re.compile(r'<span class="title">(.*?)</span>')
 
-def extract_games(basepath, outputfile_name):
-    gameidre = re.compile(r'/(app|bundle)/([0-9]+)/')
-    gamenamere = re.compile(r'<span class="title">(.*?)</span>')
-    games = dict()
-    for root, _, files in os.walk(basepath):
-        for file in tqdm(files):
-            fullpath = os.path.join(root, file)
+
+def page_html(page):
+    # pages of the json search endpoint have the html of the results in results_html
+    if page.lstrip().startswith('{'):
+        return json.loads(page)['results_html']
+    return page
+
+
+def result_rows(htmlpage):
+    """Yields package type, id and title of every result in a page of the listing, in order.
+
+    Id and title are taken from the same result, links to games that are not
+    results (they have no title) are skipped.
+    """
+    for match in resultre.finditer(htmlpage):
+        title = gamenamere.search(match.group(3))
+        if title:
+            yield match.group(1), match.group(2), title.group(1)
+
+
+def listing_rows(basepath):
+    """Yields the rows of every page of the listing, from a page store or from a directory of html pages.
+
+    The rows of a page in a store are saved in the store with the hash of the
+    page, the next extractions parse only the pages that changed.
+    """
+    if os.path.isdir(basepath):
+        files = [os.path.join(root, file) for root, _, files in os.walk(basepath) for file in files]
+        for fullpath in tqdm(sorted(files, key=page_key)):
             with open(fullpath, encoding='utf8') as f:
-                htmlpage = f.read()
+                yield from result_rows(page_html(f.read()))
+        return
+    store = PageStore(basepath)
+    parsed = 0
+    names = store.names()
+    for name in tqdm(names):
+        sha1 = store.sha1(name)
+        rows = store.extracted(name, sha1)
+        if rows is None:
+            rows = list(result_rows(page_html(store.get(name))))
+            store.save_extracted(name, sha1, rows)
+            parsed += 1
+        yield from rows
+    store.close()
+    print(f'{parsed} pages parsed, {len(names) - parsed} pages unchanged since the last extraction')
+
 
-                gameids = list(gameidre.findall(htmlpage))
-                gamenames = list(gamenamere.findall(htmlpage))
-                for package_type, game_id, game_title in zip([package_type for (package_type, _) in gameids],
-                                                             [game_id for (_, game_id) in gameids], gamenames):
-                    games[(package_type, game_id)] = game_title
+def listing_input(basepath):
+    """Returns the store or the directory of pages to read, checked before the output is overwritten.
 
-    df = pd.DataFrame(
-        [(package_type, game_id, title) for (package_type, game_id), title in games.items()],
-        columns=['package_type', 'game_id', 'game_title']
-    )
-    df.to_csv(outputfile_name, index=False, encoding='utf-8')
+    When the store is missing, the html pages that older crawls saved in the
+    games directory next to it are read instead. A missing input is an error,
+    an empty store is never created.
+    """
+    if os.path.exists(basepath):
+        return basepath
+    legacydir = os.path.join(os.path.dirname(basepath), 'games')
+    if os.path.isdir(legacydir):
+        print(f'{basepath} not found, reading the html pages in {legacydir}')
+        return legacydir
+    raise FileNotFoundError(f'{basepath} not found, download the listing with steam-game-crawler.py')
+
+
+def extract_games(basepath, outputfile_name):
+    basepath = listing_input(basepath)
+    games = set()
+    with open(outputfile_name, mode='w', encoding='utf-8', newline='') as outputfile:
+        writer = csv.writer(outputfile, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        for package_type, game_id, game_title in listing_rows(basepath):
+            # a game can be listed in two pages, when the listing changes while it is crawled
+            if (package_type, game_id) in games:
+                continue
+            games.add((package_type, game_id))
+            writer.writerow((package_type, game_id, game_title))
 
 
 def main():
     parser = argparse.ArgumentParser(description='Extractor of Steam game ids and names from crawled HTML pages.')
     parser.add_argument(
-        '-i', '--input', help='Input file or path (all files in subpath are processed)', default='./data/pages/games',
-        required=False)
+        '-i', '--input', help='Input page store, or path of html pages (all files in subpath are processed)',
+        default=f'./data/pages/{LISTING_STORE}', required=False)
     parser.add_argument(
         '-o', '--output', help='Output file', default='./data/games.csv', required=False)
     args = parser.parse_args()
 
-    extract_games(args.input, args.output)
+    try:
+        extract_games(args.input, args.output)
+    except FileNotFoundError as e:
+        parser.error(str(e))
 
 
 if __name__ == '__main__':
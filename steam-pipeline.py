@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import csv
+import importlib
+import os
+import queue
+import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from steam_catalog import GameCatalog
+from steam_checkpoint import atomic_write
+from steam_dedup import SeenKeys
+from steam_http import print_stats
+from steam_index import ReviewIndex
+from steam_reviewparse import PARSERS
+from steam_stats import ReviewStats, read_chunks
+from steam_ratelimit import add_limiter_arguments
+from steam_telemetry import add_metrics_arguments, metrics
+
+# the stages are those of the batch scripts, whose names are not valid module names
+crawler = importlib.import_module('steam-review-crawler')
+extractor = importlib.import_module('steam-review-extractor')
+
+# pages downloaded and not yet parsed, beyond it the crawlers wait for the extraction
+PAGE_BUFFER = 100
+# games parsed and not yet added to the output
+GAME_BUFFER = 4
+# seconds between two writes of the stats
+STATS_INTERVAL = 60
+POLL = 1
+
+
+class StageQueue(queue.Queue):
+    """Bounded queue between two stages of the pipeline.
+
+    Puts and gets raise, instead of waiting forever, once failed is set by a
+    stage that stopped on an error.
+    """
+
+    def __init__(self, maxsize, failed):
+        super().__init__(maxsize)
+        self.failed = failed
+
+    def put(self, item, block=True, timeout=None):
+        while True:
+            if self.failed.is_set():
+                raise RuntimeError('a stage of the pipeline failed')
+            try:
+                return super().put(item, timeout=POLL)
+            except queue.Full:
+                pass
+
+    def get(self, block=True, timeout=None):
+        while True:
+            try:
+                return super().get(timeout=POLL)
+            except queue.Empty:
+                if self.failed.is_set():
+                    raise RuntimeError('a stage of the pipeline failed')
+
+
+class GameSpool:
+    """Unique rows of a game being crawled, spooled to a csv file until the game is complete."""
+
+    def __init__(self, path, resumed=False):
+        self.path = path
+        self.resumed = resumed
+        self.counts = Counter()
+        self.seen = SeenKeys()
+        self._file = open(path, mode='w', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(extractor.COLUMNS)
+
+    def write(self, rows):
+        self._writer.writerows(extractor.unique_reviews(rows, self.counts, self.seen))
+
+    def close(self):
+        self._file.close()
+        self.seen.close()
+
+    def discard(self):
+        self.close()
+        os.remove(self.path)
+
+
+def read_log(logfile):
+    # lines are "game_id<TAB>size of the output after the rows of the game", a truncated last line is ignored
+    entries = list()
+    if os.path.exists(logfile):
+        with open(logfile, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if line.endswith('\n') and len(fields) == 2 and fields[1].isdigit():
+                    entries.append((fields[0], int(fields[1])))
+    return entries
+
+
+def recover_output(outputfile_name, logfile, stats):
+    """Returns the ids of the games already in the output, adding their reviews to stats.
+
+    Rows written after the last game in the log, by a run that stopped before
+    logging their game, are truncated. A missing log starts a new output.
+    """
+    entries = read_log(logfile) if os.path.exists(outputfile_name) else []
+    if not entries:
+        with open(outputfile_name, mode='w', encoding='utf-8', newline='') as f:
+            csv.writer(f).writerow(extractor.COLUMNS)
+        atomic_write(logfile, '')
+        return set()
+    with open(outputfile_name, mode='r+b') as f:
+        f.truncate(entries[-1][1])
+    atomic_write(logfile, ''.join(f'{game_id}\t{size}\n' for game_id, size in entries))
+    print(f'{len(entries)} games already in {outputfile_name}, reading their stats')
+    for chunk in read_chunks(outputfile_name):
+        stats.add(chunk)
+    return {game_id for game_id, _ in entries}
+
+
+def extract_pages(pages, games, spooldir, parser, logged):
+    """Parses the pages of every game as they are crawled, passing the spool of the complete games to games.
+
+    The pages of a game resumed from a previous run, and the games whose
+    archive was complete before the crawl, are parsed from their archive.
+    """
+    spools = dict()
+    try:
+        while True:
+            event = pages.get()
+            if event is None:
+                break
+            kind, id_, name, gamedir, data = event
+            if id_ in logged:
+                # the game is already in the output
+                continue
+            path = os.path.join(spooldir, f'{id_}.csv')
+            if kind == 'start':
+                spools[id_] = GameSpool(path, data)
+            elif kind == 'page':
+                spool = spools[id_]
+                if not spool.resumed:
+                    file, page = data
+                    spool.write((key, (id_, name) + row) for key, row in extractor.page_reviews(file, page, parser))
+            elif kind == 'failed':
+                # the crawl of the game continues in the next run
+                spools.pop(id_).discard()
+            elif kind in ('done', 'existing'):
+                spool = spools.pop(id_, None)
+                if spool is None or spool.resumed:
+                    # the pages downloaded before a restart are only in the archive
+                    if spool is not None:
+                        spool.discard()
+                    spool = GameSpool(path)
+                    spool.write(extractor.game_reviews(gamedir, id_, name, False, parser))
+                    metrics.inc('extract_games_total', source='archive')
+                else:
+                    metrics.inc('extract_games_total', source='stream')
+                spool.close()
+                metrics.inc('extract_duplicates_total', spool.counts['duplicates'])
+                games.put((id_, spool.path))
+        games.put(None)
+    finally:
+        for spool in spools.values():
+            spool.discard()
+
+
+def aggregate_games(games, outputfile_name, logfile, stats, stats_dir, interval, indexfile=None, fts=False):
+    """Appends the rows of every complete game to the output and adds them to the stats, written every interval.
+
+    With an indexfile, the rows are also added to the query index in it.
+    """
+    last = monotonic()
+    # the connection to the index belongs to the thread of this stage
+    index = ReviewIndex(indexfile, fts) if indexfile else None
+    with open(outputfile_name, mode='ab') as outputfile, open(logfile, mode='a', encoding='utf-8') as log:
+        while True:
+            item = games.get()
+            if item is None:
+                break
+            id_, path = item
+            with open(path, mode='rb') as f:
+                # the header
+                f.readline()
+                shutil.copyfileobj(f, outputfile)
+            outputfile.flush()
+            os.fsync(outputfile.fileno())
+            count = 0
+            for chunk in read_chunks(path):
+                stats.add(chunk)
+                count += len(chunk)
+            if index is not None:
+                # before the log, a game indexed by a stopped run is replaced when it is added again
+                with open(path, mode='r', encoding='utf-8', newline='') as f:
+                    f.readline()
+                    index.add_reviews(id_, csv.reader(f))
+            os.remove(path)
+            # a game is in the output once it is in the log, with the size of the output after its rows
+            log.write(f'{id_}\t{outputfile.tell()}\n')
+            log.flush()
+            os.fsync(log.fileno())
+            metrics.inc('extract_reviews_total', count)
+            print(f'{count} reviews of {id_} added to {outputfile_name}')
+            if monotonic() - last >= interval:
+                stats.write(stats_dir)
+                last = monotonic()
+    stats.write(stats_dir)
+    if index is not None:
+        index.close()
+
+
+def run_stage(failed, function, *args):
+    try:
+        function(*args)
+    except BaseException:
+        failed.set()
+        raise
+
+
+def run_pipeline(ids, outputfile_name, stats_dir, parser, buffer, interval, *crawl_args, indexfile=None, fts=False,
+                 **crawl_kwargs):
+    """Crawls the reviews of the games, parsing every page and aggregating its game as soon as it is downloaded.
+
+    The crawl writes the same archives of steam-review-crawler.py; the
+    rows of every complete game are appended to the output, with the same
+    content steam-review-extractor.py extracts from its archive, and the stats
+    of the output are written to stats_dir every interval seconds. The stages
+    run in parallel, connected by bounded queues. A stopped pipeline continues
+    from where it stopped. With an indexfile, the rows are also added to the
+    query index in it, as steam-review-extractor.py --index does.
+    """
+    logfile = outputfile_name + '.games'
+    stats = ReviewStats()
+    logged = recover_output(outputfile_name, logfile, stats)
+    # the spools of a stopped run are of games that are crawled again
+    spooldir = outputfile_name + '.spool'
+    shutil.rmtree(spooldir, ignore_errors=True)
+    os.makedirs(spooldir)
+    failed = threading.Event()
+    pages = StageQueue(buffer, failed)
+    games = StageQueue(GAME_BUFFER, failed)
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            extraction = executor.submit(run_stage, failed, extract_pages, pages, games, spooldir, parser, logged)
+            aggregation = executor.submit(run_stage, failed, aggregate_games, games, outputfile_name, logfile, stats,
+                                          stats_dir, interval, indexfile, fts)
+            try:
+                crawler.getgamereviews(ids, *crawl_args, pages=pages, **crawl_kwargs)
+            finally:
+                if not failed.is_set():
+                    pages.put(None)
+            extraction.result()
+            aggregation.result()
+    finally:
+        shutil.rmtree(spooldir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crawler, extractor and stats of Steam reviews in a single pass')
+    parser.add_argument(
+        '-l', '--language', help='Language of the reviews. Default: all', required=False, default='all')
+    parser.add_argument(
+        '-t', '--timeout', help='Timeout in seconds for http connections. Default: 180', required=False, type=int,
+        default=180)
+    parser.add_argument(
+        '-r', '--maxretries', help='Max retries to download a file. Default: 3', required=False, type=int,
+        default=3)
+    parser.add_argument(
+        '-p', '--pause', help='Seconds to wait between http requests. Default: 0.5', required=False, default=0.5,
+        type=float)
+    parser.add_argument(
+        '-m', '--maxreviews', help='Maximum number of reviews per item to download. Default:unlimited',
+        required=False, type=int, default=-1)
+    parser.add_argument(
+        '-o', '--out', help='Output base path of the downloaded pages', required=False, default='data')
+    parser.add_argument(
+        '-i', '--ids', help='File with game ids', required=False, default='./data/games.csv')
+    parser.add_argument(
+        '--title', help='Crawl only games whose title matches the given regular expression', required=False)
+    parser.add_argument(
+        '-b', '--baseurl', help='Base url of the Steam store. Default: http://store.steampowered.com',
+        required=False, default='http://store.steampowered.com')
+    parser.add_argument(
+        '-w', '--workers', help='Number of games crawled in parallel. Default: 1', required=False, type=int,
+        default=1)
+    add_limiter_arguments(parser)
+    parser.add_argument(
+        '-j', '--json', help='Download reviews in the structured json format of the Steam API, 100 per request',
+        required=False, action='store_true')
+    parser.add_argument(
+        '--reviews', help='Output file of the reviews', required=False, default='./data/reviews.csv')
+    parser.add_argument(
+        '--stats', help='Output dir for stats', required=False, default='./data/')
+    parser.add_argument(
+        '--index', help='Also add the reviews to a sqlite query index in the given file, see steam-review-index.py',
+        required=False)
+    parser.add_argument(
+        '--fts', help='Also index the text of the reviews for full text search in the query index',
+        required=False, action='store_true')
+    parser.add_argument(
+        '--parser', help='Parser of the html of reviews, as in steam-review-extractor.py. Default: fast',
+        required=False, choices=sorted(PARSERS), default='fast')
+    parser.add_argument(
+        '--buffer', help=f'Max pages downloaded and not yet parsed. Default: {PAGE_BUFFER}', required=False,
+        type=int, default=PAGE_BUFFER)
+    parser.add_argument(
+        '--statsinterval', help=f'Seconds between two writes of the stats. Default: {STATS_INTERVAL}',
+        required=False, type=float, default=STATS_INTERVAL)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    for path in (args.out, args.stats, os.path.dirname(os.path.abspath(args.reviews))):
+        os.makedirs(path, exist_ok=True)
+
+    ids = GameCatalog(args.ids).games(args.title)
+    print(f'{len(ids)} games')
+
+    if args.metrics:
+        metrics.start_export(args.metrics, args.metricsinterval)
+    run_pipeline(ids, args.reviews, args.stats, args.parser, args.buffer, args.statsinterval, args.language,
+                 args.timeout, args.maxretries, args.pause, args.out, args.baseurl, args.workers, args.rate,
+                 args.maxinflight, args.adaptive, args.maxrate, indexfile=args.index, fts=args.fts,
+                 structured=args.json, maxreviews=args.maxreviews)
+    metrics.stop_export()
+    print_stats()
+    print(metrics.summary())
+
+
+if __name__ == '__main__':
+    main()
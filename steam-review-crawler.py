@@ -16,98 +16,412 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import datetime
 import json
 import os
-import pandas as pd
 import re
-import socket
 import string
+import threading
 import urllib
 import urllib.parse
-import urllib.request
 import zipfile
-from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from time import sleep
 
+from steam_archive import PageArchive, append_pages, restore_tail
+from steam_catalog import GameCatalog
+from steam_checkpoint import clear_checkpoint, load_checkpoint, load_state, save_checkpoint, save_state
+from steam_dedup import SeenKeys
+from steam_http import backoff_pause, download_page, print_stats
+from steam_ratelimit import AdaptiveRateLimiter, add_limiter_arguments, make_limiter
+from steam_reviewpages import drop_seen, page_keys, page_size, trim_known, trim_page
+from steam_telemetry import add_metrics_arguments, metrics
+from steam_workqueue import LEASE_TIME, LEASED, LeaseLost, WorkQueue
 
-def download_page(url, maxretries, timeout, pause):
-    tries = 0
-    htmlpage = None
-    while tries < maxretries and htmlpage is None:
-        try:
-            with closing(urllib.request.urlopen(url, timeout=timeout)) as f:
-                htmlpage = f.read()
-                sleep(pause)
-        except (urllib.error.URLError, socket.timeout, socket.error):
-            tries += 1
-    return htmlpage
+# number of most recent review keys kept to detect where a refresh reaches the already downloaded reviews
+HEAD_SIZE = 100
 
+# max number of reviews per request of the structured json format
+MAX_PER_PAGE = 100
 
-def getgameids(filename):
-    df = pd.read_csv(filename, encoding='utf8')
-    ids = set(df.iloc[:, :3].itertuples(index=False, name=None))
-    return ids
+# keys of the reviews downloaded by an unfinished crawl of a game, to drop the reviews repeated by the cursor paging
+SEEN_FILE = 'seen.sqlite'
 
+# pages downloaded between two checkpoints of a game, each one syncs the archive and commits the seen keys;
+# a crawl that crashes downloads again the pages after the last checkpoint
+CHECKPOINT_PAGES = 10
 
-def getgamereviews(ids, language, timeout, maxretries, pause, out):
-    urltemplate = string.Template(
-        f'http://store.steampowered.com//appreviews/$id?cursor=$cursor&filter=recent&language={language}')
-    endre = re.compile(r'({"success":2})|(no_more_reviews)')
+# seconds between checks of a work queue whose remaining games are leased by other crawlers
+QUEUE_POLL = 10
+
+endre = re.compile(r'({"success":2})|(no_more_reviews)')
+pagere = re.compile(r'reviews-([0-9]+)\.(html|json)$')
+
+
+def getgameids(filename, title_pattern=None):
+    return GameCatalog(filename).games(title_pattern)
+
+
+def reviewsurl(baseurl, language, structured):
+    if structured:
+        return string.Template(f'{baseurl}//appreviews/$id?json=1&num_per_page=$num&cursor=$cursor&filter=recent'
+                               f'&language={language}&purchase_type=all')
+    return string.Template(f'{baseurl}//appreviews/$id?cursor=$cursor&filter=recent&language={language}')
+
+
+def islastpage(htmlpage, parsed_json, structured):
+    if endre.search(htmlpage):
+        return True
+    # the structured format signals the end with an empty list of reviews
+    return structured and not parsed_json.get('reviews')
+
+
+def getheadkeys(zipfilename):
+    # keys of the most recent reviews in a reviews.zip crawled before states were saved
+    keys = list()
+    with zipfile.ZipFile(zipfilename, 'r') as zipf:
+        pages = sorted((int(m.group(1)), file) for file in zipf.namelist() for m in [pagere.match(file)] if m)
+        for _, file in pages:
+            try:
+                keys.extend(page_keys(json.loads(zipf.read(file))))
+            except ValueError:
+                continue
+            if len(keys) >= HEAD_SIZE:
+                break
+    return keys[:HEAD_SIZE]
+
+
+class CrawlStopped(Exception):
+    """The crawl was stopped before the game was complete, it is resumed from its checkpoint by the next crawl."""
 
-    for (dir, id_, name) in ids:
-        if dir == 'bundle':
-            print(f'skipping bundle {id_} {name}')
-            continue
-        if type(id_) is not str:
-            id_ = str(id_)
 
-        gamedir = os.path.join(out, 'pages', 'reviews', language, '-'.join((dir, id_)))
+def checkstop(stop, id_, name):
+    # the workers of a parallel crawl stop at the next page when the crawl is interrupted or fails
+    if stop is not None and stop.is_set():
+        raise CrawlStopped(f'crawl of {id_} {name} stopped')
 
-        zipfilename = os.path.join(gamedir, 'reviews.zip')
-        if not os.path.exists(gamedir):
-            os.makedirs(gamedir)
-        elif os.path.exists(zipfilename):
-            print(f'skipping app {id_} {name}')
+
+def checklease(owned, id_, name):
+    # a crawl coordinated by a work queue writes the files of a game only while it holds its lease
+    if owned is not None and not owned():
+        raise LeaseLost(f'lease of {id_} {name} lost')
+
+
+def refreshgamereviews(gamedir, id_, name, baseurl, language, timeout, maxretries, pause, limiter=None, owned=None,
+                       stop=None):
+    """Downloads the reviews posted after the previous crawl of a game. Returns False if the download failed."""
+    zipfilename = os.path.join(gamedir, 'reviews.zip')
+    state = load_state(gamedir)
+    head = state['head'] if state else getheadkeys(zipfilename)
+    # new pages are downloaded in the same format of the archive, so that their keys can be compared
+    structured = state is not None and state.get('format') == 'json'
+    urltemplate = reviewsurl(baseurl, language, structured)
+    extension = 'json' if structured else 'html'
+    known = set(head)
+    seen = set()
+    duplicates = 0
+
+    print('refreshing', id_, name)
+    stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    cursor = '*'
+    pages = list()
+    newkeys = list()
+    maxError = 10
+    errorCount = 0
+    while True:
+        checkstop(stop, id_, name)
+        url = urltemplate.substitute({'id': id_, 'cursor': cursor, 'num': MAX_PER_PAGE})
+        print(len(pages), url)
+        htmlpage = download_page(url, maxretries, timeout, pause, limiter)
+
+        if htmlpage is None:
+            print('Error downloading from ' + url)
+            sleep(backoff_pause(pause, limiter) * 3)
+            errorCount += 1
+            if errorCount >= maxError:
+                # nothing is saved, the next refresh will start again from the most recent review
+                print('Max error!')
+                return False
             continue
+        htmlpage = htmlpage.decode()
+        parsed_json = json.loads(htmlpage)
+        if islastpage(htmlpage, parsed_json, structured):
+            break
+        found = trim_known(parsed_json, known)
+        dropped = drop_seen(parsed_json, seen)
+        duplicates += dropped
+        if found or dropped:
+            htmlpage = json.dumps(parsed_json)
+        keys = page_keys(parsed_json)
+        seen.update(keys)
+        metrics.inc('crawl_pages_total')
+        metrics.inc('crawl_reviews_total', len(keys))
+        metrics.inc('crawl_duplicates_total', dropped)
+        if keys:
+            pages.append((f'refresh-{stamp}-{len(pages) + 1}.{extension}', htmlpage))
+            newkeys.extend(keys)
+        if found:
+            break
+        cursor = urllib.parse.quote(parsed_json['cursor'])
+
+    print(f'{len(newkeys)} new reviews' + (f', {duplicates} duplicate reviews dropped' if duplicates else ''))
+    checklease(owned, id_, name)
+    if pages:
+        append_pages(zipfilename, pages)
+    save_state(gamedir, (newkeys + head)[:HEAD_SIZE], stamp, extension)
+    metrics.inc('crawl_games_total')
+    return True
+
+
+def checkpointgame(gamedir, archive, seen, cursor, page, head, reviews):
+    # the pages are made durable before the checkpoint that counts them, and the keys of their reviews are
+    # committed after it, so that a page downloaded again after a crash is not taken for a repeat
+    archive.sync()
+    save_checkpoint(gamedir, cursor, page, head, reviews, archive.size)
+    seen.flush()
+
+
+def notify(pages, event, id_, name, gamedir, data=None):
+    # events of the crawl of a game, for a consumer of the pages as they are downloaded (see steam-pipeline.py):
+    # existing (the archive was complete before the crawl), start (data tells if the game is resumed),
+    # page (data is the name and the content of a page), failed, done
+    if pages is not None:
+        pages.put((event, id_, name, gamedir, data))
+
+
+def crawlgamereviews(dir, id_, name, language, timeout, maxretries, pause, out, baseurl, limiter=None,
+                     refresh=False, structured=False, maxreviews=-1, pages=None, owned=None, stop=None):
+    """Downloads the reviews of a game into its reviews.zip.
+
+    Returns True when the game is complete (or skipped), False when the
+    download failed and the game has to be crawled again. owned tells
+    whether the crawler still holds the lease of the game: it is checked
+    before writing every page, and LeaseLost is raised when it is gone.
+    stop is an Event checked before requesting every page: once it is set
+    CrawlStopped is raised, and the game is left to its checkpoint.
+    """
+    urltemplate = reviewsurl(baseurl, language, structured)
+    extension = 'json' if structured else 'html'
 
-        print(dir, id_, name)
+    if dir == 'bundle':
+        print(f'skipping bundle {id_} {name}')
+        return True
+    if type(id_) is not str:
+        id_ = str(id_)
 
+    gamedir = os.path.join(out, 'pages', 'reviews', language, '-'.join((dir, id_)))
+
+    zipfilename = os.path.join(gamedir, 'reviews.zip')
+    if not os.path.exists(gamedir):
+        os.makedirs(gamedir, exist_ok=True)
+    elif os.path.exists(zipfilename):
+        if restore_tail(zipfilename):
+            print(f'interrupted refresh of {id_} {name} undone')
+        if refresh:
+            return refreshgamereviews(gamedir, id_, name, baseurl, language, timeout, maxretries, pause, limiter,
+                                      owned, stop)
+        print(f'skipping app {id_} {name}')
+        notify(pages, 'existing', id_, name, gamedir)
+        return True
+
+    print(dir, id_, name)
+    if isinstance(limiter, AdaptiveRateLimiter):
+        print(f'current rate {limiter.rate:.2f} requests/s')
+
+    checkpoint = load_checkpoint(gamedir)
+    resumed = checkpoint is not None and os.path.exists(zipfilename + '.part')
+    if resumed:
+        archive = PageArchive(zipfilename, checkpoint['size'])
+        cursor = checkpoint['cursor']
+        page = checkpoint['page']
+        head = checkpoint.get('head', [])
+        offset = checkpoint.get('reviews', 0)
+        print(f'resuming from page {page}')
+    else:
         cursor = '*'
-        offset = 0
         page = 1
-        maxError = 10
-        errorCount = 0
-        while True:
-            url = urltemplate.substitute({'id': id_, 'cursor': cursor})
+        head = []
+        offset = 0
+        archive = PageArchive(zipfilename)
+        if os.path.exists(os.path.join(gamedir, SEEN_FILE)):
+            os.remove(os.path.join(gamedir, SEEN_FILE))
+    notify(pages, 'start', id_, name, gamedir, resumed)
+    # pages saved as separate files by the versions before checkpoints, by a crawl that did not complete
+    for file in os.listdir(gamedir):
+        if pagere.match(file):
+            os.remove(os.path.join(gamedir, file))
+    # the keys of the pages in the archive, saved with the checkpoint so that a resumed crawl keeps dropping repeats
+    seen = SeenKeys(os.path.join(gamedir, SEEN_FILE))
+    duplicates = 0
+
+    # pages are added to the archive as soon as they are downloaded, the checkpoint marks how much of
+    # the archive is complete
+    unsaved = 0
+    maxError = 10
+    errorCount = 0
+    try:
+        while maxreviews < 0 or offset < maxreviews:
+            checkstop(stop, id_, name)
+            num = MAX_PER_PAGE if maxreviews < 0 else min(MAX_PER_PAGE, maxreviews - offset)
+            url = urltemplate.substitute({'id': id_, 'cursor': cursor, 'num': num})
             print(offset, url)
-            htmlpage = download_page(url, maxretries, timeout, pause)
+            htmlpage = download_page(url, maxretries, timeout, pause, limiter)
 
             if htmlpage is None:
                 print('Error downloading from ' + url)
-                sleep(pause * 3)
+                sleep(backoff_pause(pause, limiter) * 3)
                 errorCount += 1
                 if errorCount >= maxError:
+                    # the checkpoint is kept, the next run will continue from the last cursor
                     print('Max error!')
-                    break
+                    checklease(owned, id_, name)
+                    checkpointgame(gamedir, archive, seen, cursor, page, head, offset)
+                    archive.abort()
+                    seen.close()
+                    notify(pages, 'failed', id_, name, gamedir)
+                    return False
             else:
-                with open(os.path.join(gamedir, f'reviews-{page}.html'), 'w', encoding='utf-8') as f:
-                    htmlpage = htmlpage.decode()
-                    if endre.search(htmlpage):
-                        break
-                    f.write(htmlpage)
+                checklease(owned, id_, name)
+                htmlpage = htmlpage.decode()
+                parsed_json = json.loads(htmlpage)
+                if islastpage(htmlpage, parsed_json, structured):
+                    break
+                # when new reviews are posted during the crawl the cursor paging repeats some reviews
+                dropped = drop_seen(parsed_json, seen)
+                duplicates += dropped
+                # html pages have a fixed number of reviews, the one that reaches maxreviews is cut
+                trimmed = trim_page(parsed_json, maxreviews - offset) if maxreviews >= 0 else 0
+                if dropped or trimmed:
+                    htmlpage = json.dumps(parsed_json)
+                metrics.inc('crawl_pages_total')
+                metrics.inc('crawl_reviews_total', page_size(parsed_json))
+                metrics.inc('crawl_duplicates_total', dropped)
+                page_file = f'reviews-{page}.{extension}' if page_size(parsed_json) else None
+                if page_file:
+                    archive.write(page_file, htmlpage)
                     page = page + 1
-                    parsed_json = (json.loads(htmlpage))
-                    cursor = urllib.parse.quote(parsed_json['cursor'])
+                offset += page_size(parsed_json)
+                cursor = urllib.parse.quote(parsed_json['cursor'])
+                if len(head) < HEAD_SIZE:
+                    head.extend(page_keys(parsed_json)[:HEAD_SIZE - len(head)])
+                seen.update(page_keys(parsed_json))
+                unsaved += 1
+                if unsaved >= CHECKPOINT_PAGES:
+                    checkpointgame(gamedir, archive, seen, cursor, page, head, offset)
+                    unsaved = 0
+                if page_file:
+                    notify(pages, 'page', id_, name, gamedir, (page_file, htmlpage))
+        checklease(owned, id_, name)
+    except LeaseLost:
+        # another crawler may be writing the files of the game, nothing more is written to them
+        archive.detach()
+        seen.discard()
+        seen.close()
+        raise
+    except CrawlStopped:
+        # stopped between two pages, the pages downloaded so far are kept
+        checkpointgame(gamedir, archive, seen, cursor, page, head, offset)
+        archive.abort()
+        seen.close()
+        raise
+    except BaseException:
+        # the crawl resumes from the last checkpoint, the keys of the pages after it are not saved
+        archive.abort()
+        seen.discard()
+        seen.close()
+        raise
+
+    archive.close()
+    save_state(gamedir, head, datetime.datetime.now().strftime('%Y%m%d%H%M%S'), extension)
+    clear_checkpoint(gamedir)
+    seen.delete()
+    metrics.inc('crawl_games_total')
+    notify(pages, 'done', id_, name, gamedir)
+    if duplicates:
+        print(f'{duplicates} duplicate reviews dropped from {id_} {name}')
+    return True
+
 
-        # put all the html files that are in the gamedir in a zip file called reviews.zip
-        # then remove the html files
-        with zipfile.ZipFile(zipfilename, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(gamedir):
-                for file in files:
-                    if file.endswith('.html'):
-                        fullpath = os.path.join(root, file)
-                        zipf.write(fullpath, os.path.relpath(fullpath, gamedir))
-                        os.remove(fullpath)
+def crawlqueuedgames(queue, stop, *args):
+    # worker of a crawl coordinated by a work queue, args are those of crawlgamereviews after the game;
+    # no more games are leased once stop is set
+    while not stop.is_set():
+        game = queue.lease()
+        if game is None:
+            if queue.counts()[LEASED] == 0:
+                return
+            # the games left are leased by other crawlers, they are taken over if their leases expire
+            stop.wait(min(QUEUE_POLL, queue.lease_time / 3))
+            continue
+        dir, id_, name = game
+        try:
+            complete = crawlgamereviews(dir, id_, name, *args, owned=lambda: queue.owns(dir, id_), stop=stop)
+        except LeaseLost as e:
+            # the game is left to the crawler that leased it after this one
+            print(e)
+            continue
+        except CrawlStopped:
+            # the game is resumed from its checkpoint by the next crawler that leases it
+            queue.release(dir, id_)
+            return
+        except BaseException:
+            queue.release(dir, id_)
+            raise
+        if complete:
+            queue.done(dir, id_)
+        else:
+            # the game is given back to the queue and resumed from its checkpoint, up to the max attempts
+            queue.fail(dir, id_)
+
+
+def getgamereviews(ids, language, timeout, maxretries, pause, out, baseurl='http://store.steampowered.com',
+                   workers=1, rate=None, maxinflight=None, adaptive=False, maxrate=None, refresh=False,
+                   structured=False, maxreviews=-1, queue=None, pages=None):
+    limiter, pause = make_limiter(workers, pause, rate, maxinflight, adaptive, maxrate)
+
+    if queue is not None:
+        # games are crawled by all the crawlers sharing the queue, each game by only one of them
+        queue.add(ids)
+        queue.start_heartbeat()
+        stop = threading.Event()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(crawlqueuedgames, queue, stop, language, timeout, maxretries, pause, out,
+                                           baseurl, limiter, refresh, structured, maxreviews, pages)
+                           for _ in range(max(workers, 1))]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # on an error or an interrupt the workers stop at the next page of their current game
+                    stop.set()
+                    raise
+        finally:
+            queue.stop_heartbeat()
+        print('queue: ' + ', '.join(f'{count} {state}' for state, count in queue.counts().items()))
+    elif workers <= 1:
+        for (dir, id_, name) in ids:
+            crawlgamereviews(dir, id_, name, language, timeout, maxretries, pause, out, baseurl, limiter, refresh,
+                             structured, maxreviews, pages)
+    else:
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(crawlgamereviews, dir, id_, name, language, timeout, maxretries, pause, out,
+                                       baseurl, limiter, refresh, structured, maxreviews, pages, stop=stop)
+                       for (dir, id_, name) in ids]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # on an error or an interrupt the games not started yet are dropped, and the running ones stop at
+                # their next page, so that the executor does not wait for whole games
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+
+    if adaptive:
+        print(f'final rate {limiter.rate:.2f} requests/s, {limiter.throttled} throttled requests')
 
 
 def main():
@@ -133,16 +447,50 @@ def main():
         '-o', '--out', help='Output base path', required=False, default='data')
     parser.add_argument(
         '-i', '--ids', help='File with game ids', required=False, default='./data/games.csv')
+    parser.add_argument(
+        '--title', help='Crawl only games whose title matches the given regular expression', required=False)
+    parser.add_argument(
+        '-b', '--baseurl', help='Base url of the Steam store. Default: http://store.steampowered.com',
+        required=False, default='http://store.steampowered.com')
+    parser.add_argument(
+        '-w', '--workers', help='Number of games crawled in parallel. Default: 1', required=False, type=int,
+        default=1)
+    add_limiter_arguments(parser)
+    parser.add_argument(
+        '-u', '--refresh', help='Download only the new reviews of the games already downloaded', required=False,
+        action='store_true')
+    parser.add_argument(
+        '-j', '--json', help='Download reviews in the structured json format of the Steam API, 100 per request. '
+                             'Usernames are steam ids and texts keep their BBCode markup, see the README',
+        required=False, action='store_true')
+    parser.add_argument(
+        '-q', '--queue', help='Work queue file (sqlite) shared by crawlers running on several processes or nodes '
+                              'with the same output path: each game is crawled by only one of them', required=False)
+    parser.add_argument(
+        '--lease', help=f'Seconds after which a game leased from the queue by a crawler that stopped responding is '
+                        f'given to another crawler. Default: {LEASE_TIME}', required=False, type=float,
+        default=LEASE_TIME)
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
     if not os.path.exists(args.out):
         os.makedirs(args.out)
 
-    ids = getgameids(args.ids)
+    ids = getgameids(args.ids, args.title)
 
     print(f'{len(ids)} games')
 
-    getgamereviews(ids, args.language, args.timeout, args.maxretries, args.pause, args.out)
+    if args.metrics:
+        metrics.start_export(args.metrics, args.metricsinterval)
+    queue = WorkQueue(args.queue, lease=args.lease) if args.queue else None
+    getgamereviews(ids, args.language, args.timeout, args.maxretries, args.pause, args.out, args.baseurl,
+                   args.workers, args.rate, args.maxinflight, args.adaptive, args.maxrate, args.refresh, args.json,
+                   args.maxreviews, queue)
+    if queue is not None:
+        queue.close()
+    metrics.stop_export()
+    print_stats()
+    print(metrics.summary())
 
 
 if __name__ == '__main__':
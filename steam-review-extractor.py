@@ -17,116 +17,304 @@
 
 import argparse
 import csv
-import datetime
+import gzip
 import json
+import multiprocessing
 import os
 import re
+import shutil
 import sys
+import tempfile
 import zipfile
+from collections import Counter
+from itertools import islice
 
-import pandas as pd
-from bs4 import BeautifulSoup
 from tqdm import tqdm
 
+from steam_catalog import GameCatalog
+from steam_checkpoint import atomic_write_json
+from steam_columnar import clear_dataset, partition_source, require_pyarrow, write_game_parquet
+from steam_dedup import SeenKeys
+from steam_index import ReviewIndex
+from steam_reviewparse import PARSERS, html_reviews, structured_review_row
+from steam_telemetry import STAGE_SECONDS, add_metrics_arguments, metrics
 
-def extract_reviews(basepath, outputfile_name, games_df, title_pattern):
-    helpfulre = re.compile(r'([0-9]+) [a-z]+? found this review helpful')
-    funnyre = re.compile(r'([0-9]+) [a-z]+? found this review funny')
-    ownedre = re.compile(r'([0-9]+) product')
-    revre = re.compile(r'([0-9]+) review')
-    timere = re.compile(r'([0-9.]+) hrs on record')
-    postedre = re.compile(r'Posted: (.+)')
-    idre = re.compile(r'app-([0-9]+)$')
-    yearre = re.compile(r'.* [0-9][0-9][0-9][0-9]$')
-    userre = re.compile(r'/(profiles|id)/(.+?)/')
-    title_re = re.compile(title_pattern) if title_pattern else None
+
+idre = re.compile(r'app-([0-9]+)$')
+
+COLUMNS = ['game_id', 'game_title', 'review_helpful', 'review_funny', 'username', 'games_owned', 'reviews_written',
+           'recommended', 'time_played', 'review_date', 'review_text']
+
+USERNAME = COLUMNS.index('username')
+
+# rows are timed in batches, a timer per row costs a good part of the time of the cheapest stages
+BATCH_ROWS = 1000
+
+# the extracted rows of a game are cached next to its reviews.zip, without game id and title
+CACHE_ROWS = 'extracted.csv.gz'
+CACHE_META = 'extracted.json'
+# changes when the rows extracted from the same archive change
+CACHE_VERSION = 2
+
+
+def page_reviews(file, data, parser='bs4'):
+    """Yields the key and the values of the fields of the reviews in a page saved by the crawler.
+
+    Pages are in the html or json format. The key identifies the review: it
+    is the recommendationid of reviews in json pages, None for html pages,
+    whose reviews are identified by their username (see unique_reviews).
+    """
+    try:
+        with metrics.timer(STAGE_SECONDS, stage='json'):
+            page = json.loads(data)
+    except ValueError:
+        return
+    if file.endswith('.json'):
+        # structured pages need no html parsing
+        with metrics.timer(STAGE_SECONDS, stage='fields'):
+            rows = [(review_id(review), structured_review_row(review)) for review in page['reviews']]
+        yield from rows
+        return
+    # parse the HTML content
+    for row in html_reviews(page['html'], parser):
+        yield None, row
+
+
+def review_id(review):
+    if 'recommendationid' in review:
+        return str(review['recommendationid'])
+    return None
+
+
+def game_reviews(root, game_id, game_title, progress=True, parser='bs4'):
+    """Yields the key (see page_reviews) and the csv row of the reviews in the reviews.zip of a game directory."""
+    # open reviews.zip file if it exists
+    zipfile_path = os.path.join(root, 'reviews.zip')
+    if not os.path.exists(zipfile_path):
+        return
+    # read the content of each page file in the zip
+    with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
+        files = [f for f in zip_ref.namelist() if f.endswith('.html') or f.endswith('.json')]
+        for file in tqdm(files, leave=False, disable=not progress):
+            with metrics.timer(STAGE_SECONDS, stage='zip'):
+                data = zip_ref.read(file)
+            for key, row in page_reviews(file, data, parser):
+                yield key, (game_id, game_title) + row
+
+
+def batches(rows, size=BATCH_ROWS):
+    # the rows are taken from the previous stages before the timer of a batch starts
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def unique_key(key, row):
+    # a user writes at most one review of a game, the username identifies the reviews of html pages;
+    # anonymous reviews of html pages cannot be told apart and have no key
+    if key is not None:
+        return key
+    username = str(row[USERNAME])
+    return username if username != '__anon__' else None
+
+
+def unique_reviews(keyed_rows, counts, seen=None):
+    # rows of a game with the same key (see page_reviews) come from overlapping pages or pages downloaded again.
+    # The rows of a game that arrive in parts share the keys in seen, that is then closed by the caller
+    keys = SeenKeys() if seen is None else seen
+    try:
+        for batch in batches(keyed_rows):
+            unique = list()
+            with metrics.timer(STAGE_SECONDS, stage='dedup'):
+                for key, row in batch:
+                    key = unique_key(key, row)
+                    if key is None or keys.add(key):
+                        unique.append(row)
+            counts['duplicates'] += len(batch) - len(unique)
+            yield from unique
+    finally:
+        if seen is None:
+            keys.close()
+
+
+def walk_games(basepath, game_ids):
+    # when only some games are processed, the directories of the other games are not even listed
+    for root, dirs, files in os.walk(basepath):
+        if game_ids is not None:
+            dirs[:] = [dir for dir in dirs if not idre.match(dir) or int(idre.match(dir).group(1)) in game_ids]
+        yield root, dirs, files
+
+
+def game_dirs(basepath, catalog, title_pattern):
+    game_ids = catalog.app_ids(title_pattern) if title_pattern else None
+    if game_ids is not None:
+        print(f'{len(game_ids)} games matching {title_pattern}')
+    for root, _, _ in walk_games(basepath, game_ids):
+        m = idre.search(root)
+        if m:
+            game_id = m.group(1)
+            if game_ids is not None and int(game_id) not in game_ids:
+                print(f'skipping not matching game {game_id}')
+                continue
+            game_title = catalog.title(game_id)
+            if game_title is None:
+                print('skipping unknown game ', root, file=sys.stderr)
+                continue
+        else:
+            print('skipping non-game path ', root, file=sys.stderr)
+            continue
+        yield root, game_id, game_title
+
+
+def archive_signature(root):
+    try:
+        stat = os.stat(os.path.join(root, 'reviews.zip'))
+    except FileNotFoundError:
+        return None
+    return f'{CACHE_VERSION}-{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def load_cache_meta(root):
+    try:
+        with open(os.path.join(root, CACHE_META), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cached_reviews(root, game_id, game_title, progress, parser, signature, force=False):
+    """Yields the unique rows of the reviews of a game, parsing its reviews.zip only if it changed.
+
+    The rows parsed from an archive are saved in the game directory, with
+    the signature (size and mtime) of the archive. When the signature has
+    not changed, the rows are read back from there.
+    """
+    rowspath = os.path.join(root, CACHE_ROWS)
+    meta = load_cache_meta(root)
+    if not force and meta is not None and meta.get('signature') == signature and os.path.exists(rowspath):
+        metrics.inc('extract_games_total', source='cache')
+        metrics.inc('extract_duplicates_total', meta.get('duplicates', 0))
+        with gzip.open(rowspath, mode='rt', encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            while True:
+                with metrics.timer(STAGE_SECONDS, stage='cache'):
+                    batch = [(game_id, game_title) + tuple(row) for row in islice(reader, BATCH_ROWS)]
+                if not batch:
+                    break
+                yield from batch
+        return
+
+    metrics.inc('extract_games_total', source='archive')
+    game_counts = Counter()
+    rows = unique_reviews(game_reviews(root, game_id, game_title, progress, parser), game_counts)
+    try:
+        f = gzip.open(rowspath + '.tmp', mode='wt', encoding='utf-8', newline='', compresslevel=6)
+    except OSError:
+        # a read only archive, rows are not cached
+        yield from rows
+        metrics.inc('extract_duplicates_total', game_counts['duplicates'])
+        return
+    with f:
+        writer = csv.writer(f)
+        for batch in batches(rows):
+            with metrics.timer(STAGE_SECONDS, stage='cache'):
+                writer.writerows(row[2:] for row in batch)
+            yield from batch
+    # the rows are replaced before the signature, an interruption in between makes the next run parse again
+    os.replace(rowspath + '.tmp', rowspath)
+    atomic_write_json(os.path.join(root, CACHE_META), {'signature': signature,
+                                                       'duplicates': game_counts['duplicates']})
+    metrics.inc('extract_duplicates_total', game_counts['duplicates'])
+
+
+def write_game(writer, root, game_id, game_title, progress, parser, dataset, force=False, index=None):
+    signature = archive_signature(root)
+    if signature is None:
+        return
+    rows = tee_rows(writer, cached_reviews(root, game_id, game_title, progress, parser, signature, force))
+    # rows go to the csv and, when a parquet dataset or a query index are written, to the game's partition and
+    # reviews in the index in the same pass; those written from the same archive and with the same title are kept
+    source = f'{signature} {game_title}'
+    if index is not None and index.source(game_id) != source:
+        rows = index.tee(game_id, rows, source)
+    if dataset is None or partition_source(dataset, game_id) == source:
+        for _ in rows:
+            pass
+        return
+    write_game_parquet(dataset, game_id, rows, source=source)
+
+
+def tee_rows(writer, rows):
+    count = 0
+    for batch in batches(rows):
+        with metrics.timer(STAGE_SECONDS, stage='csv'):
+            writer.writerows(batch)
+        count += len(batch)
+        yield from batch
+    metrics.inc('extract_reviews_total', count)
+
+
+def write_game_reviews(task):
+    # worker of the parallel extraction: the rows of a game are spilled to a file in tmpdir,
+    # so that neither the worker nor the main process keep them in memory
+    position, root, game_id, game_title, tmpdir, parser, dataset, force = task
+    path = os.path.join(tmpdir, f'{position}.csv')
+    # the metrics of each game are sent back to the main process, that sums them
+    metrics.reset()
+    with open(path, mode="w", encoding="utf-8", newline="") as f:
+        write_game(csv.writer(f), root, game_id, game_title, False, parser, dataset, force)
+    return path, metrics.snapshot()
+
+
+def extract_reviews(basepath, outputfile_name, catalog, title_pattern, workers=1, parser='bs4', dataset=None,
+                    force=False, index=None):
+    if dataset is not None:
+        require_pyarrow()
+    games = list(game_dirs(basepath, catalog, title_pattern))
     with open(outputfile_name, mode="w", encoding="utf-8", newline="") as outputfile:
         writer = csv.writer(outputfile)
-        writer.writerow(
-            ['game_id', 'game_title', 'review_helpful', 'review_funny', 'username', 'games_owned', 'reviews_written',
-             'recommended', 'time_played', 'review_date', 'review_text'])
-        for root, _, _ in tqdm(list(os.walk(basepath))):
-            m = idre.search(root)
-            if m:
-                game_id = m.group(1)
-                game_title = games_df[(games_df['game_id'] == int(game_id)) & (games_df['package_type'] == 'app')][
-                    'game_title'].values[0]
-                if title_re and not title_re.search(str(game_title)):
-                    print(f'skipping not matching game {game_id} {game_title}')
-                    continue
-            else:
-                print('skipping non-game path ', root, file=sys.stderr)
-                continue
-            # open reviews.zip file if it exists
-            zipfile_path = os.path.join(root, 'reviews.zip')
-            if os.path.exists(zipfile_path):
-                # read the content of each html file in the zip
-                with zipfile.ZipFile(zipfile_path, 'r') as zip_ref:
-                    files = [f for f in zip_ref.namelist() if f.endswith('.html')]
-                    for file in tqdm(files, leave=False):
-                        with zip_ref.open(file) as f:
-                            # parse the HTML content
-                            try:
-                                soup = BeautifulSoup(json.loads(f.read())['html'], "html.parser")
-                            except ValueError:
-                                continue
-                            for reviewdiv in soup.find_all('div', attrs={'class': 'review_box'}):
-                                helpful = 0
-                                funny = 0
-                                elem = reviewdiv.find('div', attrs={'class': 'vote_info'})
-                                if elem:
-                                    m = helpfulre.search(elem.text)
-                                    if m:
-                                        helpful = m.group(1)
-                                    m = funnyre.search(elem.text)
-                                    if m:
-                                        funny = m.group(1)
-                                username = '__anon__'
-                                elem = reviewdiv.find('div', attrs={'class': 'persona_name'})
-                                if elem:
-                                    m = userre.search(str(elem.contents))
-                                    if m:
-                                        username = m.group(2)
-                                owned = 0
-                                elem = reviewdiv.find('div', attrs={'class': 'num_owned_games'})
-                                if elem:
-                                    m = ownedre.search(elem.text)
-                                    if m:
-                                        owned = m.group(1)
-                                numrev = 0
-                                elem = reviewdiv.find('div', attrs={'class': 'num_reviews'})
-                                if elem:
-                                    m = revre.search(elem.text)
-                                    if m:
-                                        numrev = m.group(1)
-                                recco = 0
-                                elem = reviewdiv.find('div', attrs={'class': 'title ellipsis'})
-                                if elem:
-                                    if elem.text == 'Recommended':
-                                        recco = 1
-                                    else:
-                                        recco = -1
-                                time = 0
-                                elem = reviewdiv.find('div', attrs={'class': 'hours ellipsis'})
-                                if elem:
-                                    m = timere.search(elem.text)
-                                    if m:
-                                        time = m.group(1)
-                                posted = 0
-                                elem = reviewdiv.find('div', attrs={'class': 'postedDate'})
-                                if elem:
-                                    m = postedre.search(elem.text)
-                                    if m:
-                                        posted = m.group(1).strip()
-                                        if not yearre.match(posted):
-                                            posted = posted + f", {datetime.date.today().year}"
-                                content = ''
-                                elem = reviewdiv.find('div', attrs={'class': 'content'})
-                                if elem:
-                                    content = elem.text.strip()
-                                writer.writerow(
-                                    (game_id, game_title, helpful, funny, username, owned, numrev, recco, time, posted,
-                                     content))
+        writer.writerow(COLUMNS)
+        if workers <= 1:
+            for root, game_id, game_title in tqdm(games):
+                write_game(writer, root, game_id, game_title, True, parser, dataset, force, index)
+        else:
+            extract_reviews_parallel(outputfile, games, workers, parser, dataset, force, index)
+    # a full extraction removes the games of previous extractions, a selection of games replaces only those games
+    if dataset is not None and not title_pattern:
+        clear_dataset(dataset, keep=[game_id for _, game_id, _ in games])
+    if index is not None and not title_pattern:
+        index.remove_games(keep=[game_id for _, game_id, _ in games])
+    print(f'{metrics.counter("extract_games_total", source="archive")} games parsed, '
+          f'{metrics.counter("extract_games_total", source="cache")} games from the extraction cache, '
+          f'{metrics.counter("extract_duplicates_total")} duplicate reviews dropped')
+
+
+def extract_reviews_parallel(outputfile, games, workers, parser, dataset, force=False, index=None):
+    # games are processed in parallel, and their rows are appended to the output in the same order
+    # of the serial extraction, as soon as all the preceding games are done
+    outputfile.flush()
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outputfile.name)))
+    try:
+        tasks = ((position, root, game_id, game_title, tmpdir, parser, dataset, force)
+                 for position, (root, game_id, game_title) in enumerate(games))
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.imap(write_game_reviews, tasks)
+            for (root, game_id, game_title), (path, game_metrics) in tqdm(zip(games, results), total=len(games)):
+                with open(path, mode="r", encoding="utf-8", newline="") as f:
+                    shutil.copyfileobj(f, outputfile)
+                # the index has a single writer, the main process, that reads the rows back from the spilled file
+                signature = archive_signature(root)
+                source = f'{signature} {game_title}'
+                if index is not None and signature is not None and index.source(game_id) != source:
+                    with open(path, mode="r", encoding="utf-8", newline="") as f:
+                        index.add_reviews(game_id, csv.reader(f), source)
+                os.remove(path)
+                metrics.merge(game_metrics)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
 
 def main():
@@ -141,10 +329,38 @@ def main():
         '-o', '--output', help='Output file', default='./data/reviews.csv', required=False)
     parser.add_argument(
         '-t', '--title', help='Process only games whose title matches the given regular expression', required=False)
+    parser.add_argument(
+        '-w', '--workers', help='Number of processes extracting reviews in parallel. Default: 1', required=False,
+        type=int, default=1)
+    parser.add_argument(
+        '-p', '--parser', help='Parser of the html of reviews: bs4 is the reference BeautifulSoup parser, fast is a '
+                               'single pass parser with the same output. Default: bs4',
+        required=False, choices=sorted(PARSERS), default='bs4')
+    parser.add_argument(
+        '-q', '--parquet', help='Also write the reviews, with typed columns, into a parquet dataset in the given '
+                                'directory, partitioned by game (requires pyarrow)', required=False)
+    parser.add_argument(
+        '-x', '--index', help='Also add the reviews to a sqlite query index in the given file, see '
+                              'steam-review-index.py', required=False)
+    parser.add_argument(
+        '--fts', help='Also index the text of the reviews for full text search in the query index',
+        required=False, action='store_true')
+    parser.add_argument(
+        '-f', '--force', help='Parse all the archives again, ignoring the rows cached by previous extractions',
+        required=False, action='store_true')
+    add_metrics_arguments(parser)
     args = parser.parse_args()
 
-    games_df = pd.read_csv(args.games)
-    extract_reviews(args.input, args.output, games_df, args.title)
+    if args.metrics:
+        metrics.start_export(args.metrics, args.metricsinterval)
+    catalog = GameCatalog(args.games)
+    index = ReviewIndex(args.index, args.fts) if args.index else None
+    extract_reviews(args.input, args.output, catalog, args.title, args.workers, args.parser, args.parquet,
+                    args.force, index)
+    if index is not None:
+        index.close()
+    metrics.stop_export()
+    print(metrics.summary())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import csv
+import itertools
+import sys
+from time import perf_counter
+
+from tqdm import tqdm
+
+from steam_index import COLUMNS, ReviewIndex
+
+
+def build_index(index, inputfile_name):
+    """Indexes all the reviews in reviews.csv, replacing those of the same games and removing the other games."""
+    csv.field_size_limit(sys.maxsize)
+    games = set()
+    with open(inputfile_name, mode='r', encoding='utf-8', newline='') as inputfile:
+        reader = csv.reader(inputfile)
+        next(reader)
+        # the rows of a game are usually contiguous, a game found again is added to its previous rows
+        for game_id, rows in itertools.groupby(tqdm(reader), key=lambda row: row[0]):
+            index.add_reviews(game_id, rows, replace=game_id not in games)
+            games.add(game_id)
+    removed = index.remove_games(keep=games)
+    print(f'{len(games)} games indexed, {removed} games removed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query index of Steam reviews')
+    parser.add_argument(
+        '-x', '--index', help='Index file', required=False, default='./data/reviews.sqlite')
+    parser.add_argument(
+        '-i', '--input', help='Build the index from the given reviews file, instead of querying it', required=False)
+    parser.add_argument(
+        '--fts', help='Also index the text of the reviews for full text search', required=False,
+        action='store_true')
+    parser.add_argument(
+        '-g', '--game', help='Reviews of the game with the given id', required=False, type=int)
+    parser.add_argument(
+        '-u', '--user', help='Reviews written by the given username', required=False)
+    parser.add_argument(
+        '-s', '--since', help='Reviews posted on the given date (YYYY-MM-DD) or later', required=False)
+    parser.add_argument(
+        '-e', '--until', help='Reviews posted on the given date (YYYY-MM-DD) or earlier', required=False)
+    parser.add_argument(
+        '-q', '--query', help='Reviews whose text matches the given full text query (FTS5 syntax, requires an '
+                              'index built with --fts)', required=False)
+    parser.add_argument(
+        '-l', '--limit', help='Maximum number of reviews returned', required=False, type=int)
+    parser.add_argument(
+        '-c', '--count', help='Print the number of matching reviews instead of the reviews', required=False,
+        action='store_true')
+    parser.add_argument(
+        '-o', '--output', help='Output file of the matching reviews. Default: standard output', required=False)
+    args = parser.parse_args()
+
+    index = ReviewIndex(args.index, args.fts)
+    if args.query and not index.fts:
+        parser.error('the index has no full text index of the reviews, build it with --fts')
+    if args.input:
+        build_index(index, args.input)
+        index.close()
+        return
+
+    filters = {'game_id': args.game, 'username': args.user, 'since': args.since, 'until': args.until,
+               'text': args.query}
+    start = perf_counter()
+    if args.count:
+        print(index.count(**filters))
+    else:
+        outputfile = open(args.output, mode='w', encoding='utf-8', newline='') if args.output else sys.stdout
+        writer = csv.writer(outputfile)
+        writer.writerow(COLUMNS)
+        writer.writerows(index.reviews(limit=args.limit, **filters))
+        if args.output:
+            outputfile.close()
+    print(f'query done in {1000 * (perf_counter() - start):.1f} ms', file=sys.stderr)
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
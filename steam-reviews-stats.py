@@ -16,56 +16,52 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-import json
-from collections import defaultdict
+import os
 
-import pandas as pd
 from tqdm import tqdm
 
+from steam_catalog import GameCatalog
+from steam_stats import CHUNK_SIZE, STATS_DB, ReviewStats, StatsAggregates, read_chunks
 
-def process_reviews(inputfile_name, output_dir):
-    with open(inputfile_name, mode="r", encoding="utf-8") as inputfile:
-        input_df = pd.read_csv(inputfile)
-        totalreviews = len(input_df)
-        totalhours = input_df['time_played'].astype(float).sum()
-        users = defaultdict(lambda: defaultdict(float))
-        games = defaultdict(lambda: defaultdict(float))
-        for _, row in tqdm(input_df.iterrows(), total=totalreviews):
-            username = row['username']
-            game_id = row['game_id']
-            time = float(row['time_played'])
-            users[username]['games'] += 1
-            users[username]['time_played'] += time
-            games[game_id]['users'] += 1
-            games[game_id]['title'] = row['game_title']
-            games[game_id]['reviews'] += 1
-            if row['recommended'] == 1:
-                games[game_id]['recommended'] += 1
-            else:
-                games[game_id]['not_recommended'] += 1
-            games[game_id]['time_played'] += time
 
-        summary = {'reviews': totalreviews,
-                   'hours': totalhours,
-                   'users': len(users),
-                   'games': len(games)}
-        with open(output_dir + '/summary.json', mode='w', encoding="utf-8") as f:
-            json.dump(summary, f, indent=4)
-        with open(output_dir + '/users.json', mode='w', encoding="utf-8") as f:
-            json.dump(users, f, indent=4)
-        with open(output_dir + '/games.json', mode='w', encoding="utf-8") as f:
-            json.dump(games, f, indent=4)
+def process_reviews(inputfile_name, output_dir, game_ids=None, chunksize=CHUNK_SIZE):
+    if os.path.isdir(inputfile_name):
+        # a parquet dataset written by steam-review-extractor.py --parquet, only the changed games are read
+        aggregates = StatsAggregates(os.path.join(inputfile_name, STATS_DB))
+        updated, removed = aggregates.update(inputfile_name)
+        print(f'{updated} games updated, {removed} games removed')
+        aggregates.select(game_ids)
+        aggregates.write(output_dir)
+        aggregates.close()
+        return
+    stats = ReviewStats()
+    with tqdm(unit=' reviews') as progress:
+        for chunk in read_chunks(inputfile_name, chunksize):
+            if game_ids is not None:
+                chunk = chunk[chunk['game_id'].isin(game_ids)]
+            stats.add(chunk)
+            progress.update(len(chunk))
+    stats.write(output_dir)
 
 
 def main():
     parser = argparse.ArgumentParser(description='Stats from Steam reviews')
     parser.add_argument(
-        '-i', '--input', help='Input file of reviews', required=False, default="./data/reviews.csv")
+        '-i', '--input', help='Input file of reviews, or directory of a parquet dataset of reviews', required=False,
+        default="./data/reviews.csv")
     parser.add_argument(
         '-o', '--output', help='Output dir for stats', required=False, default="./data/")
+    parser.add_argument(
+        '-g', '--games', help='Games file, used with --title', required=False, default='./data/games.csv')
+    parser.add_argument(
+        '-t', '--title', help='Process only games whose title matches the given regular expression', required=False)
+    parser.add_argument(
+        '-c', '--chunksize', help=f'Number of reviews read and aggregated at a time. Default: {CHUNK_SIZE}',
+        required=False, type=int, default=CHUNK_SIZE)
     args = parser.parse_args()
 
-    process_reviews(args.input, args.output)
+    game_ids = GameCatalog(args.games).app_ids(args.title) if args.title else None
+    process_reviews(args.input, args.output, game_ids, args.chunksize)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import struct
+import zipfile
+
+from steam_checkpoint import atomic_write
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_SIGNATURE = b'PK\x03\x04'
+
+# offset of the central directory saved before the central directory itself in the tail file of an append
+TAIL_OFFSET = struct.Struct('<Q')
+
+
+def scan_entries(fp, size):
+    """Returns the ZipInfo of the entries found in the first size bytes of a zip without central directory.
+
+    Entries must have been written on a seekable file, so that sizes and crc
+    are in their local headers.
+    """
+    entries = list()
+    offset = 0
+    while offset + LOCAL_HEADER.size <= size:
+        fp.seek(offset)
+        (signature, _, flag_bits, compress_type, dostime, dosdate, crc, compress_size, file_size, name_length,
+         extra_length) = LOCAL_HEADER.unpack(fp.read(LOCAL_HEADER.size))
+        if signature != LOCAL_SIGNATURE:
+            break
+        end = offset + LOCAL_HEADER.size + name_length + extra_length + compress_size
+        if end > size:
+            break
+        name = fp.read(name_length).decode('utf-8' if flag_bits & 0x800 else 'cp437')
+        info = zipfile.ZipInfo(name, ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF, dosdate & 0x1F,
+                                      dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2))
+        info.flag_bits = flag_bits
+        info.compress_type = compress_type
+        info.CRC = crc
+        info.compress_size = compress_size
+        info.file_size = file_size
+        info.header_offset = offset
+        info.external_attr = 0o600 << 16
+        entries.append(info)
+        offset = end
+    return entries, offset
+
+
+def append_pages(path, pages):
+    """Appends the (name, data) pages to the zip in path, in place.
+
+    The new entries are written over the central directory, that is saved
+    in path.tail before: until the append is complete the original archive
+    can be restored by restore_tail, whose cost, as that of the append,
+    does not depend on the size of the archive.
+    """
+    restore_tail(path)
+    tailpath = path + '.tail'
+    with open(path, 'r+b') as fp:
+        zipf = zipfile.ZipFile(fp, 'a', zipfile.ZIP_DEFLATED)
+        start = zipf.start_dir
+        fp.seek(start)
+        atomic_write(tailpath, TAIL_OFFSET.pack(start) + fp.read(), mode='wb')
+        fp.seek(start)
+        with zipf:
+            for name, data in pages:
+                zipf.writestr(name, data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.remove(tailpath)
+
+
+def restore_tail(path):
+    """Undoes an append to the zip in path interrupted by a crash, see append_pages. Returns True if it did."""
+    tailpath = path + '.tail'
+    try:
+        with open(tailpath, 'rb') as f:
+            tail = f.read()
+    except FileNotFoundError:
+        return False
+    start, = TAIL_OFFSET.unpack(tail[:TAIL_OFFSET.size])
+    with open(path, 'r+b') as fp:
+        fp.seek(start)
+        fp.write(tail[TAIL_OFFSET.size:])
+        fp.truncate()
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.remove(tailpath)
+    return True
+
+
+class PageArchive:
+    """Zip archive of the pages of a game, written while the pages are downloaded.
+
+    Pages are compressed into path.part one at a time, the central directory
+    is written only by close(), that renames the archive to path. Save size
+    after a sync(), that makes the pages written so far durable: after a
+    crash the archive is reopened passing it, the bytes following it are
+    dropped and the entries before it are recovered from their local headers.
+    """
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.partpath = path + '.part'
+        if size is None:
+            self._fp = open(self.partpath, 'w+b')
+            entries = list()
+        else:
+            self._fp = open(self.partpath, 'r+b')
+            entries, size = scan_entries(self._fp, size)
+            self._fp.truncate(size)
+            self._fp.seek(size)
+        self._zipf = zipfile.ZipFile(self._fp, 'w', zipfile.ZIP_DEFLATED)
+        for info in entries:
+            self._zipf.filelist.append(info)
+            self._zipf.NameToInfo[info.filename] = info
+
+    @property
+    def size(self):
+        return self._fp.tell()
+
+    def namelist(self):
+        return self._zipf.namelist()
+
+    def write(self, name, data):
+        self._zipf.writestr(name, data)
+
+    def sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        self._zipf.close()
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._fp.close()
+        os.replace(self.partpath, self.path)
+
+    def detach(self):
+        # closes the archive without writing anything more, when another crawler took over its file
+        self._zipf.fp = None
+        self._fp.close()
+
+    def abort(self):
+        # leaves the partial archive on disk, to be resumed
+        self._zipf.close()
+        self._fp.close()
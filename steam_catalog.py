@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import os
+import re
+import sqlite3
+import uuid
+
+
+def regexp(pattern, value, _cache={}):
+    if pattern not in _cache:
+        _cache[pattern] = re.compile(pattern)
+    return value is not None and _cache[pattern].search(value) is not None
+
+
+class GameCatalog:
+    """Games listed in games.csv, indexed in a sqlite database saved next to it.
+
+    The database is rebuilt when games.csv changes, into a new file that
+    replaces the old one when complete, so that the catalogs opened by other
+    processes meanwhile read either of them. Games are looked up by package
+    type and id, or selected by a regular expression on the title (re.search
+    semantics, as the --title options of the scripts).
+    """
+
+    def __init__(self, csvfile, dbfile=None):
+        self.csvfile = csvfile
+        self.dbfile = dbfile or os.path.splitext(csvfile)[0] + '.sqlite'
+        stat = os.stat(csvfile)
+        signature = f'{stat.st_size}-{stat.st_mtime_ns}'
+        try:
+            # lookups may come from helper threads, e.g. the task feeder of a multiprocessing pool
+            self._conn = sqlite3.connect(self.dbfile, check_same_thread=False)
+            if self._signature() != signature:
+                self._conn.close()
+                self._build(signature)
+                self._conn = sqlite3.connect(self.dbfile, check_same_thread=False)
+        except (sqlite3.OperationalError, OSError):
+            # the directory of games.csv is not writable, the index is kept in memory
+            self._conn = sqlite3.connect(':memory:', check_same_thread=False)
+            self._fill(self._conn, signature)
+        self._conn.create_function('REGEXP', 2, regexp, deterministic=True)
+
+    def _signature(self):
+        try:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def _build(self, signature):
+        # processes that rebuild the same catalog at the same time write their own files, the last one is kept
+        tmpfile = f'{self.dbfile}.{uuid.uuid4().hex[:8]}.tmp'
+        try:
+            conn = sqlite3.connect(tmpfile)
+            try:
+                self._fill(conn, signature)
+            finally:
+                conn.close()
+            os.replace(tmpfile, self.dbfile)
+        except BaseException:
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+    def _fill(self, conn, signature):
+        with conn:
+            conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE games (package_type TEXT, game_id INTEGER, game_title TEXT, '
+                         'position INTEGER, PRIMARY KEY (package_type, game_id)) WITHOUT ROWID')
+            with open(self.csvfile, encoding='utf-8', newline='') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                # the first title of a game is kept, as a lookup in the csv would find
+                conn.executemany('INSERT OR IGNORE INTO games VALUES (?, ?, ?, ?)',
+                                 ((row[0], int(row[1]), row[2], position)
+                                  for position, row in enumerate(reader) if len(row) >= 3))
+            conn.execute("INSERT INTO meta VALUES ('source', ?)", (signature,))
+
+    def title(self, game_id, package_type='app'):
+        row = self._conn.execute('SELECT game_title FROM games WHERE package_type = ? AND game_id = ?',
+                                 (package_type, int(game_id))).fetchone()
+        return row[0] if row else None
+
+    def games(self, title_pattern=None, package_type=None):
+        """Returns the (package_type, game_id, game_title) of the games, in the order of games.csv."""
+        query = 'SELECT package_type, game_id, game_title FROM games'
+        conditions = list()
+        params = list()
+        if title_pattern:
+            conditions.append('game_title REGEXP ?')
+            params.append(title_pattern)
+        if package_type:
+            conditions.append('package_type = ?')
+            params.append(package_type)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self._conn.execute(query + ' ORDER BY position', params).fetchall()
+
+    def app_ids(self, title_pattern=None):
+        return {game_id for _, game_id, _ in self.games(title_pattern, 'app')}
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM games').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
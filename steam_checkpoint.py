@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+
+CHECKPOINT_FILE = 'checkpoint.json'
+STATE_FILE = 'state.json'
+
+
+def atomic_write(path, data, mode='w', encoding='utf-8'):
+    # readers see either the old or the new content, never a partial file
+    tmppath = f'{path}.tmp'
+    with open(tmppath, mode, encoding=encoding if 'b' not in mode else None) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+def atomic_write_json(path, obj):
+    atomic_write(path, json.dumps(obj))
+
+
+def load_checkpoint(gamedir):
+    """Returns the checkpoint of a partially crawled game, None if there is none.
+
+    A checkpoint has the cursor to be requested next, the number of the next
+    page, the keys of the most recent reviews (see load_state), the number of
+    reviews downloaded and the size of the complete part of the archive of
+    the pages (see steam_archive.PageArchive).
+    """
+    path = os.path.join(gamedir, CHECKPOINT_FILE)
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(gamedir, cursor, page, head, reviews, size):
+    atomic_write_json(os.path.join(gamedir, CHECKPOINT_FILE),
+                      {'cursor': cursor, 'page': page, 'head': head, 'reviews': reviews, 'size': size})
+
+
+def clear_checkpoint(gamedir):
+    try:
+        os.remove(os.path.join(gamedir, CHECKPOINT_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def load_state(gamedir):
+    """Returns the state of a completely crawled game, None if there is none.
+
+    The state has the keys of the most recent reviews downloaded, used to
+    stop a refresh when it reaches already downloaded reviews, and the format
+    of the pages (html or json).
+    """
+    try:
+        with open(os.path.join(gamedir, STATE_FILE), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(gamedir, head, updated, format='html'):
+    atomic_write_json(os.path.join(gamedir, STATE_FILE), {'head': head, 'updated': updated, 'format': format})
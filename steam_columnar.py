@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import glob
+import os
+import shutil
+
+from steam_telemetry import STAGE_SECONDS, metrics
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# rows of a game are written in groups of this size, so that a game never needs to be fully in memory
+ROW_GROUP_SIZE = 50000
+
+PARTITION = 'game_id'
+PART_FILE = 'part-0.parquet'
+
+# formats of the review_date column of reviews.csv
+DATE_FORMATS = ['%B %d, %Y', '%d %B, %Y']
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('the parquet output requires pyarrow (pip install pyarrow)')
+
+
+def schema():
+    """Types of the columns of reviews.csv, except game_id that is the partitioning column."""
+    require_pyarrow()
+    return pa.schema([('game_title', pa.string()),
+                      ('review_helpful', pa.int64()),
+                      ('review_funny', pa.int64()),
+                      ('username', pa.string()),
+                      ('games_owned', pa.int64()),
+                      ('reviews_written', pa.int64()),
+                      ('recommended', pa.int8()),
+                      ('time_played', pa.float64()),
+                      ('review_date', pa.date32()),
+                      ('review_text', pa.string())])
+
+
+def parse_int(value):
+    try:
+        return int(str(value).replace(',', ''))
+    except ValueError:
+        return None
+
+
+def parse_float(value):
+    try:
+        return float(str(value).replace(',', ''))
+    except ValueError:
+        return None
+
+
+def parse_date(value):
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value), fmt).date()
+        except ValueError:
+            pass
+    # reviews without a posted date have 0 in reviews.csv
+    return None
+
+
+def typed_columns(rows):
+    """Converts rows with the reviews.csv layout into typed columns, dropping the game_id column."""
+    columns = [list() for _ in range(10)]
+    for row in rows:
+        (_, title, helpful, funny, username, owned, numrev, recco, time, posted, content) = row
+        columns[0].append(title)
+        columns[1].append(parse_int(helpful))
+        columns[2].append(parse_int(funny))
+        columns[3].append(username)
+        columns[4].append(parse_int(owned))
+        columns[5].append(parse_int(numrev))
+        columns[6].append(parse_int(recco))
+        columns[7].append(parse_float(time))
+        columns[8].append(parse_date(posted))
+        columns[9].append(content)
+    return columns
+
+
+def partition_dir(dataset, game_id):
+    return os.path.join(dataset, f'{PARTITION}={game_id}')
+
+
+def partitions(dataset):
+    """Returns the game_id and the file of the partitions of a parquet dataset."""
+    found = list()
+    for path in glob.glob(os.path.join(partition_dir(dataset, '*'), PART_FILE)):
+        value = os.path.basename(os.path.dirname(path))[len(PARTITION) + 1:]
+        if value.isdigit():
+            found.append((int(value), path))
+    return sorted(found)
+
+
+def clear_dataset(dataset, keep=()):
+    """Removes the game partitions, except those of the games in keep, leaving any other file in place."""
+    keep = {str(game_id) for game_id in keep}
+    for path in glob.glob(partition_dir(dataset, '*')):
+        if os.path.basename(path)[len(PARTITION) + 1:] not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def partition_source(dataset, game_id):
+    """Returns the source recorded when the partition of a game was written, None if there is no partition."""
+    require_pyarrow()
+    path = os.path.join(partition_dir(dataset, game_id), PART_FILE)
+    if not os.path.exists(path):
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    source = metadata.get(b'source')
+    return source.decode('utf-8') if source is not None else None
+
+
+def write_game_parquet(dataset, game_id, rows, row_group_size=ROW_GROUP_SIZE, source=None):
+    """Writes the rows of a game into its partition of a parquet dataset, streaming them in row groups.
+
+    The file is written under a temporary name and renamed when complete, so
+    that an interrupted extraction never leaves truncated partitions. source
+    is saved in the metadata of the file, see partition_source.
+    Returns the number of rows written.
+    """
+    require_pyarrow()
+    table_schema = schema()
+    if source is not None:
+        table_schema = table_schema.with_metadata({'source': source})
+    path = os.path.join(partition_dir(dataset, game_id), PART_FILE)
+    # hidden files are ignored when the dataset is read
+    tmppath = os.path.join(partition_dir(dataset, game_id), '.' + PART_FILE + '.tmp')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    count = 0
+    with pq.ParquetWriter(tmppath, table_schema, compression='zstd') as writer:
+        group = list()
+        for row in rows:
+            group.append(row)
+            if len(group) >= row_group_size:
+                with metrics.timer(STAGE_SECONDS, stage='parquet'):
+                    writer.write_table(pa.Table.from_arrays(typed_columns(group), schema=table_schema))
+                count += len(group)
+                group = list()
+        if group or count == 0:
+            with metrics.timer(STAGE_SECONDS, stage='parquet'):
+                writer.write_table(pa.Table.from_arrays(typed_columns(group), schema=table_schema))
+            count += len(group)
+    os.replace(tmppath, path)
+    return count
+
+
+def read_reviews(dataset, columns=None):
+    """Reads the reviews of a parquet dataset into a DataFrame, loading only the given columns."""
+    require_pyarrow()
+    table = pq.read_table(dataset, columns=columns, partitioning='hive')
+    df = table.to_pandas(date_as_object=False)
+    if PARTITION in df.columns:
+        # partition values are read as a categorical column
+        df[PARTITION] = df[PARTITION].astype('int64')
+    return df
+
+
+def read_partition(path, columns=None):
+    """Reads the reviews of a single partition file of a dataset into a DataFrame."""
+    require_pyarrow()
+    return pq.read_table(path, columns=columns).to_pandas(date_as_object=False)
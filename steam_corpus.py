@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+import os
+import shutil
+import zipfile
+
+from steam_checkpoint import atomic_write_json
+from steam_pagestore import LISTING_STORE, PageStore
+from steam_stub_server import SEARCH_PER_PAGE, appreviews_page, review_count, search_game, search_page
+
+CORPUS_META = 'corpus.json'
+# changes when the files of a corpus with the same parameters change
+CORPUS_VERSION = 2
+
+
+def write_corpus(path, games=1000, pages=10, reviews=20, structured=False):
+    """Writes the files a crawl of a stub server with the same parameters would write, without any request.
+
+    The listing pages go in the page store path/pages/listing.sqlite, the
+    games in path/games.csv and
+    the reviews.zip of every app in path/pages/reviews/all/app-N, with pages
+    in the html format or, if structured, in the json format. The corpus is
+    deterministic: the same parameters give the same files. Returns the
+    number of games, listing pages, review pages and reviews written.
+    """
+    counts = {'games': games, 'listing_pages': 0, 'review_pages': 0, 'reviews': 0}
+    os.makedirs(os.path.join(path, 'pages'), exist_ok=True)
+    store = PageStore(os.path.join(path, 'pages', LISTING_STORE))
+    for page in range(1, (games + SEARCH_PER_PAGE - 1) // SEARCH_PER_PAGE + 1):
+        store.put(f'games-page-{page}', search_page(page, games))
+        counts['listing_pages'] += 1
+    store.close()
+
+    with open(os.path.join(path, 'games.csv'), mode='w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['package_type', 'game_id', 'game_title'])
+        writer.writerows(search_game(index) for index in range(games))
+
+    extension = 'json' if structured else 'html'
+    # the crawler asks the json api for the largest pages
+    per_page = 100 if structured else reviews
+    for index in range(games):
+        package_type, game_id, _ = search_game(index)
+        if package_type != 'app':
+            continue
+        gamedir = os.path.join(path, 'pages', 'reviews', 'all', f'app-{game_id}')
+        os.makedirs(gamedir, exist_ok=True)
+        count = review_count(game_id, pages, reviews)
+        with zipfile.ZipFile(os.path.join(gamedir, 'reviews.zip'), 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for page, offset in enumerate(range(0, count, per_page), 1):
+                body = appreviews_page(game_id, offset, count, per_page, structured, first=offset == 0)
+                zipf.writestr(f'reviews-{page}.{extension}', json.dumps(body))
+                counts['review_pages'] += 1
+        counts['reviews'] += count
+    return counts
+
+
+def ensure_corpus(path, games=1000, pages=10, reviews=20, structured=False):
+    """Writes the corpus in path, unless it is already there with the same parameters. Returns its counts."""
+    params = {'games': games, 'pages': pages, 'reviews': reviews, 'structured': structured, 'version': CORPUS_VERSION}
+    metapath = os.path.join(path, CORPUS_META)
+    if os.path.exists(metapath):
+        with open(metapath, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['params'] == params:
+            return meta['counts']
+        shutil.rmtree(os.path.join(path, 'pages'), ignore_errors=True)
+    elif os.path.exists(os.path.join(path, 'pages')):
+        # never overwrite the pages of a real crawl
+        raise ValueError(f'{path} contains pages that are not from a synthetic corpus')
+    counts = write_corpus(path, games, pages, reviews, structured)
+    atomic_write_json(metapath, {'params': params, 'counts': counts})
+    return counts
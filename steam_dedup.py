@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import math
+import os
+import sqlite3
+import tempfile
+
+# keys a new set is sized for, about 12KB of filter; it grows by GROWTH times whenever its keys exceed it
+CAPACITY = 10000
+GROWTH = 4
+ERROR_RATE = 0.01
+
+# keys kept in memory before they are written to the database
+FLUSH_SIZE = 10000
+
+
+class SeenKeys:
+    """Set of review keys with bounded memory, for sets of tens of millions of keys.
+
+    A bloom filter in memory tells when a key is certainly new; only the keys
+    the filter reports as maybe seen are looked up in a sqlite database of
+    the keys, so the answer is exact. The database is a temporary file when
+    path is None, and it is created only when the keys exceed FLUSH_SIZE.
+    A database saved in path is reopened with its keys.
+    The filter is sized for capacity keys and rebuilt larger when they are
+    exceeded, so a set takes memory in proportion to its keys (about 1.2
+    bytes per key for the default error rate).
+    """
+
+    def __init__(self, path=None, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self._error_rate = error_rate
+        self._pending = set()
+        self._path = path
+        self._temporary = path is None
+        self._conn = None
+        self._count = 0
+        if path is not None and os.path.exists(path):
+            self._connect()
+            self._count = self._conn.execute('SELECT COUNT(*) FROM keys').fetchone()[0]
+            capacity = max(capacity, GROWTH * self._count)
+        self._resize(capacity)
+
+    def _resize(self, capacity):
+        # the keys are hashed again into a filter for capacity keys, pending keys are not written to the database
+        self._capacity = capacity
+        self._size = max(int(-capacity * math.log(self._error_rate) / math.log(2) ** 2), 8)
+        self._hashes = max(int(round(self._size / capacity * math.log(2))), 1)
+        self._bits = bytearray((self._size + 7) // 8)
+        if self._conn is not None:
+            for key, in self._conn.execute('SELECT key FROM keys'):
+                self._set(self._positions(key))
+        for key in self._pending:
+            self._set(self._positions(key))
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self._size for i in range(self._hashes)]
+
+    def _set(self, positions):
+        bits = self._bits
+        for position in positions:
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def _maybe(self, positions):
+        bits = self._bits
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _connect(self):
+        if self._path is None:
+            fd, self._path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(fd)
+        self._conn = sqlite3.connect(self._path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY) WITHOUT ROWID')
+
+    def __contains__(self, key):
+        return self._contains(key, self._positions(key))
+
+    def _contains(self, key, positions):
+        if not self._maybe(positions):
+            return False
+        if key in self._pending:
+            return True
+        if self._conn is None:
+            return False
+        return self._conn.execute('SELECT 1 FROM keys WHERE key = ?', (key,)).fetchone() is not None
+
+    def add(self, key):
+        """Adds a key, returns False if it was already in the set."""
+        positions = self._positions(key)
+        if self._contains(key, positions):
+            return False
+        self._set(positions)
+        self._pending.add(key)
+        self._count += 1
+        if len(self._pending) >= FLUSH_SIZE:
+            self.flush()
+        if self._count > self._capacity:
+            self._resize(GROWTH * self._capacity)
+        return True
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def flush(self):
+        if not self._pending:
+            return
+        if self._conn is None:
+            self._connect()
+        with self._conn:
+            self._conn.executemany('INSERT OR IGNORE INTO keys VALUES (?)', ((key,) for key in self._pending))
+        self._pending.clear()
+
+    def discard(self):
+        """Discards the keys added since the last flush, their bits stay set and cost a lookup each."""
+        self._count -= len(self._pending)
+        self._pending.clear()
+
+    def close(self):
+        """Saves the keys in path, or deletes the temporary database."""
+        if self._temporary:
+            self.delete()
+            return
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def delete(self):
+        """Discards the keys and deletes the database."""
+        self._pending.clear()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+        if self._temporary:
+            self._path = None
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import email.utils
+import http.client
+import random
+import threading
+import urllib.parse
+import zlib
+from contextlib import nullcontext
+from time import monotonic, sleep, time
+
+from steam_telemetry import metrics
+
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 5
+MAX_BACKOFF = 60.0
+
+# seconds on which backoffs are based at least, also when requests are not paused (e.g., a limiter paces them)
+MIN_BACKOFF_PAUSE = 0.5
+
+# errors of a request on a kept-alive connection that the server closed while it was idle (RemoteDisconnected
+# is the empty status line of a connection closed before any byte of the response)
+CLOSED_CONNECTION_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPStatusError(Exception):
+    def __init__(self, url, status, retry_after=None):
+        super().__init__(f'HTTP {status} for {url}')
+        self.url = url
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self):
+        return self.status == 429 or self.status >= 500
+
+
+class Response:
+    def __init__(self, url, status, headers, body, elapsed, wire_bytes, reused):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        # seconds from sending the request to the end of the body, bytes received before decoding,
+        # whether the request was sent on an already open connection
+        self.elapsed = elapsed
+        self.wire_bytes = wire_bytes
+        self.reused = reused
+
+
+def decode_body(data, encoding):
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    if encoding == 'deflate':
+        # servers disagree on whether deflate means zlib or raw deflate
+        try:
+            return zlib.decompressobj().decompress(data)
+        except zlib.error:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+    return bytes(data)
+
+
+def hostkey(parts):
+    scheme = parts.scheme or 'http'
+    return scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80)
+
+
+class HTTPClient:
+    """Thread-safe http client keeping keep-alive connections open, per host.
+
+    Connections are returned to the pool of their host after each complete
+    response, at most maxidle idle connections are kept for each host.
+    Aggregated counters are in stats().
+    """
+
+    def __init__(self, maxidle=16, user_agent='steam-crawler'):
+        self.maxidle = maxidle
+        self.user_agent = user_agent
+        self._pools = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = {'requests': 0, 'connections': 0, 'reused': 0, 'wire_bytes': 0, 'body_bytes': 0,
+                       'elapsed': 0.0}
+
+    def _buffer(self, size):
+        # a read buffer for each thread, grown when needed and reused across requests
+        buffer = getattr(self._local, 'buffer', None)
+        if buffer is None or len(buffer) < size:
+            buffer = bytearray(max(size, 64 * 1024))
+            self._local.buffer = buffer
+        return buffer
+
+    def _getconnection(self, key, timeout):
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool:
+                conn = pool.pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self._stats['connections'] += 1
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def _putconnection(self, key, conn):
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.maxidle:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def _read(self, response):
+        length = response.getheader('Content-Length')
+        if length is not None and not response.chunked:
+            length = int(length)
+            if not length:
+                # marks the response as complete, so that the connection can be reused
+                response.read()
+                return memoryview(b'')
+            buffer = self._buffer(length)
+            view = memoryview(buffer)[:length]
+            read = 0
+            while read < length:
+                n = response.readinto(view[read:])
+                if not n:
+                    raise http.client.IncompleteRead(bytes(view[:read]), length - read)
+                read += n
+            return view
+        return memoryview(response.read())
+
+    def _request(self, url, timeout, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = hostkey(parts)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = {'Accept-Encoding': 'gzip, deflate', 'User-Agent': self.user_agent}
+        if headers:
+            request_headers.update(headers)
+
+        conn, reused = self._getconnection(key, timeout)
+        start = monotonic()
+        response = None
+        complete = False
+        try:
+            conn.request('GET', path, headers=request_headers)
+            response = conn.getresponse()
+            data = self._read(response)
+            body = decode_body(data, response.getheader('Content-Encoding', '').lower())
+            complete = True
+        except CLOSED_CONNECTION_ERRORS:
+            # only a request that got no response can be sent again, timeouts are left to the caller
+            if not reused or response is not None:
+                raise
+        finally:
+            # a connection in the middle of a request is never reused, whatever stopped it (e.g., a KeyboardInterrupt)
+            if not complete:
+                conn.close()
+        if not complete:
+            # the server closed the idle connections of the host, the request is sent again on a new one
+            self._droppool(key)
+            return self._request(url, timeout, headers)
+        elapsed = monotonic() - start
+        if response.will_close:
+            conn.close()
+        else:
+            self._putconnection(key, conn)
+
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['reused'] += int(reused)
+            self._stats['wire_bytes'] += len(data)
+            self._stats['body_bytes'] += len(body)
+            self._stats['elapsed'] += elapsed
+        metrics.observe('http_request_seconds', elapsed)
+        metrics.inc('http_requests_total', status=response.status)
+        metrics.inc('http_received_bytes_total', len(data))
+        return Response(url, response.status, response.headers, body, elapsed, len(data), reused)
+
+    def _droppool(self, key):
+        with self._lock:
+            pool = self._pools.pop(key, [])
+        for conn in pool:
+            conn.close()
+
+    def get(self, url, timeout=180, headers=None):
+        """Returns the Response to a GET of url, following redirects.
+
+        Raises HTTPStatusError on status codes >= 400, OSError and
+        http.client.HTTPException on network errors.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, timeout, headers)
+            if response.status in REDIRECT_CODES and response.headers.get('Location'):
+                url = urllib.parse.urljoin(url, response.headers['Location'])
+                continue
+            if response.status >= 400:
+                raise HTTPStatusError(url, response.status, parse_retry_after(response.headers.get('Retry-After')))
+            return response
+        raise HTTPStatusError(url, response.status)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        if stats['requests']:
+            stats['mean_elapsed'] = stats['elapsed'] / stats['requests']
+        return stats
+
+    def close(self):
+        with self._lock:
+            pools = self._pools
+            self._pools = dict()
+        for pool in pools.values():
+            for conn in pool:
+                conn.close()
+
+
+default_client = HTTPClient()
+
+
+def download_page(url, maxretries, timeout, pause, limiter=None, client=None):
+    """Returns the content of url, or None if all the maxretries tries failed, see download_response."""
+    response = download_response(url, maxretries, timeout, pause, limiter, client)
+    return None if response is None else response.body
+
+
+def download_response(url, maxretries, timeout, pause, limiter=None, client=None, headers=None):
+    """Returns the Response to a GET of url, or None if all the maxretries tries failed.
+
+    A failed try is followed by the Retry-After time sent by the server or by
+    a jittered exponential backoff, unless the limiter takes care of pacing
+    (see AdaptiveRateLimiter). With the headers of a conditional request, the
+    Response can be a 304 without content.
+    """
+    client = client or default_client
+    tries = 0
+    response = None
+    while tries < maxretries and response is None:
+        if tries:
+            metrics.inc('http_retries_total')
+        try:
+            start = monotonic()
+            with limiter or nullcontext():
+                metrics.inc('http_limiter_wait_seconds_total', monotonic() - start)
+                response = client.get(url, timeout=timeout, headers=headers)
+            if limiter:
+                limiter.success()
+            with metrics.timer('http_pause_seconds_total'):
+                sleep(pause)
+        except HTTPStatusError as e:
+            tries += 1
+            metrics.inc('http_errors_total', status=e.status)
+            if e.throttled:
+                metrics.inc('http_throttled_total')
+            with metrics.timer('http_backoff_seconds_total'):
+                backoff(limiter, pause, tries, e.throttled, e.retry_after)
+        except (OSError, http.client.HTTPException) as e:
+            tries += 1
+            metrics.inc('http_errors_total', status=type(e).__name__)
+            with metrics.timer('http_backoff_seconds_total'):
+                backoff(limiter, pause, tries)
+    if response is None:
+        metrics.inc('http_failures_total')
+    return response
+
+
+def backoff_pause(pause, limiter=None):
+    """Returns the seconds on which the waits after failures are based.
+
+    They are the pause between requests or, when the requests are paced by a
+    limiter, the interval between its requests, and at least MIN_BACKOFF_PAUSE.
+    """
+    interval = 1 / limiter.rate if limiter and limiter.rate else 0.0
+    return max(pause, interval, MIN_BACKOFF_PAUSE)
+
+
+def backoff(limiter, pause, tries, throttled=True, retry_after=None):
+    if limiter and limiter.failure(throttled, retry_after):
+        return
+    if retry_after is not None:
+        sleep(min(retry_after, MAX_BACKOFF))
+    elif throttled:
+        sleep(min(backoff_pause(pause, limiter) * 2 ** tries, MAX_BACKOFF) * random.uniform(0.5, 1.5))
+
+
+def print_stats(client=None):
+    stats = (client or default_client).stats()
+    if not stats['requests']:
+        return
+    print(f'{stats["requests"]} requests on {stats["connections"]} connections ({stats["reused"]} reused), '
+          f'{stats["wire_bytes"]} bytes received for {stats["body_bytes"]} bytes of content, '
+          f'{stats["mean_elapsed"] * 1000:.1f} ms per request')
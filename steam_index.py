@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+
+from steam_columnar import parse_date
+
+# columns of reviews.csv, kept with the same values in the index
+COLUMNS = ['game_id', 'game_title', 'review_helpful', 'review_funny', 'username', 'games_owned', 'reviews_written',
+           'recommended', 'time_played', 'review_date', 'review_text']
+
+
+class ReviewIndex:
+    """Reviews of reviews.csv saved in a sqlite database, indexed by game, user and date.
+
+    Rows are kept with the values they have in reviews.csv, plus the date of
+    the review in ISO format for range lookups. The reviews of a game are
+    added in a single transaction that replaces its previous reviews, with the
+    source they come from, so that an extraction updates only the games whose
+    source changed. With fts the text of the reviews is also indexed for full
+    text search (it requires the FTS5 extension of sqlite, included in most
+    builds), an index without it is extended when reopened with fts.
+    """
+
+    def __init__(self, dbfile, fts=False):
+        self._conn = sqlite3.connect(dbfile)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sources (game_id INTEGER PRIMARY KEY, source TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS reviews (game_id INTEGER, game_title TEXT, '
+                               'review_helpful TEXT, review_funny TEXT, username TEXT, games_owned TEXT, '
+                               'reviews_written TEXT, recommended TEXT, time_played TEXT, review_date TEXT, '
+                               'review_text TEXT, posted TEXT)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS reviews_game ON reviews (game_id)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS reviews_username ON reviews (username)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS reviews_posted ON reviews (posted)')
+        self.fts = self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'reviews_fts'").fetchone() is not None
+        if fts and not self.fts:
+            self._create_fts()
+
+    def _create_fts(self):
+        try:
+            with self._conn:
+                self._conn.execute("CREATE VIRTUAL TABLE reviews_fts USING fts5(review_text, content='reviews', "
+                                   "content_rowid='rowid')")
+                self._conn.execute('CREATE TRIGGER reviews_insert AFTER INSERT ON reviews BEGIN '
+                                   'INSERT INTO reviews_fts (rowid, review_text) VALUES (new.rowid, new.review_text); '
+                                   'END')
+                self._conn.execute('CREATE TRIGGER reviews_delete AFTER DELETE ON reviews BEGIN '
+                                   "INSERT INTO reviews_fts (reviews_fts, rowid, review_text) "
+                                   "VALUES ('delete', old.rowid, old.review_text); END")
+                # the reviews already in the index
+                self._conn.execute("INSERT INTO reviews_fts (reviews_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            raise RuntimeError(f'full text search is not available in this build of sqlite: {e}') from e
+        self.fts = True
+
+    def source(self, game_id):
+        """Returns the source of the reviews of a game in the index, None if there is none."""
+        row = self._conn.execute('SELECT source FROM sources WHERE game_id = ?', (int(game_id),)).fetchone()
+        return row[0] if row else None
+
+    def tee(self, game_id, rows, source=None, replace=True):
+        """Yields rows, with the reviews.csv layout, while adding them to the index as the reviews of a game.
+
+        The previous reviews of the game are replaced, unless replace is
+        False. The rows are committed when they are over, an interruption
+        leaves the previous reviews of the game in place.
+        """
+        game_id = int(game_id)
+        with self._conn:
+            if replace:
+                self._conn.execute('DELETE FROM reviews WHERE game_id = ?', (game_id,))
+            for row in rows:
+                self._conn.execute('INSERT INTO reviews VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (game_id,) + tuple(row[1:]) + (self._isodate(row[9]),))
+                yield row
+            self._conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)', (game_id, source))
+
+    @staticmethod
+    def _isodate(value):
+        date = parse_date(value)
+        return date.isoformat() if date else None
+
+    def add_reviews(self, game_id, rows, source=None, replace=True):
+        """Adds the rows of a game to the index, see tee. Returns the number of rows added."""
+        count = 0
+        for _ in self.tee(game_id, rows, source, replace):
+            count += 1
+        return count
+
+    def remove_games(self, keep=()):
+        """Removes the reviews of all the games, except those in keep."""
+        keep = {int(game_id) for game_id in keep}
+        removed = [game_id for game_id, in self._conn.execute('SELECT game_id FROM sources')
+                   if game_id not in keep]
+        for game_id in removed:
+            with self._conn:
+                self._conn.execute('DELETE FROM reviews WHERE game_id = ?', (game_id,))
+                self._conn.execute('DELETE FROM sources WHERE game_id = ?', (game_id,))
+        return len(removed)
+
+    def _where(self, game_id, username, since, until, text):
+        conditions = list()
+        params = list()
+        if game_id is not None:
+            conditions.append('game_id = ?')
+            params.append(int(game_id))
+        if username is not None:
+            conditions.append('username = ?')
+            params.append(username)
+        if since is not None:
+            conditions.append('posted >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('posted <= ?')
+            params.append(until)
+        if text is not None:
+            if not self.fts:
+                raise RuntimeError('the index has no full text index of the reviews, build it with fts')
+            conditions.append('rowid IN (SELECT rowid FROM reviews_fts WHERE reviews_fts MATCH ?)')
+            params.append(text)
+        return (' WHERE ' + ' AND '.join(conditions) if conditions else ''), params
+
+    def reviews(self, game_id=None, username=None, since=None, until=None, text=None, limit=None):
+        """Yields the rows, with the reviews.csv layout, of the reviews matching all the given conditions.
+
+        since and until are ISO dates (YYYY-MM-DD), both included; text is a
+        full text query in the FTS5 syntax. Rows of a game are in the order of
+        reviews.csv.
+        """
+        where, params = self._where(game_id, username, since, until, text)
+        query = f'SELECT {", ".join(COLUMNS)} FROM reviews{where} ORDER BY rowid'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        yield from self._conn.execute(query, params)
+
+    def count(self, game_id=None, username=None, since=None, until=None, text=None):
+        where, params = self._where(game_id, username, since, until, text)
+        return self._conn.execute(f'SELECT COUNT(*) FROM reviews{where}', params).fetchone()[0]
+
+    def games(self):
+        return self._conn.execute('SELECT COUNT(*) FROM sources').fetchone()[0]
+
+    def close(self):
+        self._conn.close()
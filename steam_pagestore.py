@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import zlib
+from time import time
+
+# the store of the pages of the game listing, in the pages directory of a crawl
+LISTING_STORE = 'listing.sqlite'
+
+digitsre = re.compile(r'([0-9]+)')
+
+
+def page_key(name):
+    # pages sorted by their number, games-page-2 before games-page-10
+    return [int(part) if part.isdigit() else part for part in digitsre.split(name)]
+
+
+class PageStore:
+    """Pages downloaded by a crawler, compressed in a single sqlite file and indexed by name.
+
+    Every page is kept with the validators the server sent with it (ETag and
+    Last-Modified), to download it again with a conditional request, and with
+    the sha1 of its content, that tells whether a page downloaded again
+    changed. Rows extracted from a page can be saved with the sha1 of the
+    content they come from, so that only the pages that changed are parsed
+    again. The store can be shared by threads.
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS pages (name TEXT PRIMARY KEY, url TEXT, etag TEXT, '
+                               'last_modified TEXT, sha1 TEXT, updated REAL, body BLOB)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS extracted (name TEXT PRIMARY KEY, sha1 TEXT, rows TEXT)')
+
+    def __contains__(self, name):
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM pages WHERE name = ?', (name,)).fetchone() is not None
+
+    def names(self):
+        with self._lock:
+            names = [name for name, in self._conn.execute('SELECT name FROM pages')]
+        return sorted(names, key=page_key)
+
+    def get(self, name):
+        """Returns the content of a page as text, None if it is not in the store."""
+        with self._lock:
+            row = self._conn.execute('SELECT body FROM pages WHERE name = ?', (name,)).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8') if row else None
+
+    def sha1(self, name):
+        with self._lock:
+            row = self._conn.execute('SELECT sha1 FROM pages WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def validators(self, name):
+        """Returns the headers of a conditional request for a page, that the server answers with 304 if unchanged."""
+        with self._lock:
+            row = self._conn.execute('SELECT etag, last_modified FROM pages WHERE name = ?', (name,)).fetchone()
+        headers = dict()
+        if row and row[0]:
+            headers['If-None-Match'] = row[0]
+        if row and row[1]:
+            headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def put(self, name, body, url=None, headers=None):
+        """Saves a page, with the validators in the headers of its response. Returns whether its content changed.
+
+        A page with the same content of the one in the store is not written
+        again, only its validators are updated.
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        sha1 = hashlib.sha1(body).hexdigest()
+        etag = headers.get('ETag') if headers else None
+        last_modified = headers.get('Last-Modified') if headers else None
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT sha1 FROM pages WHERE name = ?', (name,)).fetchone()
+            if row and row[0] == sha1:
+                self._conn.execute('UPDATE pages SET url = ?, etag = ?, last_modified = ? WHERE name = ?',
+                                   (url, etag, last_modified, name))
+                return False
+            self._conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (name, url, etag, last_modified, sha1, time(), zlib.compress(body)))
+            return True
+
+    def delete(self, name):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM pages WHERE name = ?', (name,))
+            self._conn.execute('DELETE FROM extracted WHERE name = ?', (name,))
+
+    def extracted(self, name, sha1):
+        """Returns the rows extracted from the content of a page with the given sha1, None if there are none."""
+        with self._lock:
+            row = self._conn.execute('SELECT rows FROM extracted WHERE name = ? AND sha1 = ?',
+                                     (name, sha1)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_extracted(self, name, sha1, rows):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO extracted VALUES (?, ?, ?)', (name, sha1, json.dumps(rows)))
+
+    def clear_extracted(self):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM extracted')
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import threading
+from time import monotonic, sleep
+
+
+class RateLimiter:
+    """Token bucket shared by all the threads of a crawl.
+
+    rate is the number of requests per second (None means no limit on the
+    rate), burst the maximum number of requests that can be issued back to
+    back after an idle period, maxinflight the maximum number of requests
+    that can be open at the same time (None means no limit).
+    Use it as a context manager around each request.
+    """
+
+    def __init__(self, rate, burst=1, maxinflight=None):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = monotonic()
+        self._lock = threading.Lock()
+        self._inflight = threading.BoundedSemaphore(maxinflight) if maxinflight else None
+
+    def acquire(self):
+        if self._inflight:
+            self._inflight.acquire()
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            sleep(wait)
+
+    def release(self):
+        if self._inflight:
+            self._inflight.release()
+
+    def success(self):
+        pass
+
+    def failure(self, throttled=True, retry_after=None):
+        # a plain rate limiter does not react to failures, the caller has to back off
+        return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdaptiveRateLimiter(RateLimiter):
+    """Rate limiter that looks for the fastest rate the server tolerates.
+
+    The rate grows additively, by about increase requests per second every
+    second, while requests succeed. On a throttled request (429, 5xx,
+    timeouts) the rate is multiplied by decrease and all the requests are
+    paused for the Retry-After time sent by the server or, when missing,
+    for a jittered backoff. The rate is kept in [minrate, maxrate].
+    """
+
+    def __init__(self, rate, minrate=0.1, maxrate=None, increase=1.0, decrease=0.5, burst=1, maxinflight=None):
+        super().__init__(rate, burst, maxinflight)
+        self.minrate = minrate
+        self.maxrate = maxrate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttled = 0
+        self._until = 0.0
+        self._failures = 0
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                wait = self._until - monotonic()
+            if wait <= 0:
+                break
+            sleep(wait)
+        super().acquire()
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            # one request is 1/rate seconds of traffic, so this adds about increase to the rate every second
+            rate = self.rate + self.increase / self.rate
+            self.rate = min(rate, self.maxrate) if self.maxrate else rate
+
+    def failure(self, throttled=True, retry_after=None):
+        if not throttled:
+            return True
+        with self._lock:
+            now = monotonic()
+            self.throttled += 1
+            if now < self._until:
+                # requests that were in flight when the first one was throttled do not back off again
+                return True
+            self.rate = max(self.minrate, self.rate * self.decrease)
+            self._failures += 1
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                delay = min(60.0, 2 ** (self._failures - 1) / self.rate) * random.uniform(0.5, 1.5)
+            self._until = now + delay
+            self._tokens = 0
+        return True
+
+
+def add_limiter_arguments(parser):
+    """Adds to an argparse parser the options of the rate limiter shared by the workers of a crawl, see make_limiter."""
+    parser.add_argument(
+        '--rate', help='Max http requests per second across all workers, used when workers > 1 or in adaptive '
+                       'mode. Default: 1/pause', required=False, type=float)
+    parser.add_argument(
+        '--maxinflight', help='Max http requests open at the same time, used when workers > 1. '
+                              'Default: number of workers', required=False, type=int)
+    parser.add_argument(
+        '-a', '--adaptive', help='Adapt the request rate to the server: speed up while requests succeed, back off '
+                                 'when throttled. The initial rate is --rate', required=False, action='store_true')
+    parser.add_argument(
+        '--maxrate', help='Max http requests per second reached in adaptive mode. Default: unlimited',
+        required=False, type=float)
+
+
+def make_limiter(workers, pause, rate=None, maxinflight=None, adaptive=False, maxrate=None):
+    """Returns the rate limiter of a crawl, None if it has none, and the pause to keep after each request.
+
+    With more than one worker, or with an adaptive rate, the politeness is
+    enforced by a single limiter shared by all the workers, at rate requests
+    per second (1/pause by default), instead of the pause after each request.
+    """
+    if workers <= 1 and not adaptive:
+        return None, pause
+    if rate is None and pause > 0:
+        rate = 1 / pause
+    if adaptive:
+        return AdaptiveRateLimiter(rate or 1.0, maxrate=maxrate, maxinflight=maxinflight or workers), 0
+    return RateLimiter(rate, maxinflight=maxinflight or workers), 0
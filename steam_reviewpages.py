@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+
+# a div with the review_box class among its classes, not the divs with classes such as review_box_content
+reviewboxre = re.compile(r'<div class="(?:[^"]*\s)?review_box[\s"]')
+profilere = re.compile(r'steamcommunity\.com/(profiles|id)/([^/"]+)/')
+
+
+def split_reviews(html):
+    """Returns the (start, html) of every review box in the html of a reviews page."""
+    starts = [m.start() for m in reviewboxre.finditer(html)]
+    return list(zip(starts, [html[start:end] for start, end in zip(starts, starts[1:] + [len(html)])]))
+
+
+def review_key(reviewhtml):
+    # a user can write only one review for a game, the profile of the author identifies the review
+    m = profilere.search(reviewhtml)
+    if m:
+        return '/'.join(m.groups())
+    return None
+
+
+def review_keys(html):
+    return [key for key in (review_key(review) for _, review in split_reviews(html)) if key]
+
+
+def new_reviews(html, known):
+    """Returns the part of the html of a reviews page that precedes the first known review.
+
+    Reviews are sorted from the most recent, so that part contains only new
+    reviews. The second returned value tells if a known review was found.
+    """
+    for start, review in split_reviews(html):
+        if review_key(review) in known:
+            return html[:start], True
+    return html, False
+
+
+def page_keys(page):
+    """Returns the keys of the reviews of a parsed reviews page, in html or structured json format."""
+    if 'reviews' in page:
+        return [str(review['recommendationid']) for review in page['reviews']]
+    return review_keys(page.get('html', ''))
+
+
+def page_size(page):
+    if 'reviews' in page:
+        return len(page['reviews'])
+    return len(split_reviews(page.get('html', '')))
+
+
+def trim_known(page, known):
+    """Removes from a parsed reviews page the reviews from the first known one on.
+
+    Returns True if a known review was found.
+    """
+    if 'reviews' in page:
+        for i, review in enumerate(page['reviews']):
+            if str(review['recommendationid']) in known:
+                page['reviews'] = page['reviews'][:i]
+                return True
+        return False
+    page['html'], found = new_reviews(page['html'], known)
+    return found
+
+
+def trim_page(page, size):
+    """Removes from a parsed reviews page the reviews after the first size ones. Returns the number removed."""
+    if 'reviews' in page:
+        trimmed = max(0, len(page['reviews']) - size)
+        page['reviews'] = page['reviews'][:size]
+        return trimmed
+    reviews = split_reviews(page.get('html', ''))
+    if len(reviews) <= size:
+        return 0
+    page['html'] = page['html'][:reviews[size][0]]
+    return len(reviews) - size
+
+
+def drop_seen(page, seen):
+    """Removes from a parsed reviews page the reviews whose key is in seen, or repeated in the page.
+
+    The keys of the page are not added to seen. Returns the number of
+    reviews removed.
+    """
+    kept = set()
+
+    def duplicate(key):
+        if key is None:
+            return False
+        if key in kept or key in seen:
+            return True
+        kept.add(key)
+        return False
+
+    if 'reviews' in page:
+        reviews = [review for review in page['reviews'] if not duplicate(str(review['recommendationid']))]
+        dropped = len(page['reviews']) - len(reviews)
+        page['reviews'] = reviews
+        return dropped
+    reviews = split_reviews(page.get('html', ''))
+    unique = [review for _, review in reviews if not duplicate(review_key(review))]
+    dropped = len(reviews) - len(unique)
+    if dropped:
+        page['html'] = page['html'][:reviews[0][0]] + ''.join(unique)
+    return dropped
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import re
+from html import unescape
+from html.entities import html5
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+from steam_telemetry import STAGE_SECONDS, metrics
+
+helpfulre = re.compile(r'([0-9]+) [a-z]+? found this review helpful')
+funnyre = re.compile(r'([0-9]+) [a-z]+? found this review funny')
+ownedre = re.compile(r'([0-9]+) product')
+revre = re.compile(r'([0-9]+) review')
+timere = re.compile(r'([0-9.]+) hrs on record')
+postedre = re.compile(r'Posted: (.+)')
+yearre = re.compile(r'.* [0-9][0-9][0-9][0-9]$')
+userre = re.compile(r'/(profiles|id)/(.+?)/')
+
+
+def structured_review_row(review):
+    # the fields extracted from the html of a review, with two differences: the username is the steam id also
+    # for the users with a custom profile url (html pages give their name), the text keeps its BBCode markup
+    author = review.get('author', {})
+    posted = datetime.datetime.fromtimestamp(review['timestamp_created'], datetime.timezone.utc)
+    return (review.get('votes_up', 0), review.get('votes_funny', 0), author.get('steamid', '__anon__'),
+            author.get('num_games_owned', 0), author.get('num_reviews', 0), 1 if review.get('voted_up') else -1,
+            f"{author.get('playtime_forever', 0) / 60:.1f}", f'{posted:%B} {posted.day}, {posted.year}',
+            review.get('review', '').strip())
+
+
+def html_review_row(reviewdiv):
+    helpful = 0
+    funny = 0
+    elem = reviewdiv.find('div', attrs={'class': 'vote_info'})
+    if elem:
+        m = helpfulre.search(elem.text)
+        if m:
+            helpful = m.group(1)
+        m = funnyre.search(elem.text)
+        if m:
+            funny = m.group(1)
+    username = '__anon__'
+    elem = reviewdiv.find('div', attrs={'class': 'persona_name'})
+    if elem:
+        m = userre.search(str(elem.contents))
+        if m:
+            username = m.group(2)
+    owned = 0
+    elem = reviewdiv.find('div', attrs={'class': 'num_owned_games'})
+    if elem:
+        m = ownedre.search(elem.text)
+        if m:
+            owned = m.group(1)
+    numrev = 0
+    elem = reviewdiv.find('div', attrs={'class': 'num_reviews'})
+    if elem:
+        m = revre.search(elem.text)
+        if m:
+            numrev = m.group(1)
+    recco = 0
+    elem = reviewdiv.find('div', attrs={'class': 'title ellipsis'})
+    if elem:
+        if elem.text == 'Recommended':
+            recco = 1
+        else:
+            recco = -1
+    time = 0
+    elem = reviewdiv.find('div', attrs={'class': 'hours ellipsis'})
+    if elem:
+        m = timere.search(elem.text)
+        if m:
+            time = m.group(1)
+    posted = 0
+    elem = reviewdiv.find('div', attrs={'class': 'postedDate'})
+    if elem:
+        m = postedre.search(elem.text)
+        if m:
+            posted = m.group(1).strip()
+            if not yearre.match(posted):
+                posted = posted + f", {datetime.date.today().year}"
+    content = ''
+    elem = reviewdiv.find('div', attrs={'class': 'content'})
+    if elem:
+        content = elem.text.strip()
+    return helpful, funny, username, owned, numrev, recco, time, posted, content
+
+
+def bs4_reviews(html):
+    """Reference parser: builds the tree of the page with BeautifulSoup and searches it for every field."""
+    with metrics.timer(STAGE_SECONDS, stage='parse'):
+        soup = BeautifulSoup(html, "html.parser")
+        reviewdivs = soup.find_all('div', attrs={'class': 'review_box'})
+    with metrics.timer(STAGE_SECONDS, stage='fields'):
+        rows = [html_review_row(reviewdiv) for reviewdiv in reviewdivs]
+    yield from rows
+
+
+# tags that BeautifulSoup closes as soon as they are opened
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+             'param', 'source', 'track', 'wbr', 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex',
+             'nextid', 'spacer'}
+
+# tags whose strings BeautifulSoup leaves out of the text of the tags that contain them
+STRING_CONTAINERS = {'rt', 'rp', 'style', 'script', 'template'}
+
+# tags whose strings BeautifulSoup serializes without escaping them
+RAW_TEXT_TAGS = {'script', 'style'}
+
+# tags within which BeautifulSoup keeps the strings made only of whitespace as they are
+PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# attributes whose value BeautifulSoup splits on whitespace, by tag ('*' is any tag)
+LIST_ATTRIBUTES = {'*': {'class', 'accesskey', 'dropzone'}, 'a': {'rel', 'rev'}, 'link': {'rel', 'rev'},
+                   'td': {'headers'}, 'th': {'headers'}, 'form': {'accept-charset'}, 'object': {'archive'},
+                   'area': {'rel'}, 'icon': {'sizes'}, 'iframe': {'sandbox'}, 'output': {'for'}}
+
+# how BeautifulSoup serializes the strings that are not text (comments, declarations, ...)
+MARKUP = {'comment': ('<!--', '-->'), 'cdata': ('<![CDATA[', ']]>'), 'pi': ('<?', '>'),
+          'doctype': ('<!DOCTYPE ', '>\n'), 'declaration': ('<?', '?>')}
+
+# the fields of a review, identified by the class of their div
+FIELDS = ['vote_info', 'persona_name', 'num_owned_games', 'num_reviews', 'title ellipsis', 'hours ellipsis',
+          'postedDate', 'content']
+
+decimalre = re.compile(r'([0-9]+)(.*)')
+hexre = re.compile(r'([0-9a-f]+)(.*)')
+
+
+def escape_text(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def charref_text(name):
+    # the text of the character reference &#name; as BeautifulSoup reads it: as html.unescape, but control
+    # characters and noncharacters are kept, and the digits of a malformed reference are read up to the first
+    # character that is not a digit
+    if name.startswith(('x', 'X')):
+        digits, base, numberre = name[1:], 16, hexre
+    else:
+        digits, base, numberre = name, 10, decimalre
+    extra = ''
+    try:
+        number = int(digits, base)
+    except ValueError:
+        m = numberre.match(digits)
+        if not m:
+            return name
+        number, extra = int(m.group(1), base), m.group(2)
+    return (unescape(f'&#{number};') or chr(number)) + extra
+
+
+def serialize_starttag(tag, attrs):
+    # attributes are sorted, as by the formatter of BeautifulSoup
+    serialized = [tag]
+    for key, value in sorted(attrs.items()):
+        if key in LIST_ATTRIBUTES['*'] or key in LIST_ATTRIBUTES.get(tag, ()):
+            value = ' '.join(value.split())
+        value = escape_text(value)
+        if '"' in value and "'" not in value:
+            serialized.append(f"{key}='{value}'")
+        else:
+            serialized.append('{}="{}"'.format(key, value.replace('"', '&quot;')))
+    return '<' + ' '.join(serialized) + ('/>' if tag in VOID_TAGS else '>')
+
+
+class ReviewBox:
+    """The fields of a review box, while the html of the page is scanned."""
+
+    def __init__(self):
+        self.fields = dict()
+        # fields whose div is open, collecting text
+        self.open = list()
+        # children of persona_name, serialized as in str(elem.contents), and the depth within them
+        self.persona = None
+        self.depth = 0
+
+
+class ReviewFieldsParser(HTMLParser):
+    """Collects the fields of all the review boxes of a page in a single pass over the html.
+
+    Text is collected only for the first div of every field in a review box,
+    as BeautifulSoup find() does, also when the div is in a review box nested
+    within the box. Tags are opened and closed, and strings are split,
+    joined, unescaped and kept out of the text, following the same rules of
+    the html.parser tree builder of BeautifulSoup.
+    """
+
+    def __init__(self):
+        # references are read as BeautifulSoup does, see handle_charref
+        super().__init__(convert_charrefs=False)
+        # fields of the review boxes, in the order their div is opened as in find_all()
+        self.reviews = list()
+        self._boxes = list()
+        self._stack = list()
+        self._data = list()
+        self._containers = 0
+        self._preserve = 0
+        # void tags already closed, whose end tag is ignored
+        self._closed = list()
+
+    def handle_starttag(self, tag, attrs, void=True):
+        self._end_data()
+        attrs = {key: '' if value is None else value for key, value in attrs}
+        opened = list()
+        for box in self._boxes:
+            if box.persona is not None:
+                if box.depth == 0:
+                    box.persona.append('')
+                box.persona[-1] += serialize_starttag(tag, attrs)
+                box.depth += 1
+        if tag == 'div':
+            classvalue = ' '.join(attrs.get('class', '').split())
+            classes = classvalue.split(' ')
+            for box in self._boxes:
+                for field in FIELDS:
+                    if field not in box.fields and (field == classvalue or field in classes):
+                        opened.append((box, field))
+                        if field == 'persona_name':
+                            box.persona = box.fields[field] = list()
+                            box.depth = 0
+                        else:
+                            box.fields[field] = list()
+                            box.open.append(field)
+            if 'review_box' in classes:
+                box = ReviewBox()
+                self.reviews.append(box.fields)
+                self._boxes.append(box)
+                opened.append((box, None))
+        self._stack.append((tag, opened))
+        self._containers += tag in STRING_CONTAINERS
+        self._preserve += tag in PRESERVE_WHITESPACE_TAGS
+        if void and tag in VOID_TAGS:
+            self._pop(len(self._stack) - 1)
+            self._closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, void=False)
+        self.handle_endtag(tag, closed=False)
+
+    def handle_endtag(self, tag, closed=True):
+        if closed and tag in self._closed:
+            self._closed.remove(tag)
+            return
+        self._end_data()
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                # BeautifulSoup ignores end tags without a matching open tag
+                self._pop(i)
+                break
+
+    def _pop(self, size):
+        while len(self._stack) > size:
+            tag, opened = self._stack.pop()
+            self._containers -= tag in STRING_CONTAINERS
+            self._preserve -= tag in PRESERVE_WHITESPACE_TAGS
+            for box in self._boxes:
+                if box.persona is not None and (box, 'persona_name') not in opened:
+                    box.depth -= 1
+                    if tag not in VOID_TAGS:
+                        box.persona[-1] += f'</{tag}>'
+            for box, field in opened:
+                if field is None:
+                    self._boxes.remove(box)
+                elif field == 'persona_name':
+                    box.persona = None
+                else:
+                    box.open.remove(field)
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_charref(self, name):
+        self._data.append(charref_text(name))
+
+    def handle_entityref(self, name):
+        self._data.append(html5.get(name + ';', '&' + name))
+
+    def handle_comment(self, data):
+        self._string(data, 'comment')
+
+    def handle_decl(self, decl):
+        self._string(decl[len('DOCTYPE '):], 'doctype')
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            self._string(data[len('CDATA['):], 'cdata')
+        else:
+            self._string(data, 'declaration')
+
+    def handle_pi(self, data):
+        self._string(data, 'pi')
+
+    def _string(self, data, kind):
+        self._end_data()
+        self._data.append(data)
+        self._end_data(kind)
+
+    def _end_data(self, kind=None):
+        # the data since the last tag is a single string, as a NavigableString of BeautifulSoup
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = list()
+        if not self._preserve and not data.strip(ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        # CData is text also within a string container
+        text = kind == 'cdata' or (kind is None and not self._containers)
+        for box in self._boxes:
+            if text:
+                for field in box.open:
+                    box.fields[field].append(data)
+            if box.persona is not None:
+                if box.depth == 0:
+                    box.persona.append(repr(data))
+                elif kind is not None:
+                    box.persona[-1] += MARKUP[kind][0] + data + MARKUP[kind][1]
+                elif self._stack[-1][0] in RAW_TEXT_TAGS:
+                    box.persona[-1] += data
+                else:
+                    box.persona[-1] += escape_text(data)
+
+    def close(self):
+        super().close()
+        self._end_data()
+        # tags left open at the end of the page are closed, as BeautifulSoup does
+        self._pop(0)
+
+
+def fields_review_row(fields):
+    # same rules of html_review_row, applied to the texts collected by ReviewFieldsParser
+    helpful = 0
+    funny = 0
+    if 'vote_info' in fields:
+        text = ''.join(fields['vote_info'])
+        m = helpfulre.search(text)
+        if m:
+            helpful = m.group(1)
+        m = funnyre.search(text)
+        if m:
+            funny = m.group(1)
+    username = '__anon__'
+    if 'persona_name' in fields:
+        m = userre.search('[' + ', '.join(fields['persona_name']) + ']')
+        if m:
+            username = m.group(2)
+    owned = 0
+    if 'num_owned_games' in fields:
+        m = ownedre.search(''.join(fields['num_owned_games']))
+        if m:
+            owned = m.group(1)
+    numrev = 0
+    if 'num_reviews' in fields:
+        m = revre.search(''.join(fields['num_reviews']))
+        if m:
+            numrev = m.group(1)
+    recco = 0
+    if 'title ellipsis' in fields:
+        if ''.join(fields['title ellipsis']) == 'Recommended':
+            recco = 1
+        else:
+            recco = -1
+    time = 0
+    if 'hours ellipsis' in fields:
+        m = timere.search(''.join(fields['hours ellipsis']))
+        if m:
+            time = m.group(1)
+    posted = 0
+    if 'postedDate' in fields:
+        m = postedre.search(''.join(fields['postedDate']))
+        if m:
+            posted = m.group(1).strip()
+            if not yearre.match(posted):
+                posted = posted + f", {datetime.date.today().year}"
+    content = ''
+    if 'content' in fields:
+        content = ''.join(fields['content']).strip()
+    return helpful, funny, username, owned, numrev, recco, time, posted, content
+
+
+def fast_reviews(html):
+    """Single pass parser: the fields of the reviews are collected while the html is scanned, without a tree."""
+    with metrics.timer(STAGE_SECONDS, stage='parse'):
+        parser = ReviewFieldsParser()
+        parser.feed(html)
+        parser.close()
+    with metrics.timer(STAGE_SECONDS, stage='fields'):
+        rows = [fields_review_row(fields) for fields in parser.reviews]
+    yield from rows
+
+
+PARSERS = {'bs4': bs4_reviews, 'fast': fast_reviews}
+
+
+def html_reviews(html, parser='bs4'):
+    """Yields the values of the fields of every review box in the html of a reviews page."""
+    return PARSERS[parser](html)
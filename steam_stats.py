@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import math
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from steam_columnar import partitions, read_partition
+
+# the only columns of reviews used by the stats
+STATS_COLUMNS = ['game_id', 'game_title', 'username', 'recommended', 'time_played']
+
+CHUNK_SIZE = 1000000
+
+# aggregates of a parquet dataset are saved in the dataset directory, files starting with _ are not read as data
+STATS_DB = '_stats.sqlite'
+
+# compact types of the columns read from reviews.csv
+CSV_DTYPES = {'game_id': 'int64', 'game_title': 'category', 'username': 'category', 'recommended': 'int8',
+              'time_played': 'float64'}
+
+# only a missing time played is NA, usernames and titles such as NA, null or nan are kept as they are
+CSV_NA_VALUES = {'time_played': ['']}
+
+
+def read_chunks(inputfile_name, chunksize=CHUNK_SIZE):
+    """Yields DataFrames of at most chunksize reviews, with only the columns used by the stats."""
+    with pd.read_csv(inputfile_name, encoding='utf-8', usecols=STATS_COLUMNS, dtype=CSV_DTYPES,
+                     keep_default_na=False, na_values=CSV_NA_VALUES, chunksize=chunksize) as reader:
+        yield from reader
+
+
+class KeyIndex:
+    """Assigns consecutive ids to keys, in order of first appearance."""
+
+    def __init__(self):
+        self.keys = pd.Index([], dtype=object)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def ids(self, values):
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+        uniques = pd.Index(np.asarray(uniques, dtype=object), dtype=object)
+        ids = self.keys.get_indexer(uniques)
+        new = ids < 0
+        ids[new] = len(self.keys) + np.arange(new.sum())
+        self.keys = self.keys.append(uniques[new])
+        return ids[codes]
+
+
+def grow(array, size):
+    if len(array) >= size:
+        return array
+    grown = np.zeros(max(size, 2 * len(array)), dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class ReviewStats:
+    """Aggregates of reviews per user and per game, computed on chunks of reviews.
+
+    Users and games are kept in order of first appearance and their hours are
+    summed in the order of the reviews, so that the output is the same of a
+    row by row loop over the reviews.
+    """
+
+    def __init__(self):
+        self.reviews = 0
+        self.hours = 0.0
+        self.users = KeyIndex()
+        self.user_games = np.zeros(0, dtype=np.int64)
+        self.user_time = np.zeros(0, dtype=np.float64)
+        self.games = KeyIndex()
+        self.game_reviews = np.zeros(0, dtype=np.int64)
+        self.game_recommended = np.zeros(0, dtype=np.int64)
+        self.game_time = np.zeros(0, dtype=np.float64)
+        # whether the first review of a game is a recommendation, it sets the order of the keys in games.json
+        self.game_first_recommended = np.zeros(0, dtype=bool)
+        self.game_title = np.zeros(0, dtype=object)
+
+    def add(self, chunk):
+        time = chunk['time_played'].to_numpy(dtype=np.float64)
+        recommended = chunk['recommended'].to_numpy() == 1
+        self.reviews += len(chunk)
+        self.hours += float(np.nansum(time))
+
+        uids = self.users.ids(chunk['username'])
+        size = len(self.users)
+        self.user_games = grow(self.user_games, size)
+        self.user_time = grow(self.user_time, size)
+        self.user_games[:size] += np.bincount(uids, minlength=size)
+        np.add.at(self.user_time, uids, time)
+
+        known = len(self.games)
+        gids = self.games.ids(chunk['game_id'].to_numpy(dtype=np.int64))
+        size = len(self.games)
+        for name in ['game_reviews', 'game_recommended', 'game_time', 'game_first_recommended', 'game_title']:
+            setattr(self, name, grow(getattr(self, name), size))
+        self.game_reviews[:size] += np.bincount(gids, minlength=size)
+        self.game_recommended[:size] += np.bincount(gids[recommended], minlength=size)
+        np.add.at(self.game_time, gids, time)
+        first = ~pd.Index(gids).duplicated(keep='first') & (gids >= known)
+        self.game_first_recommended[gids[first]] = recommended[first]
+        last = ~pd.Index(gids).duplicated(keep='last')
+        self.game_title[gids[last]] = np.asarray(chunk['game_title'], dtype=object)[last]
+
+    def summary(self):
+        return {'reviews': self.reviews,
+                'hours': self.hours,
+                'users': len(self.users),
+                'games': len(self.games)}
+
+    def user_items(self):
+        for key, games, time in zip(self.users.keys, self.user_games, self.user_time):
+            yield str(key), [('games', float(games)), ('time_played', float(time))]
+
+    def game_items(self):
+        for i, key in enumerate(self.games.keys):
+            yield str(key), game_fields(self.game_title[i], self.game_reviews[i], self.game_recommended[i],
+                                        float(self.game_time[i]), self.game_first_recommended[i])
+
+    def write(self, output_dir):
+        write_stats(self, output_dir)
+
+
+class StatsAggregates:
+    """Partial aggregates of the reviews of a parquet dataset, saved in a sqlite database.
+
+    Every game partition contributes its totals and the totals of each of its
+    users. When a partition changes only its contribution is replaced, and
+    the totals of users are updated by difference, so the cost of an update
+    depends on the changed games, not on the size of the dataset. Hours are
+    kept as integer tenths, the precision of reviews.csv, so that sums do not
+    depend on the order in which games are added and removed.
+    """
+
+    def __init__(self, dbfile):
+        self._conn = sqlite3.connect(dbfile)
+        self._selected = False
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sources (game_id INTEGER PRIMARY KEY, signature TEXT)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS games (game_id INTEGER PRIMARY KEY, title TEXT, '
+                               'reviews INTEGER, recommended INTEGER, time_played INTEGER, '
+                               'first_recommended INTEGER)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS user_games (game_id INTEGER, username TEXT, '
+                               'reviews INTEGER, time_played INTEGER, PRIMARY KEY (game_id, username)) WITHOUT ROWID')
+            # users are listed in order of rowid, i.e., of first appearance
+            self._conn.execute('CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, games INTEGER, '
+                               'time_played INTEGER)')
+            self._conn.execute('CREATE TEMP TABLE selected (game_id INTEGER PRIMARY KEY)')
+
+    def update(self, dataset):
+        """Folds the new and changed partitions of a dataset into the aggregates and drops the removed ones.
+
+        Returns the number of games folded in and the number of games dropped.
+        """
+        current = dict()
+        for game_id, path in partitions(dataset):
+            stat = os.stat(path)
+            current[game_id] = (path, f'{stat.st_size}-{stat.st_mtime_ns}')
+        known = dict(self._conn.execute('SELECT game_id, signature FROM sources'))
+        removed = [game_id for game_id in known if game_id not in current]
+        changed = [(game_id, path, signature) for game_id, (path, signature) in current.items()
+                   if known.get(game_id) != signature]
+        # every game is updated in its own transaction, an interrupted update is resumed from the next game
+        for game_id in removed:
+            with self._conn:
+                self._remove(game_id)
+                self._conn.execute('DELETE FROM sources WHERE game_id = ?', (game_id,))
+        for game_id, path, signature in tqdm(changed):
+            reviews = read_partition(path, ['game_title', 'username', 'recommended', 'time_played'])
+            with self._conn:
+                self._remove(game_id)
+                self._add(game_id, reviews)
+                self._conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?)', (game_id, signature))
+        return len(changed), len(removed)
+
+    def _remove(self, game_id):
+        self._conn.execute('UPDATE users SET games = users.games - ug.reviews, '
+                           'time_played = users.time_played - ug.time_played '
+                           'FROM user_games AS ug WHERE ug.game_id = ? AND users.username = ug.username', (game_id,))
+        self._conn.execute('DELETE FROM users WHERE games <= 0 AND username IN '
+                           '(SELECT username FROM user_games WHERE game_id = ?)', (game_id,))
+        self._conn.execute('DELETE FROM user_games WHERE game_id = ?', (game_id,))
+        self._conn.execute('DELETE FROM games WHERE game_id = ?', (game_id,))
+
+    def _add(self, game_id, reviews):
+        if len(reviews) == 0:
+            return
+        time = (reviews['time_played'].fillna(0) * 10).round().astype('int64')
+        recommended = (reviews['recommended'] == 1).to_numpy()
+        partial = time.groupby(reviews['username'], sort=False, dropna=False).agg(['size', 'sum'])
+        rows = [(str(username), int(count), int(total))
+                for username, count, total in zip(partial.index, partial['size'], partial['sum'])]
+        self._conn.executemany('INSERT INTO user_games VALUES (?, ?, ?, ?)', ((game_id,) + row for row in rows))
+        self._conn.executemany('INSERT INTO users VALUES (?, ?, ?) ON CONFLICT (username) DO UPDATE SET '
+                               'games = games + excluded.games, time_played = time_played + excluded.time_played',
+                               rows)
+        self._conn.execute('INSERT INTO games VALUES (?, ?, ?, ?, ?, ?)',
+                           (game_id, reviews['game_title'].iloc[-1], len(reviews), int(recommended.sum()),
+                            int(time.sum()), bool(recommended[0])))
+
+    def select(self, game_ids=None):
+        """Restricts the stats to the given games, all games when None."""
+        with self._conn:
+            self._conn.execute('DELETE FROM selected')
+            if game_ids is not None:
+                self._conn.executemany('INSERT INTO selected VALUES (?)', ((int(game_id),) for game_id in game_ids))
+        self._selected = game_ids is not None
+
+    def _where(self):
+        return ' WHERE game_id IN (SELECT game_id FROM selected)' if self._selected else ''
+
+    def summary(self):
+        games, reviews, time = self._conn.execute('SELECT COUNT(*), TOTAL(reviews), TOTAL(time_played) FROM games'
+                                                  + self._where()).fetchone()
+        if self._selected:
+            users = self._conn.execute('SELECT COUNT(DISTINCT username) FROM user_games'
+                                       + self._where()).fetchone()[0]
+        else:
+            users = self._conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        return {'reviews': int(reviews),
+                'hours': time / 10,
+                'users': users,
+                'games': games}
+
+    def user_items(self):
+        if self._selected:
+            query = ('SELECT ug.username, SUM(ug.reviews), SUM(ug.time_played) FROM user_games AS ug '
+                     'JOIN users AS u ON u.username = ug.username '
+                     'WHERE ug.game_id IN (SELECT game_id FROM selected) GROUP BY ug.username ORDER BY MIN(u.rowid)')
+        else:
+            query = 'SELECT username, games, time_played FROM users ORDER BY rowid'
+        for username, games, time in self._conn.execute(query):
+            yield username, [('games', float(games)), ('time_played', time / 10)]
+
+    def game_items(self):
+        for game_id, title, reviews, recommended, time, first_recommended in self._conn.execute(
+                'SELECT game_id, title, reviews, recommended, time_played, first_recommended FROM games'
+                + self._where() + ' ORDER BY game_id'):
+            yield str(game_id), game_fields(title, reviews, recommended, time / 10, first_recommended)
+
+    def write(self, output_dir):
+        write_stats(self, output_dir)
+
+    def close(self):
+        self._conn.close()
+
+
+def game_fields(title, reviews, recommended, time, first_recommended):
+    # the fields of a game in games.json, in the order a row by row loop over the reviews creates them
+    reviews = float(reviews)
+    counts = [('recommended', float(recommended)), ('not_recommended', reviews - float(recommended))]
+    if not first_recommended:
+        counts.reverse()
+    fields = [('users', reviews), ('title', title), ('reviews', reviews), counts[0], ('time_played', time)]
+    if counts[1][1] > 0:
+        fields.append(counts[1])
+    return fields
+
+
+def write_stats(stats, output_dir):
+    with open(output_dir + '/summary.json', mode='w', encoding="utf-8") as f:
+        json.dump(stats.summary(), f, indent=4)
+    with open(output_dir + '/users.json', mode='w', encoding="utf-8") as f:
+        dump_items(stats.user_items(), f)
+    with open(output_dir + '/games.json', mode='w', encoding="utf-8") as f:
+        dump_items(stats.game_items(), f)
+
+
+def json_value(value):
+    if isinstance(value, float) and math.isfinite(value):
+        return float.__repr__(value)
+    return json.dumps(value)
+
+
+def dump_items(items, f):
+    """Writes a mapping of objects as json.dump(..., indent=4) does, without building it in memory."""
+    f.write('{')
+    separator = '\n'
+    for key, fields in items:
+        f.write(f'{separator}    {json.dumps(key)}: {{')
+        f.write(','.join(f'\n        {json.dumps(name)}: {json_value(value)}' for name, value in fields))
+        f.write('\n    }')
+        separator = ',\n'
+    f.write('\n}' if separator != '\n' else '}')
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import random
+import re
+import socket
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from time import monotonic, sleep
+
+REVIEW_TEMPLATE = '''<div class="review_box">
+<div class="leftcol"><div class="persona_name"><a href="https://steamcommunity.com/profiles/{steamid}/">{steamid}</a></div>
+<div class="num_owned_games"><a href="#">{owned} products in account</a></div>
+<div class="num_reviews"><a href="#">{numrev} reviews</a></div></div>
+<div class="rightcol"><div class="vote_header"><div class="title ellipsis">{recommended}</div>
+<div class="hours ellipsis">{hours:.1f} hrs on record</div></div>
+<div class="postedDate">Posted: {posted}</div>
+<div class="content">{text}</div>
+<div class="vote_info">{helpful} people found this review helpful<br>{funny} people found this review funny</div>
+</div></div>
+'''
+
+SEARCH_TEMPLATE = '''<a href="https://store.steampowered.com/{package_type}/{id}/Game_{id}/?snr=1_7_7_230_150_1" data-ds-appid="{id}" class="search_result_row ds_collapse_flag" >
+<div class="col search_capsule"><img src="https://cdn.akamai.steamstatic.com/steam/apps/{id}/capsule_sm_120.jpg"></div>
+<div class="responsive_search_name_combined"><div class="col search_name ellipsis"><span class="title">{title}</span></div>
+<div class="col search_released responsive_secondrow">{released}</div></div></a>
+'''
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+          'November', 'December']
+
+WORDS = ['game', 'fun', 'great', 'boring', 'story', 'graphics', 'bugs', 'hours', 'friends', 'price', 'worth', 'not',
+         'really', 'good', 'bad', 'the', 'a', 'is', 'and', 'of']
+
+MAX_PER_PAGE = 100
+
+# results of a page of the search html, and max results of a request to the infinite scroll json of the search
+SEARCH_PER_PAGE = 25
+MAX_SEARCH_COUNT = 100
+
+appreviewsre = re.compile(r'^/+appreviews/([0-9]+)$')
+searchre = re.compile(r'^/+search/results/?$')
+cursorre = re.compile(r'^AoJ([0-9]+)\+')
+
+
+def make_cursor(game_id, offset):
+    # real cursors contain characters that must be quoted in the url
+    return f'AoJ{offset}+{game_id}/w=='
+
+
+def make_review(game_id, index):
+    """Returns a review in the format of the json output of appreviews.
+
+    Reviews with negative index are the ones added after the start of the
+    server, see --new.
+    """
+    rng = random.Random(f'{game_id}-{index}')
+    created = rng.randrange(1262304000, 1514764800)
+    return {'recommendationid': str(rng.randrange(10 ** 8, 10 ** 9)),
+            'author': {'steamid': str(76561197960265728 + rng.randrange(10 ** 9)),
+                       'num_games_owned': rng.randrange(1, 2000),
+                       'num_reviews': rng.randrange(1, 100),
+                       'playtime_forever': rng.randrange(6, 120000),
+                       'playtime_last_two_weeks': 0,
+                       'last_played': created},
+            'language': 'english',
+            'review': ' '.join(rng.choice(WORDS) for _ in range(rng.randrange(5, 60))),
+            'timestamp_created': created,
+            'timestamp_updated': created,
+            'voted_up': rng.random() < 0.7,
+            'votes_up': rng.randrange(0, 50),
+            'votes_funny': rng.randrange(0, 10),
+            'weighted_vote_score': '0',
+            'comment_count': 0,
+            'steam_purchase': True,
+            'received_for_free': False,
+            'written_during_early_access': False}
+
+
+def review_html(review):
+    posted = datetime.datetime.fromtimestamp(review['timestamp_created'], datetime.timezone.utc)
+    return REVIEW_TEMPLATE.format(steamid=review['author']['steamid'], owned=review['author']['num_games_owned'],
+                                  numrev=review['author']['num_reviews'],
+                                  recommended='Recommended' if review['voted_up'] else 'Not Recommended',
+                                  hours=review['author']['playtime_forever'] / 60,
+                                  posted=f'{MONTHS[posted.month - 1]} {posted.day}, {posted.year}',
+                                  text=review['review'], helpful=review['votes_up'], funny=review['votes_funny'])
+
+
+def search_game(index):
+    # every twentieth result is a bundle, ids are those of the games of a games.csv extracted from the listing
+    game_id = 10 * (index + 1)
+    package_type = 'bundle' if index % 20 == 19 else 'app'
+    return package_type, game_id, f'Game {game_id}'
+
+
+def search_result(index):
+    package_type, game_id, title = search_game(index)
+    released = datetime.date(2010, 1, 1) + datetime.timedelta(days=index)
+    return SEARCH_TEMPLATE.format(package_type=package_type, id=game_id, title=title,
+                                  released=f'{released.day} {MONTHS[released.month - 1][:3]}, {released.year}')
+
+
+def search_page(page, total):
+    """Returns the html of a page of the search listing, pages are numbered from 1."""
+    start = max(page - 1, 0) * SEARCH_PER_PAGE
+    end = min(start + SEARCH_PER_PAGE, total)
+    html = ''.join(search_result(index) for index in range(start, end))
+    if start < end:
+        html += f'<div class="search_pagination_left">showing {start + 1} - {end} of {total}</div>'
+    return f'<html><body><div id="search_resultsRows">{html}</div></body></html>'
+
+
+def game_pages(game_id, pages):
+    # a deterministic number of pages in [0, pages] for every game
+    return random.Random(int(game_id)).randrange(pages + 1)
+
+
+def review_count(game_id, pages, reviews, new=0):
+    return game_pages(game_id, pages) * reviews + new
+
+
+def appreviews_page(game_id, offset, count, per_page, structured=False, overlap=0, new=0, first=False):
+    """Returns the json of the appreviews page of a game with count reviews, starting at offset.
+
+    first marks the request without a cursor, the only one whose summary
+    has the total number of reviews.
+    """
+    start = offset
+    if 0 < offset < count:
+        # pages repeat the last reviews of the previous page, as when new reviews shift the cursor
+        start = max(offset - min(overlap, per_page - 1), 0)
+    reviews = [make_review(game_id, index - new) for index in range(start, min(start + per_page, count))]
+    if structured:
+        body = {'success': 1, 'query_summary': {'num_reviews': len(reviews)}, 'reviews': reviews,
+                'cursor': make_cursor(game_id, start + len(reviews))}
+        if first:
+            body['query_summary']['total_reviews'] = count
+        return body
+    if reviews:
+        html = ''.join(review_html(review) for review in reviews)
+    else:
+        html = '<div id="no_more_reviews">No more reviews</div>'
+    return {'success': 1, 'html': html, 'cursor': make_cursor(game_id, start + len(reviews))}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # headers and body are sent with separate writes, don't let Nagle delay the body
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, body, content_type='application/json; charset=utf-8', status=200):
+        # the content is its own version: conditional requests with its ETag are answered with 304
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if status == 200:
+            self.send_header('ETag', etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def throttle(self):
+        # requests above threshold in the last second get a 429
+        if not self.server.threshold:
+            return False
+        with self.server.lock:
+            now = monotonic()
+            window = self.server.window
+            while window and window[0] < now - 1:
+                window.popleft()
+            window.append(now)
+            if len(window) <= self.server.threshold:
+                return False
+            self.server.throttled += 1
+        self.send_response(429)
+        self.send_header('Retry-After', str(self.server.retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return True
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.throttle():
+            return
+        if self.server.latency:
+            sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        m = appreviewsre.match(url.path)
+        if m:
+            self.appreviews(m.group(1), query)
+        elif searchre.match(url.path):
+            self.search(query)
+        else:
+            self.send_body(b'Not found', 'text/plain', status=404)
+
+    def appreviews(self, game_id, query):
+        cursor = query.get('cursor', ['*'])[0]
+        if cursor == '*':
+            offset = 0
+        else:
+            m = cursorre.match(cursor)
+            if not m:
+                self.send_body(json.dumps({'success': 2}).encode())
+                return
+            offset = int(m.group(1))
+        count = review_count(game_id, self.server.pages, self.server.reviews, self.server.new)
+        structured = query.get('json', ['0'])[0] == '1'
+        if structured:
+            per_page = min(int(query.get('num_per_page', ['20'])[0]), MAX_PER_PAGE)
+        else:
+            per_page = self.server.reviews
+        body = appreviews_page(game_id, offset, count, per_page, structured, self.server.overlap, self.server.new,
+                               cursor == '*')
+        self.send_body(json.dumps(body).encode())
+
+    def search(self, query):
+        total = self.server.games
+        if query.get('infinite', ['0'])[0] == '1':
+            start = int(query.get('start', ['0'])[0])
+            count = min(int(query.get('count', ['50'])[0]), MAX_SEARCH_COUNT)
+            html = ''.join(search_result(index) for index in range(start, min(start + count, total)))
+            body = {'success': 1, 'results_html': html, 'total_count': total, 'start': start}
+            self.send_body(json.dumps(body).encode())
+            return
+        # pages are numbered from 1, page 0 is the same of page 1
+        self.send_body(search_page(int(query.get('page', ['1'])[0]), total).encode(), 'text/html; charset=utf-8')
+
+
+def make_server(host='127.0.0.1', port=0, pages=10, reviews=20, latency=0.0, threshold=None, retry_after=1,
+                new=0, verbose=False, games=1000, overlap=0):
+    """Returns a stub of the Steam store serving fake appreviews cursor chains and a search listing.
+
+    Every game has a deterministic number of pages between 0 and pages, each
+    with reviews review boxes, preceded by new more recent reviews. Pages
+    after the first repeat the last overlap reviews of the previous page. The
+    search results list games games. When more than threshold requests
+    arrive in a second, the server answers 429 with a Retry-After of
+    retry_after seconds.
+    Responses carry an ETag, conditional requests for unchanged content are
+    answered with 304.
+    Use port 0 to bind a free port, the actual address is in
+    server.server_address.
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.pages = pages
+    server.reviews = reviews
+    server.latency = latency
+    server.new = new
+    server.games = games
+    server.overlap = overlap
+    server.threshold = threshold
+    server.retry_after = retry_after
+    server.window = deque()
+    server.verbose = verbose
+    server.requests = 0
+    server.throttled = 0
+    server.not_modified = 0
+    server.lock = threading.Lock()
+    return server
+
+
+def start_server(**kwargs):
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stub of the Steam store, for testing the crawlers')
+    parser.add_argument(
+        '--host', help='Address to bind. Default: 127.0.0.1', required=False, default='127.0.0.1')
+    parser.add_argument(
+        '--port', help='Port to bind. Default: 8080', required=False, type=int, default=8080)
+    parser.add_argument(
+        '--pages', help='Maximum number of review pages per game. Default: 10', required=False, type=int,
+        default=10)
+    parser.add_argument(
+        '--reviews', help='Number of reviews per page. Default: 20', required=False, type=int, default=20)
+    parser.add_argument(
+        '--new', help='Number of reviews added to every game, as if posted after a first crawl. Default: 0',
+        required=False, type=int, default=0)
+    parser.add_argument(
+        '--overlap', help='Number of reviews of a page repeated at the start of the next page. Default: 0',
+        required=False, type=int, default=0)
+    parser.add_argument(
+        '--games', help='Number of games in the search results. Default: 1000', required=False, type=int,
+        default=1000)
+    parser.add_argument(
+        '--latency', help='Seconds to wait before answering each request. Default: 0', required=False,
+        type=float, default=0.0)
+    parser.add_argument(
+        '--threshold', help='Requests per second above which requests are throttled with 429. Default: no limit',
+        required=False, type=int)
+    parser.add_argument(
+        '--retryafter', help='Retry-After seconds sent with throttled responses. Default: 1', required=False,
+        type=int, default=1)
+    parser.add_argument('-v', '--verbose', help='Log every request', required=False, action='store_true')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.pages, args.reviews, args.latency, args.threshold,
+                         args.retryafter, args.new, args.verbose, args.games, args.overlap)
+    print(f'Serving on http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import json
+import threading
+from contextlib import contextmanager
+from time import monotonic, perf_counter
+
+from steam_checkpoint import atomic_write
+
+# upper bounds, in seconds, of the buckets of latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROMETHEUS_PREFIX = 'steam_'
+
+# counter of the seconds spent in each stage of the extraction, labelled by stage
+STAGE_SECONDS = 'extract_stage_seconds_total'
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile interpolating within its bucket, as Prometheus' histogram_quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+    def merge(self, data):
+        for i, count in enumerate(data['counts']):
+            self.counts[i] += count
+        self.sum += data['sum']
+        self.count += data['count']
+
+
+def label_key(labels):
+    # label values are kept as strings, so that keys with values of different types can be sorted
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def metric_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """Counters and histograms of a run, updated from any thread.
+
+    Metrics are identified by a name and optional labels. They can be
+    exported periodically to a file, as json or, for files ending in .prom,
+    in the Prometheus text format. Snapshots of metrics collected in other
+    processes can be merged.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._histograms = dict()
+        self._start = monotonic()
+        self._stop = threading.Event()
+        self._exporter = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Adds the seconds spent in the block to the counter name."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.inc(name, perf_counter() - start, **labels)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, label_key(labels)), 0)
+
+    def elapsed(self):
+        return monotonic() - self._start
+
+    def reset(self):
+        with self._lock:
+            self._counters = dict()
+            self._histograms = dict()
+            self._start = monotonic()
+
+    def snapshot(self):
+        """Returns the metrics as plain data, that can be pickled and merged into other Metrics."""
+        with self._lock:
+            return {'counters': [(name, labels, value) for (name, labels), value in self._counters.items()],
+                    'histograms': [(name, labels, histogram.to_dict())
+                                   for (name, labels), histogram in self._histograms.items()]}
+
+    def merge(self, snapshot):
+        with self._lock:
+            for name, labels, value in snapshot['counters']:
+                self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+            for name, labels, data in snapshot['histograms']:
+                histogram = self._histograms.get((name, labels))
+                if histogram is None:
+                    histogram = self._histograms[(name, labels)] = Histogram(data['buckets'])
+                histogram.merge(data)
+
+    def to_json(self):
+        snapshot = self.snapshot()
+        return json.dumps({'elapsed': self.elapsed(),
+                           'counters': {metric_name(name, labels): value
+                                        for name, labels, value in snapshot['counters']},
+                           'histograms': {metric_name(name, labels): data
+                                          for name, labels, data in snapshot['histograms']}}, indent=4)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = [f'{PROMETHEUS_PREFIX}elapsed_seconds {self.elapsed()}']
+        for name, labels, value in sorted(snapshot['counters']):
+            lines.append(f'{metric_name(PROMETHEUS_PREFIX + name, labels)} {value}')
+        for name, labels, data in sorted(snapshot['histograms'], key=lambda item: item[:2]):
+            cumulative = 0
+            for bound, count in zip(data['buckets'] + ['+Inf'], data['counts']):
+                cumulative += count
+                lines.append(f'{metric_name(PROMETHEUS_PREFIX + name + "_bucket", labels + (("le", bound),))} '
+                             f'{cumulative}')
+            lines.append(f'{metric_name(PROMETHEUS_PREFIX + name + "_sum", labels)} {data["sum"]}')
+            lines.append(f'{metric_name(PROMETHEUS_PREFIX + name + "_count", labels)} {data["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        atomic_write(path, self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+    def start_export(self, path, interval=10.0):
+        """Writes the metrics to path every interval seconds, and once more on stop_export."""
+        self._stop.clear()
+        self._exporter = threading.Thread(target=self._export, args=(path, interval), daemon=True)
+        self._exporter.start()
+
+    def _export(self, path, interval):
+        while not self._stop.wait(interval):
+            self.write(path)
+        self.write(path)
+
+    def stop_export(self):
+        if self._exporter:
+            self._stop.set()
+            self._exporter.join()
+            self._exporter = None
+
+    def summary(self):
+        """Returns a human readable summary of the metrics, with the rate of the counters.
+
+        Seconds counters are compared to the elapsed time; they are summed over
+        parallel workers, so they can exceed it.
+        """
+        snapshot = self.snapshot()
+        elapsed = self.elapsed()
+        lines = [f'elapsed {elapsed:.1f} s']
+        for name, labels, value in sorted(snapshot['counters']):
+            line = f'{metric_name(name, labels)} {value:.6g}'
+            if name.endswith('_seconds_total'):
+                line += f' ({100 * value / elapsed:.1f}% of elapsed time)' if elapsed else ''
+            elif elapsed:
+                line += f' ({value / elapsed:.1f}/s)'
+            lines.append(line)
+        for name, labels, data in sorted(snapshot['histograms'], key=lambda item: item[:2]):
+            histogram = Histogram(data['buckets'])
+            histogram.merge(data)
+            if not histogram.count:
+                continue
+            lines.append(f'{metric_name(name, labels)} count {histogram.count}, '
+                         f'mean {1000 * histogram.sum / histogram.count:.1f} ms, '
+                         f'p50 {1000 * histogram.quantile(0.5):.1f} ms, p90 {1000 * histogram.quantile(0.9):.1f} ms, '
+                         f'p99 {1000 * histogram.quantile(0.99):.1f} ms')
+        return '\n'.join(lines)
+
+
+# the metrics of the running script
+metrics = Metrics()
+
+
+def add_metrics_arguments(parser):
+    """Adds to an argparse parser the options of the periodic export of the metrics, see Metrics.start_export."""
+    parser.add_argument(
+        '--metrics', help='File to which the metrics are periodically written, in the Prometheus text format if it '
+                          'ends in .prom, as json otherwise', required=False)
+    parser.add_argument(
+        '--metricsinterval', help='Seconds between two writes of the metrics file. Default: 10', required=False,
+        type=float, default=10)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from time import time
+
+# seconds a leased game is reserved to a crawler without a heartbeat
+LEASE_TIME = 300
+
+# leases of a game whose crawl fails, after which it is marked failed and no longer leased
+MAX_ATTEMPTS = 3
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class LeaseLost(Exception):
+    """The lease of a game expired and the game may have been leased by another crawler."""
+
+
+class WorkQueue:
+    """Queue of games shared by crawlers running in several processes or on several nodes, saved in sqlite.
+
+    A crawler leases a game for lease seconds, and a heartbeat thread renews
+    the leases it holds while it works on them. Finished games are marked
+    done. When a crawler dies its leases expire and the games are leased
+    again by the other crawlers, that resume them from their checkpoint.
+    A game whose crawl fails is leased again, until it fails max_attempts
+    times and is marked failed. A crawler whose lease expired (e.g., its
+    heartbeat stalled) must stop writing the files of the game, see owns.
+    Leases expire on wall clock time, so the clocks of the nodes must be
+    roughly in sync (well within the lease time).
+    """
+
+    def __init__(self, dbfile, owner=None, lease=LEASE_TIME, max_attempts=MAX_ATTEMPTS):
+        self.owner = owner or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.lease_time = lease
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        # the games leased by this crawler and not yet finished
+        self._held = set()
+        # transactions are explicit, the rollback journal (unlike WAL) works on shared network file systems
+        self._conn = sqlite3.connect(dbfile, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tasks (package_type TEXT, game_id INTEGER, game_title TEXT, '
+                           'position INTEGER, state TEXT, owner TEXT, expires REAL, attempts INTEGER, '
+                           'PRIMARY KEY (package_type, game_id))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, position)')
+
+    def _transaction(self, statements):
+        # BEGIN IMMEDIATE takes the write lock before reading, so two crawlers never lease the same game
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements()
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return result
+
+    def add(self, games):
+        """Adds the (package_type, game_id, game_title) games not already in the queue, after the others."""
+        def statements():
+            position = self._conn.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM tasks').fetchone()[0]
+            self._conn.executemany('INSERT OR IGNORE INTO tasks VALUES (?, ?, ?, ?, ?, NULL, NULL, 0)',
+                                   ((package_type, int(game_id), game_title, position + i, PENDING)
+                                    for i, (package_type, game_id, game_title) in enumerate(games)))
+        self._transaction(statements)
+
+    def lease(self):
+        """Leases the first pending game, or the first game whose lease has expired.
+
+        Returns its (package_type, game_id, game_title), None when no game is available.
+        """
+        def statements():
+            now = time()
+            row = self._conn.execute('SELECT package_type, game_id, game_title FROM tasks WHERE state = ? OR '
+                                     '(state = ? AND expires < ?) ORDER BY position LIMIT 1',
+                                     (PENDING, LEASED, now)).fetchone()
+            if row:
+                self._conn.execute('UPDATE tasks SET state = ?, owner = ?, expires = ?, attempts = attempts + 1 '
+                                   'WHERE package_type = ? AND game_id = ?',
+                                   (LEASED, self.owner, now + self.lease_time, row[0], row[1]))
+                self._held.add((row[0], row[1]))
+            return row
+        return self._transaction(statements)
+
+    def renew(self):
+        """Extends all the leases held by this crawler. Returns the (package_type, game_id) of the leases lost.
+
+        A lease is lost when it expired and the game was leased by another
+        crawler; the lost games are no longer held.
+        """
+        def statements():
+            renewed = self._conn.execute('UPDATE tasks SET expires = ? WHERE state = ? AND owner = ?',
+                                         (time() + self.lease_time, LEASED, self.owner)).rowcount
+            if renewed == len(self._held):
+                return set()
+            owned = set(self._conn.execute('SELECT package_type, game_id FROM tasks WHERE state = ? AND owner = ?',
+                                           (LEASED, self.owner)))
+            lost = self._held - owned
+            self._held -= lost
+            return lost
+        return self._transaction(statements)
+
+    def owns(self, package_type, game_id):
+        """Returns whether this crawler still holds an unexpired lease of the game."""
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM tasks WHERE package_type = ? AND game_id = ? AND state = ? AND '
+                                     'owner = ? AND expires > ?',
+                                     (package_type, int(game_id), LEASED, self.owner, time())).fetchone()
+        return row is not None
+
+    def done(self, package_type, game_id):
+        self._finish(package_type, game_id, DONE)
+
+    def release(self, package_type, game_id):
+        """Gives back a leased game that could not be completed, so that it can be leased again."""
+        self._finish(package_type, game_id, PENDING)
+
+    def fail(self, package_type, game_id):
+        """Gives back a leased game whose crawl failed, marking it failed after max_attempts leases."""
+        self._finish(package_type, game_id, PENDING, failed=True)
+
+    def _finish(self, package_type, game_id, state, failed=False):
+        def statements():
+            self._conn.execute('UPDATE tasks SET state = ?, owner = NULL, expires = NULL '
+                               'WHERE package_type = ? AND game_id = ? AND owner = ?',
+                               (state, package_type, int(game_id), self.owner))
+            self._held.discard((package_type, int(game_id)))
+            if failed:
+                self._conn.execute('UPDATE tasks SET state = ? WHERE package_type = ? AND game_id = ? AND '
+                                   'state = ? AND attempts >= ?',
+                                   (FAILED, package_type, int(game_id), PENDING, self.max_attempts))
+        self._transaction(statements)
+
+    def counts(self):
+        """Returns the number of games in each state."""
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state'))
+        return {state: counts.get(state, 0) for state in (PENDING, LEASED, DONE, FAILED)}
+
+    def start_heartbeat(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew_leases, daemon=True)
+        self._heartbeat.start()
+
+    def _renew_leases(self):
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                lost = self.renew()
+                if lost:
+                    # their crawls stop at the next page, see owns
+                    print('Leases lost: ' + ', '.join(f'{package_type} {game_id}' for package_type, game_id in lost))
+            except sqlite3.OperationalError as e:
+                # a busy or unreachable database, the next heartbeat tries again before the leases expire
+                print('Error renewing leases', e)
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def close(self):
+        self.stop_heartbeat()
+        self._conn.close()
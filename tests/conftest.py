@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib
+import os
+import sys
+
+import pytest
+
+# the scripts and the modules are in the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from steam_catalog import GameCatalog  # noqa: E402
+from steam_corpus import write_corpus  # noqa: E402
+
+
+def script(name):
+    # the scripts have hyphens in their names, they can be imported only by name
+    return importlib.import_module(name)
+
+
+@pytest.fixture(scope='session')
+def corpus(tmp_path_factory):
+    """A small synthetic corpus of crawled pages, see steam_corpus.py."""
+    path = str(tmp_path_factory.mktemp('corpus'))
+    write_corpus(path, games=60, pages=4, reviews=5)
+    return path
+
+
+@pytest.fixture(scope='session')
+def reviews_csv(corpus, tmp_path_factory):
+    """The reviews.csv extracted from the corpus."""
+    outputfile_name = str(tmp_path_factory.mktemp('reviews') / 'reviews.csv')
+    catalog = GameCatalog(os.path.join(corpus, 'games.csv'))
+    script('steam-review-extractor').extract_reviews(os.path.join(corpus, 'pages', 'reviews', 'all'),
+                                                     outputfile_name, catalog, None, 1, 'bs4', force=True)
+    catalog.close()
+    return outputfile_name
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import os
+
+from steam_catalog import GameCatalog
+
+
+def write_games(path, games):
+    with open(path, mode='w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['package_type', 'game_id', 'game_title'])
+        writer.writerows(games)
+
+
+def test_rebuilt_catalog_replaces_the_open_one(tmp_path):
+    path = str(tmp_path / 'games.csv')
+    write_games(path, [('app', 10, 'Game 10'), ('bundle', 20, 'Bundle 20'), ('app', 10, 'Again 10')])
+    old = GameCatalog(path)
+    assert old.games() == [('app', 10, 'Game 10'), ('bundle', 20, 'Bundle 20')]
+
+    write_games(path, [('app', 30, 'Game 30'), ('app', 10, 'New 10')])
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 1))
+    new = GameCatalog(path)
+    # the catalog opened before the rebuild keeps reading the old index
+    assert old.title(10) == 'Game 10'
+    assert len(old) == 2
+    assert new.games() == [('app', 30, 'Game 30'), ('app', 10, 'New 10')]
+    assert new.app_ids('^New') == {10}
+    old.close()
+    new.close()
+    assert sorted(os.listdir(str(tmp_path))) == ['games.csv', 'games.sqlite']
+    reopened = GameCatalog(path)
+    assert reopened.title(30) == 'Game 30'
+    reopened.close()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import zipfile
+
+import pytest
+
+from conftest import script
+from steam_archive import TAIL_OFFSET, PageArchive, append_pages, restore_tail, scan_entries
+from steam_checkpoint import load_checkpoint, load_state
+from steam_reviewpages import page_size
+from steam_stub_server import start_server
+
+# game 30 has 8 * 20 reviews in the stub, each page after the first repeats 3 reviews of the previous one
+GAME = ('app', '30', 'Game 30')
+PAGES = 8
+REVIEWS = 20
+
+
+class StopAfter:
+    """Stands for the Event of a parallel crawl, it is set after pages pages are requested."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def is_set(self):
+        self.pages -= 1
+        return self.pages < 0
+
+
+@pytest.fixture(scope='module')
+def baseurl():
+    server = start_server(pages=PAGES, reviews=REVIEWS, overlap=3)
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+def crawl(out, baseurl, structured=False, maxreviews=-1, stop=None, refresh=False):
+    dir, id_, name = GAME
+    return script('steam-review-crawler').crawlgamereviews(dir, id_, name, 'english', 10, 3, 0, str(out), baseurl,
+                                                           refresh=refresh, structured=structured,
+                                                           maxreviews=maxreviews, stop=stop)
+
+
+def gamedir(out):
+    return os.path.join(str(out), 'pages', 'reviews', 'english', '-'.join(GAME[:2]))
+
+
+def pages(out):
+    with zipfile.ZipFile(os.path.join(gamedir(out), 'reviews.zip')) as zipf:
+        return {name: zipf.read(name) for name in zipf.namelist()}
+
+
+def test_resumed_crawl_is_identical_to_an_uninterrupted_one(baseurl, tmp_path):
+    assert crawl(tmp_path / 'complete', baseurl)
+    with pytest.raises(script('steam-review-crawler').CrawlStopped):
+        crawl(tmp_path / 'resumed', baseurl, stop=StopAfter(3))
+    assert load_checkpoint(gamedir(tmp_path / 'resumed'))['page'] == 4
+    assert crawl(tmp_path / 'resumed', baseurl)
+
+    complete = pages(tmp_path / 'complete')
+    # repeated reviews are dropped, the stub has PAGES * REVIEWS distinct ones
+    assert sum(page_size(json.loads(page)) for page in complete.values()) == PAGES * REVIEWS
+    assert pages(tmp_path / 'resumed') == complete
+    assert load_state(gamedir(tmp_path / 'resumed'))['head'] == load_state(gamedir(tmp_path / 'complete'))['head']
+    assert load_checkpoint(gamedir(tmp_path / 'resumed')) is None
+
+
+def test_crawl_killed_while_writing_a_page_is_resumed(baseurl, tmp_path):
+    assert crawl(tmp_path / 'complete', baseurl)
+    with pytest.raises(script('steam-review-crawler').CrawlStopped):
+        crawl(tmp_path / 'killed', baseurl, stop=StopAfter(5))
+    # a kill leaves no central directory, and the page being written is cut short
+    partpath = os.path.join(gamedir(tmp_path / 'killed'), 'reviews.zip.part')
+    size = load_checkpoint(gamedir(tmp_path / 'killed'))['size']
+    with open(partpath, 'r+b') as f:
+        f.seek(size)
+        f.write(b'PK\x03\x04' + bytes(40))
+        f.truncate()
+    assert crawl(tmp_path / 'killed', baseurl)
+
+    assert pages(tmp_path / 'killed') == pages(tmp_path / 'complete')
+
+
+class CrashAfter:
+    """Stands for the queue of pages of the pipeline, the crawl fails when it is given a page after pages pages."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def put(self, event):
+        if event[0] == 'page':
+            self.pages -= 1
+            if self.pages < 0:
+                raise RuntimeError('crash')
+
+
+def test_crawl_crashed_between_checkpoints_is_resumed(baseurl, tmp_path, monkeypatch):
+    crawler = script('steam-review-crawler')
+    monkeypatch.setattr(crawler, 'CHECKPOINT_PAGES', 3)
+    assert crawl(tmp_path / 'complete', baseurl)
+    dir, id_, name = GAME
+    with pytest.raises(RuntimeError):
+        crawler.crawlgamereviews(dir, id_, name, 'english', 10, 3, 0, str(tmp_path / 'crashed'), baseurl,
+                                 pages=CrashAfter(4))
+    # the pages after the last checkpoint are downloaded again, their reviews are not taken for repeats
+    assert load_checkpoint(gamedir(tmp_path / 'crashed'))['page'] == 4
+    assert crawl(tmp_path / 'crashed', baseurl)
+
+    assert pages(tmp_path / 'crashed') == pages(tmp_path / 'complete')
+
+
+def test_truncated_archive_entries_are_recovered(tmp_path):
+    path = str(tmp_path / 'reviews.zip')
+    archive = PageArchive(path)
+    for page in range(1, 4):
+        archive.write(f'reviews-{page}.html', f'page {page} ' * 1000)
+    size = archive.size
+    archive.write('reviews-4.html', 'page 4 ' * 1000)
+    archive.detach()
+    # the last entry is cut in the middle of its data
+    with open(path + '.part', 'r+b') as f:
+        f.truncate(size + (os.path.getsize(path + '.part') - size) // 2)
+
+    with open(path + '.part', 'rb') as f:
+        entries, offset = scan_entries(f, os.path.getsize(path + '.part'))
+    assert [info.filename for info in entries] == [f'reviews-{page}.html' for page in range(1, 4)]
+    assert offset == size
+
+    archive = PageArchive(path, size)
+    archive.write('reviews-4.html', 'page 4')
+    archive.close()
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.testzip() is None
+        assert [zipf.read(f'reviews-{page}.html').decode() for page in range(1, 4)] == \
+               [f'page {page} ' * 1000 for page in range(1, 4)]
+        assert zipf.read('reviews-4.html') == b'page 4'
+    assert not os.path.exists(path + '.part')
+
+
+@pytest.mark.parametrize('structured', [False, True], ids=['html', 'json'])
+@pytest.mark.parametrize('maxreviews', [33, REVIEWS, 1])
+def test_maxreviews_is_exact(baseurl, tmp_path, structured, maxreviews):
+    assert crawl(tmp_path, baseurl, structured=structured, maxreviews=maxreviews)
+    assert sum(page_size(json.loads(page)) for page in pages(tmp_path).values()) == maxreviews
+
+
+@pytest.mark.parametrize('structured', [False, True], ids=['html', 'json'])
+def test_refresh_appends_the_new_reviews(baseurl, tmp_path, structured):
+    assert crawl(tmp_path, baseurl, structured=structured)
+    crawled = pages(tmp_path)
+    server = start_server(pages=PAGES, reviews=REVIEWS, overlap=3, new=5)
+    try:
+        assert crawl(tmp_path, f'http://127.0.0.1:{server.server_address[1]}', structured=structured, refresh=True)
+    finally:
+        server.shutdown()
+
+    refreshed = pages(tmp_path)
+    added = {name: page for name, page in refreshed.items() if name not in crawled}
+    assert {name: refreshed[name] for name in crawled} == crawled
+    assert [name.startswith('refresh-') for name in added] == [True]
+    assert sum(page_size(json.loads(page)) for page in added.values()) == 5
+    assert not os.path.exists(os.path.join(gamedir(tmp_path), 'reviews.zip.tail'))
+
+
+def test_interrupted_append_is_undone(tmp_path):
+    path = str(tmp_path / 'reviews.zip')
+    archive = PageArchive(path)
+    for page in range(1, 4):
+        archive.write(f'reviews-{page}.html', f'page {page} ' * 1000)
+    archive.close()
+    with open(path, 'rb') as f:
+        original = f.read()
+
+    append_pages(path, [('refresh-1.html', 'new ' * 1000), ('refresh-2.html', 'newer ' * 1000)])
+    with zipfile.ZipFile(path) as zipf:
+        assert zipf.testzip() is None
+        assert len(zipf.namelist()) == 5
+    assert not restore_tail(path)
+
+    # a crash while the new entries are written: the central directory is saved, the file ends in an entry
+    with zipfile.ZipFile(path) as zipf:
+        start = zipf.getinfo('refresh-1.html').header_offset
+    with open(path + '.tail', 'wb') as f:
+        f.write(TAIL_OFFSET.pack(start) + original[start:])
+    with open(path, 'r+b') as f:
+        f.truncate(start + 100)
+    assert restore_tail(path)
+    with open(path, 'rb') as f:
+        assert f.read() == original
+    assert not os.path.exists(path + '.tail')
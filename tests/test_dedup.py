@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from steam_dedup import FLUSH_SIZE, SeenKeys
+
+KEYS = [str(100000000 + 7 * i) for i in range(3 * FLUSH_SIZE)]
+
+# keys saved in the test of reopening, the following ones are not
+SAVED = FLUSH_SIZE + 10
+
+
+def test_filter_grows_with_the_keys():
+    seen = SeenKeys(capacity=100)
+    small = len(seen._bits)
+    assert all(seen.add(key) for key in KEYS)
+    assert not any(seen.add(key) for key in KEYS)
+    assert len(seen._bits) > len(KEYS) > 100 * small
+    assert not any(str(int(key) + 1) in seen for key in KEYS)
+    seen.close()
+
+
+def test_saved_keys_are_reopened(tmp_path):
+    path = str(tmp_path / 'seen.sqlite')
+    seen = SeenKeys(path, capacity=100)
+    seen.update(KEYS[:SAVED])
+    seen.flush()
+    # keys added after the last flush are not saved
+    seen.update(KEYS[SAVED:SAVED + 100])
+    seen.discard()
+    assert not any(key in seen for key in KEYS[SAVED:])
+    seen.close()
+
+    seen = SeenKeys(path, capacity=100)
+    assert all(key in seen for key in KEYS[:SAVED])
+    assert not any(key in seen for key in KEYS[SAVED:])
+    assert all(seen.add(key) for key in KEYS[SAVED:])
+    seen.delete()
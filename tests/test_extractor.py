@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from conftest import script
+from steam_catalog import GameCatalog
+
+
+def extract(corpus, outputfile_name, workers):
+    catalog = GameCatalog(os.path.join(corpus, 'games.csv'))
+    # force parses every archive, ignoring the rows cached by the other extraction
+    script('steam-review-extractor').extract_reviews(os.path.join(corpus, 'pages', 'reviews', 'all'),
+                                                     outputfile_name, catalog, None, workers, 'fast', force=True)
+    catalog.close()
+    with open(outputfile_name, mode='rb') as f:
+        return f.read()
+
+
+def test_parallel_output_is_identical_to_serial(corpus, tmp_path):
+    serial = extract(corpus, str(tmp_path / 'serial.csv'), 1)
+    parallel = extract(corpus, str(tmp_path / 'parallel.csv'), 3)
+    assert serial.count(b'\n') > 100
+    assert parallel == serial
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import threading
+
+import pytest
+
+from steam_http import HTTPClient
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\nok'
+
+
+class KeepAliveServer:
+    """Answers the first request of every connection and keeps it open, later requests get no answer.
+
+    With close, the connection is closed after the answer, as servers do
+    with idle connections.
+    """
+
+    def __init__(self, close):
+        self.close = close
+        self.requests = 0
+        self.connections = 0
+        self._socket = socket.create_server(('127.0.0.1', 0))
+        self.port = self._socket.getsockname()[1]
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._socket.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._answer, args=(conn,), daemon=True).start()
+
+    def _answer(self, conn):
+        with conn:
+            data = b''
+            while b'\r\n\r\n' not in data:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    return
+                data += chunk
+            self.requests += 1
+            conn.sendall(RESPONSE)
+            if self.close:
+                return
+            while conn.recv(4096):
+                self.requests += 1
+
+    def shutdown(self):
+        self._socket.close()
+
+
+def test_request_on_a_closed_idle_connection_is_sent_again():
+    server = KeepAliveServer(close=True)
+    client = HTTPClient()
+    try:
+        url = f'http://127.0.0.1:{server.port}/'
+        assert client.get(url, timeout=5).body == b'ok'
+        assert client.get(url, timeout=5).body == b'ok'
+    finally:
+        client.close()
+        server.shutdown()
+    assert server.connections == 2
+    assert client.stats()['requests'] == 2
+
+
+def test_timeout_on_a_reused_connection_is_not_retried():
+    server = KeepAliveServer(close=False)
+    client = HTTPClient()
+    try:
+        url = f'http://127.0.0.1:{server.port}/'
+        assert client.get(url, timeout=5).body == b'ok'
+        with pytest.raises(TimeoutError):
+            client.get(url, timeout=0.3)
+        # the connection that timed out is not put back in the pool
+        assert not client._pools.get(('http', '127.0.0.1', server.port))
+    finally:
+        client.close()
+        server.shutdown()
+    assert server.connections == 1
+    assert server.requests == 2
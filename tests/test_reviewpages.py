@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from steam_reviewparse import bs4_reviews
+from steam_reviewpages import page_size, review_keys, split_reviews, trim_page
+from steam_stub_server import appreviews_page
+
+# boxes with the review_box class in any position, and divs whose classes only start with review_box
+HTML = ('<div class="review_box"><div class="review_box_content">'
+        '<a href="https://steamcommunity.com/id/first/">a</a></div></div>'
+        '<div class="review_box_background">x</div>'
+        '<div class="review_box ">'
+        '<a href="https://steamcommunity.com/profiles/2/">b</a></div>'
+        '<div class="partial review_box\tshort">'
+        '<a href="https://steamcommunity.com/id/third/">c</a></div>'
+        '<div class="review_boxes">'
+        '<a href="https://steamcommunity.com/id/fourth/">d</a></div>')
+
+
+def test_review_boxes_are_matched_by_class():
+    assert len(split_reviews(HTML)) == len(list(bs4_reviews(HTML))) == 3
+    assert review_keys(HTML) == ['id/first', 'profiles/2', 'id/third']
+
+
+def test_trimmed_page_keeps_whole_boxes():
+    page = appreviews_page(30, 0, 20, 20)
+    assert page_size(page) == 20
+    assert trim_page(page, 7) == 13
+    assert page_size(page) == 7
+    assert len(list(bs4_reviews(page['html']))) == 7
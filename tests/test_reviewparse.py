@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from steam_reviewparse import bs4_reviews, fast_reviews
+from steam_stub_server import appreviews_page
+
+# a review with all the fields, {} is replaced by the markup under test
+REVIEW = ('<div class="review_box">'
+          '<div class="persona_name"><a href="https://steamcommunity.com/id/some_name/">Some name</a></div>'
+          '<div class="num_owned_games"><a href="#">42 products in account</a></div>'
+          '<div class="num_reviews"><a href="#">3 reviews</a></div>'
+          '<div class="title ellipsis">Recommended</div>'
+          '<div class="hours ellipsis">12.5 hrs on record</div>'
+          '<div class="postedDate">Posted: March 3, 2015</div>'
+          '<div class="content">{}</div>'
+          '<div class="vote_info">7 people found this review helpful<br>2 people found this review funny</div>'
+          '</div>')
+
+FRAGMENTS = {
+    'entities': REVIEW.format('a &amp; b &lt;c&gt; &eacute; &#39; &#x41; &#128; &#0; &#1; &bogus; &amp x &ampx;'),
+    'entities in attributes': '<div class="review_box"><div class="persona_name">'
+                              '<a href="/id/a&amp;b&quot;c/">n</a></div></div>',
+    'comments': REVIEW.format('a<!-- hidden -->b\n<!---->\n<b>x</b> <!-- c --> <i>y</i>'),
+    'comment in persona_name': '<div class="review_box"><div class="persona_name"><!-- /id/fake/ -->'
+                               '<a href="/profiles/1/">n</a></div></div>',
+    'unclosed tags': REVIEW.format('a<b>bold<i>it') + '<div class="review_box"><div class="content">x<p>y',
+    'stray end tags': REVIEW.format('a</b>b</p></span>c<br></br>d'),
+    'script and style': REVIEW.format('a<script>var x = "</div>";</script>b<style>p {}</style>c'),
+    'template and ruby': REVIEW.format('a<template>t<b>u</b></template>b<ruby>r<rt>rt</rt><rp>(</rp></ruby>'),
+    'script in persona_name': '<div class="review_box"><div class="persona_name"><script>x = "/id/a&b/"</script>'
+                              '<a href="/profiles/1/">n</a></div></div>',
+    'cdata and declarations': REVIEW.format('a<![CDATA[x]]>b<?pi?>c<!DOCTYPE html><!ELEMENT e>d'),
+    'whitespace': REVIEW.format('\n  <b> </b>\n\n<pre>  \n </pre> a  b <textarea>\n</textarea>\t'),
+    'nested boxes': '<div class="review_box"><div class="review_box"><div class="content">inner</div></div>'
+                    '<div class="content">outer</div></div>',
+    'box in a field': '<div class="review_box"><div class="content">x<div class="review_box">'
+                      '<div class="content">inner</div><div class="hours ellipsis">3.0 hrs on record</div>'
+                      '</div></div></div>',
+    'box in persona_name': '<div class="review_box"><div class="persona_name"><div class="review_box">'
+                           '<div class="persona_name"><a href="/id/inner/">i</a></div></div>'
+                           '<a href="/id/outer/">o</a></div></div>',
+    'classes': '<div class="a  review_box b"><div class="title  ellipsis">Recommended</div>'
+               '<div class="ellipsis title">Not Recommended</div><div class="content persona_name">x</div></div>',
+    'no year': REVIEW.replace('March 3, 2015', 'March 3'),
+    'anonymous': REVIEW.replace('/id/some_name/', '#'),
+}
+
+
+@pytest.mark.parametrize('html', FRAGMENTS.values(), ids=FRAGMENTS.keys())
+def test_fast_parser_is_identical_to_bs4(html):
+    rows = list(bs4_reviews(html))
+    assert rows
+    assert list(fast_reviews(html)) == rows
+
+
+def test_fast_parser_is_identical_to_bs4_on_a_page():
+    html = appreviews_page(10, 0, 20, 20)['html']
+    rows = list(bs4_reviews(html))
+    assert len(rows) == 20
+    assert list(fast_reviews(html)) == rows
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+import shutil
+from collections import defaultdict
+
+import pandas as pd
+import pytest
+
+from conftest import script
+from steam_columnar import partition_dir, write_game_parquet
+from steam_stats import STATS_DB, ReviewStats, StatsAggregates, read_chunks
+
+
+def baseline_process_reviews(inputfile_name, output_dir):
+    # the row by row loop over the reviews that ReviewStats replaced
+    with open(inputfile_name, mode="r", encoding="utf-8") as inputfile:
+        # usernames such as NA or null are not missing values
+        input_df = pd.read_csv(inputfile, keep_default_na=False, na_values={'time_played': ['']})
+    totalreviews = len(input_df)
+    totalhours = input_df['time_played'].astype(float).sum()
+    users = defaultdict(lambda: defaultdict(float))
+    games = defaultdict(lambda: defaultdict(float))
+    for _, row in input_df.iterrows():
+        username = row['username']
+        game_id = row['game_id']
+        time = float(row['time_played'])
+        users[username]['games'] += 1
+        users[username]['time_played'] += time
+        games[game_id]['users'] += 1
+        games[game_id]['title'] = row['game_title']
+        games[game_id]['reviews'] += 1
+        if row['recommended'] == 1:
+            games[game_id]['recommended'] += 1
+        else:
+            games[game_id]['not_recommended'] += 1
+        games[game_id]['time_played'] += time
+
+    summary = {'reviews': totalreviews,
+               'hours': totalhours,
+               'users': len(users),
+               'games': len(games)}
+    with open(output_dir + '/summary.json', mode='w', encoding="utf-8") as f:
+        json.dump(summary, f, indent=4)
+    with open(output_dir + '/users.json', mode='w', encoding="utf-8") as f:
+        json.dump(users, f, indent=4)
+    with open(output_dir + '/games.json', mode='w', encoding="utf-8") as f:
+        json.dump(games, f, indent=4)
+
+
+# vanity names that pandas reads as NA by default
+NA_USERS = ['NA', 'null', 'nan', 'NaN', 'None', 'N/A']
+
+
+def shared_users(inputfile_name, outputfile_name, users=37):
+    # every review of the corpus has its own author, here a few users (with steam ids or vanity names) write them all
+    with open(inputfile_name, mode='r', encoding='utf-8', newline='') as inputfile, \
+            open(outputfile_name, mode='w', encoding='utf-8', newline='') as outputfile:
+        reader = csv.reader(inputfile)
+        writer = csv.writer(outputfile)
+        writer.writerow(next(reader))
+        for i, row in enumerate(reader):
+            user = i % users
+            if user < len(NA_USERS):
+                row[4] = NA_USERS[user]
+            else:
+                row[4] = f'user_{user}' if user % 2 else str(76561197960265728 + user)
+            writer.writerow(row)
+
+
+def read(path, binary=True):
+    with open(path, mode='rb' if binary else 'r') as f:
+        return f.read() if binary else json.load(f)
+
+
+def test_chunked_stats_are_identical_to_the_row_by_row_loop(reviews_csv, tmp_path):
+    inputfile_name = str(tmp_path / 'reviews.csv')
+    shared_users(reviews_csv, inputfile_name)
+    baseline_dir = tmp_path / 'baseline'
+    chunked_dir = tmp_path / 'chunked'
+    baseline_dir.mkdir()
+    chunked_dir.mkdir()
+    baseline_process_reviews(inputfile_name, str(baseline_dir))
+    # a small chunksize, so that users and games span several chunks
+    script('steam-reviews-stats').process_reviews(inputfile_name, str(chunked_dir), chunksize=50)
+
+    for name in ['users.json', 'games.json']:
+        assert read(chunked_dir / name) == read(baseline_dir / name)
+    assert set(NA_USERS) <= set(read(chunked_dir / 'users.json', binary=False))
+    baseline = read(baseline_dir / 'summary.json', binary=False)
+    chunked = read(chunked_dir / 'summary.json', binary=False)
+    assert baseline['reviews'] > 10 * 50
+    assert baseline['users'] < 100
+    assert chunked.pop('hours') == pytest.approx(baseline.pop('hours'))
+    assert chunked == baseline
+
+
+def rounded(stats):
+    # hours are summed as floats by ReviewStats and as integer tenths by StatsAggregates
+    return {key: {field: round(value, 1) if field == 'time_played' else value for field, value in fields.items()}
+            for key, fields in stats.items()}
+
+
+def assert_same_stats(rows, aggregates, tmp_path):
+    # the aggregates folded game by game are those of the reviews of the current games, computed from scratch
+    inputfile_name = str(tmp_path / 'current.csv')
+    with open(inputfile_name, mode='w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(script('steam-review-extractor').COLUMNS)
+        for game_rows in rows.values():
+            writer.writerows(game_rows)
+    stats = ReviewStats()
+    for chunk in read_chunks(inputfile_name, chunksize=50):
+        stats.add(chunk)
+    for name in ['from_scratch', 'folded']:
+        (tmp_path / name).mkdir(exist_ok=True)
+    stats.write(str(tmp_path / 'from_scratch'))
+    aggregates.write(str(tmp_path / 'folded'))
+    for name in ['users.json', 'games.json']:
+        assert rounded(read(tmp_path / 'folded' / name, binary=False)) == \
+               rounded(read(tmp_path / 'from_scratch' / name, binary=False))
+    folded = read(tmp_path / 'folded' / 'summary.json', binary=False)
+    from_scratch = read(tmp_path / 'from_scratch' / 'summary.json', binary=False)
+    assert folded.pop('hours') == pytest.approx(from_scratch.pop('hours'))
+    assert folded == from_scratch
+
+
+def test_folded_aggregates_are_identical_to_stats_from_scratch(reviews_csv, tmp_path):
+    pytest.importorskip('pyarrow')
+    inputfile_name = str(tmp_path / 'reviews.csv')
+    shared_users(reviews_csv, inputfile_name)
+    rows = defaultdict(list)
+    with open(inputfile_name, mode='r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            rows[int(row[0])].append(row)
+    game_ids = list(rows)
+    dataset = str(tmp_path / 'dataset')
+    aggregates = StatsAggregates(str(tmp_path / STATS_DB))
+
+    # a new dataset, the last game is extracted later
+    added = game_ids.pop()
+    added_rows = rows.pop(added)
+    for game_id in game_ids:
+        write_game_parquet(dataset, game_id, rows[game_id])
+    assert aggregates.update(dataset) == (len(game_ids), 0)
+    assert_same_stats(rows, aggregates, tmp_path)
+
+    # a game extracted again, with fewer reviews, a different author and more hours
+    changed = game_ids[0]
+    rows[changed] = rows[changed][1:]
+    rows[changed][0][4] = 'NA' if rows[changed][0][4] != 'NA' else 'null'
+    rows[changed][1][8] = str(float(rows[changed][1][8]) + 100.3)
+    write_game_parquet(dataset, changed, rows[changed])
+    assert aggregates.update(dataset) == (1, 0)
+    assert_same_stats(rows, aggregates, tmp_path)
+
+    # a new game
+    rows[added] = added_rows
+    write_game_parquet(dataset, added, rows[added])
+    assert aggregates.update(dataset) == (1, 0)
+    assert_same_stats(rows, aggregates, tmp_path)
+
+    # a dropped game, with users that reviewed only it
+    dropped = game_ids[1]
+    for i, row in enumerate(rows[dropped]):
+        row[4] = f'only_{dropped}_{i}'
+    write_game_parquet(dataset, dropped, rows[dropped])
+    assert aggregates.update(dataset) == (1, 0)
+    assert_same_stats(rows, aggregates, tmp_path)
+    del rows[dropped]
+    shutil.rmtree(partition_dir(dataset, dropped))
+    assert aggregates.update(dataset) == (0, 1)
+    assert_same_stats(rows, aggregates, tmp_path)
+    assert not any(username.startswith('only_') for username in read(tmp_path / 'folded' / 'users.json', False))
+
+    # nothing changed
+    assert aggregates.update(dataset) == (0, 0)
+    aggregates.close()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2018 Andrea Esuli (andrea@esuli.it)
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from time import sleep
+
+import pytest
+
+from conftest import script
+from steam_stub_server import start_server
+from steam_workqueue import DONE, FAILED, LEASED, PENDING, LeaseLost, WorkQueue
+
+# seconds, short enough to let leases expire during the tests
+LEASE = 0.2
+
+# games that have reviews in the stub server
+GAMES = [('app', 30, 'Game 30'), ('app', 40, 'Game 40'), ('app', 50, 'Game 50')]
+
+
+@pytest.fixture
+def queues(tmp_path):
+    """Two crawlers sharing the queue of the same sqlite file."""
+    dbfile = str(tmp_path / 'queue.sqlite')
+    first = WorkQueue(dbfile, owner='first', lease=LEASE)
+    second = WorkQueue(dbfile, owner='second', lease=LEASE)
+    first.add(GAMES)
+    yield first, second
+    first.close()
+    second.close()
+
+
+def expire():
+    sleep(LEASE * 1.5)
+
+
+def test_games_are_leased_once_in_order(queues):
+    first, second = queues
+    assert first.lease() == GAMES[0]
+    assert second.lease() == GAMES[1]
+    assert first.lease() == GAMES[2]
+    assert second.lease() is None
+    assert first.counts() == {PENDING: 0, LEASED: 3, DONE: 0, FAILED: 0}
+    # adding games again does not change them
+    second.add(GAMES)
+    assert second.counts() == first.counts()
+
+
+def test_expired_lease_is_taken_over(queues):
+    first, second = queues
+    first.lease()
+    assert first.owns('app', 30)
+    assert not second.owns('app', 30)
+    expire()
+    assert not first.owns('app', 30)
+    assert second.lease() == GAMES[0]
+    assert second.owns('app', 30)
+    assert not first.owns('app', 30)
+    # the first crawler learns it lost the lease at its next heartbeat, and finishing the game is ignored
+    assert first.renew() == {('app', 30)}
+    first.done('app', 30)
+    assert second.counts()[LEASED] == 1
+    second.done('app', 30)
+    assert second.counts()[DONE] == 1
+
+
+def test_renewed_lease_is_not_taken_over(queues):
+    first, second = queues
+    first.lease()
+    for _ in range(3):
+        sleep(LEASE / 2)
+        assert first.renew() == set()
+    assert first.owns('app', 30)
+    assert second.lease() == GAMES[1]
+
+
+def test_heartbeat_keeps_leases(queues):
+    first, second = queues
+    first.lease()
+    first.start_heartbeat()
+    expire()
+    expire()
+    assert first.owns('app', 30)
+    first.stop_heartbeat()
+    expire()
+    assert second.lease() == GAMES[0]
+
+
+def test_released_game_is_leased_again(queues):
+    first, second = queues
+    first.lease()
+    first.release('app', 30)
+    assert not first.owns('app', 30)
+    assert second.lease() == GAMES[0]
+
+
+def test_game_fails_after_max_attempts(queues):
+    first, second = queues
+    for attempt in range(first.max_attempts):
+        queue = (first, second)[attempt % 2]
+        assert queue.lease() == GAMES[0]
+        queue.fail('app', 30)
+    assert first.counts() == {PENDING: 2, LEASED: 0, DONE: 0, FAILED: 1}
+    assert second.lease() == GAMES[1]
+
+
+def test_expired_leases_count_as_attempts(queues):
+    first, second = queues
+    for _ in range(first.max_attempts - 1):
+        first.lease()
+        expire()
+    assert second.lease() == GAMES[0]
+    second.fail('app', 30)
+    assert second.counts()[FAILED] == 1
+
+
+def test_crawl_stops_when_its_lease_is_lost(queues, tmp_path):
+    first, second = queues
+    server = start_server(pages=8, reviews=20)
+    try:
+        dir, id_, name = first.lease()
+        expire()
+        assert second.lease() == GAMES[0]
+        with pytest.raises(LeaseLost):
+            script('steam-review-crawler').crawlgamereviews(dir, str(id_), name, 'english', 10, 3, 0, str(tmp_path),
+                                                            f'http://127.0.0.1:{server.server_address[1]}',
+                                                            owned=lambda: first.owns(dir, id_))
+    finally:
+        server.shutdown()
+    # no page is written by a crawler without the lease
+    gamedir = os.path.join(str(tmp_path), 'pages', 'reviews', 'english', f'{dir}-{id_}')
+    assert not os.path.exists(os.path.join(gamedir, 'checkpoint.json'))